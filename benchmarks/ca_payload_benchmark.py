@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+
+# ca_payload_benchmark.py
+# Munki Enrollment Server
+# Compares the per-client cost of each ca_payload_mode.
+
+# Written by Gerrit DeWitt (gdewitt@gsu.edu)
+# Project started 2015-06-15.  This file created 2026-10-18.
+# Copyright Georgia State University.
+# This script uses publicly-documented methods known to those skilled in the art.
+# References: See top level Read Me.
+
+# Usage: python ca_payload_benchmark.py [iterations]
+# Uses a throwaway CA generated in memory; the configured CA is not read.
+
+import os, sys, time
+from OpenSSL import crypto
+# Load MES modules from the source directory:
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.realpath(__file__)),'..','src-mes'))
+import security
+import enrollment
+import mobileconfig
+
+def make_throwaway_ca():
+    '''Returns a self-signed CA certificate object.'''
+    key = crypto.PKey()
+    key.generate_key(crypto.TYPE_RSA,2048)
+    cert = crypto.X509()
+    cert.get_subject().CN = "MES Benchmark CA"
+    cert.set_serial_number(1)
+    cert.gmtime_adj_notBefore(0)
+    cert.gmtime_adj_notAfter(24*3600)
+    cert.set_issuer(cert.get_subject())
+    cert.set_pubkey(key)
+    cert.sign(key,'sha256')
+    return cert
+
+def time_it(given_label,given_iterations,given_function):
+    '''Runs the function and prints the mean time per call.'''
+    start = time.time()
+    for i in range(given_iterations):
+        given_function(i)
+    elapsed = time.time() - start
+    print '%(label)-40s %(ms)9.3f ms/call' % {'label':given_label,'ms':elapsed*1000.0/given_iterations}
+
+def main():
+    iterations = 200
+    if len(sys.argv) > 1:
+        iterations = int(sys.argv[1])
+    ca_cert = make_throwaway_ca()
+    ca_cert_cn = security.read_cert_cn(ca_cert)
+    serial = lambda i: 'C02BENCH%04d' % i
+    print "CA payload only (%s iterations):" % iterations
+    time_it("p12 (per client)",iterations,lambda i: security.make_p12_with_ca_cert(ca_cert,serial(i)))
+    time_it("p12-cached",iterations,lambda i: security.get_cached_p12_with_ca_cert(ca_cert))
+    time_it("cert",iterations,lambda i: security.cert_to_der(ca_cert))
+    print "CA payload + mobileconfig (%s iterations):" % iterations
+    for mode in enrollment.config_munki_client.CA_PAYLOAD_MODES:
+        enrollment.config_munki_client.CA_PAYLOAD_MODE = mode
+        mobileconfig.config_munki_client.CA_PAYLOAD_MODE = mode
+        mobileconfig.TEMPLATES.clear()
+        def make_profile(i):
+            data,password = enrollment.make_ca_payload_data(ca_cert,serial(i))
+            enrollment.make_mobileconfig(serial(i),data,ca_cert_cn,password)
+        time_it(mode,iterations,make_profile)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+
+# cert_verify_benchmark.py
+# Munki Enrollment Server
+# Compares the per-request cost of checking a client certificate against the CA.
+
+# Written by Gerrit DeWitt (gdewitt@gsu.edu)
+# Project started 2015-06-15.  This file created 2026-10-18.
+# Copyright Georgia State University.
+# This script uses publicly-documented methods known to those skilled in the art.
+# References: See top level Read Me.
+
+# Usage: python cert_verify_benchmark.py [iterations]
+# Uses a throwaway CA and client certificate generated in memory;
+# the configured CA is not read.
+
+import os, sys
+from OpenSSL import crypto
+# Load MES modules from the source directory:
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.realpath(__file__)),'..','src-mes'))
+import security
+import ca_cache
+import cert_cache
+from ca_payload_benchmark import time_it
+
+def make_throwaway_pki():
+    '''Returns (CA certificate, client certificate PEM) signed by a new CA.'''
+    ca_key = crypto.PKey()
+    ca_key.generate_key(crypto.TYPE_RSA,2048)
+    ca_cert = crypto.X509()
+    ca_cert.set_version(2)
+    ca_cert.get_subject().CN = "MES Benchmark CA"
+    ca_cert.set_serial_number(1)
+    ca_cert.gmtime_adj_notBefore(0)
+    ca_cert.gmtime_adj_notAfter(24*3600)
+    ca_cert.set_issuer(ca_cert.get_subject())
+    ca_cert.set_pubkey(ca_key)
+    ca_cert.add_extensions([crypto.X509Extension('basicConstraints',True,'CA:TRUE')])
+    ca_cert.sign(ca_key,'sha256')
+    client_key = crypto.PKey()
+    client_key.generate_key(crypto.TYPE_RSA,2048)
+    client_cert = security.generate_csr(client_key,'C02BENCH0001')
+    client_cert.set_issuer(ca_cert.get_subject())
+    client_cert.sign(ca_key,'sha256')
+    return ca_cert,crypto.dump_certificate(crypto.FILETYPE_PEM,client_cert)
+
+def main():
+    iterations = 2000
+    if len(sys.argv) > 1:
+        iterations = int(sys.argv[1])
+    ca_cert,client_pem = make_throwaway_pki()
+    ca_store = security.make_ca_store(ca_cert)
+    client_cert = security.pem_to_cert(client_pem)
+    print "Client certificate check (%s iterations):" % iterations
+    time_it("parse PEM + read CN",iterations,lambda i: security.read_cert_cn(security.pem_to_cert(client_pem)))
+    time_it("new store + chain walk",iterations,lambda i: security.verify_cert_chain(client_cert,security.make_ca_store(ca_cert)))
+    time_it("cached store + chain walk",iterations,lambda i: security.verify_cert_chain(client_cert,ca_store))
+    # Steady state: the certificate is cached and has passed once already.
+    entry = cert_cache.lookup(client_pem)
+    cert_cache.set_chain_valid(entry,security.verify_cert_chain(client_cert,ca_store),ca_cache.GENERATION)
+    time_it("cert_cache lookup + passed check",iterations,lambda i: cert_cache.is_chain_valid(cert_cache.lookup(client_pem)))
+    print cert_cache.stats()
+
+if __name__ == "__main__":
+    main()
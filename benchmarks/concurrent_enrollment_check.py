@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+# concurrent_enrollment_check.py
+# Munki Enrollment Server
+# Enrolls many serials at once from parallel threads and checks that each
+# client receives its own profile.
+
+# Written by Gerrit DeWitt (gdewitt@gsu.edu)
+# Project started 2015-06-15.  This file created 2026-10-18.
+# Copyright Georgia State University.
+# This script uses publicly-documented methods known to those skilled in the art.
+# References: See top level Read Me.
+
+# Usage: python concurrent_enrollment_check.py [--full] [threads] [serials per thread]
+# By default only the configuration profile is generated, so no CA is needed.
+# With --full, each thread posts request-enrollment to the app (through the
+# Flask test client, as the threaded and async servers run it); this needs
+# the configured CA and Munki repository, and creates computer manifests.
+# Exits with status 1 if any client got another client's values.
+
+import os, sys, time, tarfile, plistlib, threading
+from cStringIO import StringIO
+# Load MES modules from the source directory:
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.realpath(__file__)),'..','src-mes'))
+import security
+import enrollment
+import manifests
+
+ERRORS = []
+ERRORS_LOCK = threading.Lock()
+
+def record_error(given_message):
+    with ERRORS_LOCK:
+        ERRORS.append(given_message)
+
+def check_profile(given_serial,given_profile_str,given_keychain_passwords):
+    '''Checks that a profile was made for the given serial.'''
+    profile_dict = plistlib.readPlistFromString(given_profile_str)
+    mcx_payload_dict = profile_dict['PayloadContent'][1]['PayloadContent']
+    prefs_dict = mcx_payload_dict[enrollment.config_munki_client.MUNKI_MCX_DEFAULTS_DOMAIN]['Forced'][0]['mcx_preference_settings']
+    if prefs_dict['ClientIdentifier'] != manifests.client_identifier(given_serial):
+        record_error("%(serial)s got ClientIdentifier %(identifier)s" % {'serial':given_serial,'identifier':prefs_dict['ClientIdentifier']})
+    given_keychain_passwords.append(prefs_dict['KeychainPassword'])
+
+def profile_worker(given_thread_index,given_count,given_keychain_passwords):
+    '''Generates profiles for this thread's serials.'''
+    for i in range(given_count):
+        serial = 'C02T%02dN%04d' % (given_thread_index,i)
+        profile_str = enrollment.make_mobileconfig(serial,os.urandom(64),"MES CA",serial)
+        if not profile_str:
+            record_error("%s: no profile" % serial)
+            continue
+        check_profile(serial,profile_str,given_keychain_passwords)
+
+def full_worker(given_thread_index,given_count,given_keychain_passwords):
+    '''Enrolls this thread's serials through the app.'''
+    import server
+    client = server.app.test_client()
+    for i in range(given_count):
+        serial = 'C02T%02dN%04d' % (given_thread_index,i)
+        response = client.post('/enroll',data={'command':'request-enrollment','message':serial,'response_mode':'binary'})
+        if response.status_code != 200:
+            record_error("%(serial)s: HTTP %(status)s" % {'serial':serial,'status':response.status_code})
+            continue
+        tar_file = tarfile.open(fileobj=StringIO(response.data))
+        check_profile(serial,tar_file.extractfile('client-enrollment.mobileconfig').read(),given_keychain_passwords)
+        identity_pem = tar_file.extractfile('client-identity.pem').read()
+        cert = security.pem_to_cert(identity_pem[identity_pem.index('-----BEGIN CERTIFICATE'):])
+        if security.read_cert_cn(cert).upper() != serial:
+            record_error("%(serial)s got certificate for %(cn)s" % {'serial':serial,'cn':security.read_cert_cn(cert)})
+
+def main():
+    arguments = sys.argv[1:]
+    worker = profile_worker
+    if arguments and arguments[0] == '--full':
+        worker = full_worker
+        arguments = arguments[1:]
+    thread_count = 16
+    count = 50
+    if arguments:
+        thread_count = int(arguments[0])
+    if len(arguments) > 1:
+        count = int(arguments[1])
+    keychain_passwords = []
+    threads = [threading.Thread(target=worker,args=(i,count,keychain_passwords)) for i in range(thread_count)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    if len(set(keychain_passwords)) != len(keychain_passwords):
+        record_error("Keychain passwords were shared between clients.")
+    if 'ClientIdentifier' in enrollment.config_munki_client.MUNKI_CLIENT_PREFS_DICT:
+        record_error("The shared Munki client prefs were changed.")
+    print "%(count)s profiles from %(threads)s threads in %(seconds).2f s: %(errors)s errors." % {'count':len(keychain_passwords),'threads':thread_count,'seconds':elapsed,'errors':len(ERRORS)}
+    for error in ERRORS[:20]:
+        print "  %s" % error
+    if ERRORS:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,525 @@
+#!/usr/bin/env python
+
+# enrollment_load_benchmark.py
+# Munki Enrollment Server
+# Drives /enroll with a mix of request-enrollment, transaction-a and
+# transaction-b against a throwaway CA and Munki repository, and reports
+# throughput and latency percentiles as JSON.
+
+# Written by Gerrit DeWitt (gdewitt@gsu.edu)
+# Project started 2015-06-15.  This file created 2026-10-18.
+# Copyright Georgia State University.
+# This script uses publicly-documented methods known to those skilled in the art.
+# References: See top level Read Me.
+
+# Usage: python enrollment_load_benchmark.py [options]; see --help.
+#
+# Runs offline.  A scratch directory gets a new CA, a Munki repository with
+# --groups group manifests and --computers computer manifests, and a copy of
+# the MES whose configuration.plist is the one in src-mes with its paths
+# pointed at the scratch directory (change other keys with --set).  The
+# configured CA and repository are not touched.
+#
+# --identities clients are enrolled first, untimed, so that transaction-a
+# and transaction-b are sent with real client certificates and correctly
+# signed messages, as the Munki Enrollment Client sends them.  Then
+# --requests requests are sent from --concurrency threads, each picking a
+# command by the --mix weights.  Enrollments are for computers already in
+# the repository (re-imaging) or, for the rest, for new serials.
+#
+# --target inprocess (the default) sends the requests to the app in this
+# process through the Flask test client, as the threaded and async servers
+# run it; --target wsgi starts wsgi_server.py (gunicorn) on a local port.
+#
+# Results (throughput; mean, p50, p95, p99 and max per command and per
+# enrollment stage, the stages taken from the Server-Timing header) are
+# printed and written with --output as JSON.  --compare prints the change
+# from an earlier JSON result, and with --max-regression exits with status 1
+# if any p95 grew by more than that percentage.
+
+import os, sys, json, time, random, shutil, socket, signal, tarfile, urllib, base64, httplib, plistlib, platform, tempfile, argparse, threading, subprocess, multiprocessing
+from cStringIO import StringIO
+from OpenSSL import crypto
+
+SOURCE_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)),'..','src-mes')
+CA_PASSPHRASE = "mes-benchmark"
+COMMANDS = ['request-enrollment','transaction-a','transaction-b']
+RESULT_FORMAT_VERSION = 1
+
+#PRAGMA MARK: SCRATCH SERVER
+
+def make_ca(given_dir):
+    '''Writes a new CA private key (encrypted) and certificate to the given
+        directory.  Returns (key path, certificate path).'''
+    key = crypto.PKey()
+    key.generate_key(crypto.TYPE_RSA,2048)
+    cert = crypto.X509()
+    cert.set_version(2)
+    cert.get_subject().CN = "MES Benchmark CA"
+    cert.set_serial_number(1)
+    cert.gmtime_adj_notBefore(0)
+    cert.gmtime_adj_notAfter(7*24*3600)
+    cert.set_issuer(cert.get_subject())
+    cert.set_pubkey(key)
+    cert.add_extensions([crypto.X509Extension('basicConstraints',True,'CA:TRUE')])
+    cert.sign(key,'sha256')
+    key_path = os.path.join(given_dir,'ca.key.pem')
+    cert_path = os.path.join(given_dir,'ca.cert.pem')
+    with open(key_path,'w') as file_object:
+        file_object.write(crypto.dump_privatekey(crypto.FILETYPE_PEM,key,'aes256',CA_PASSPHRASE))
+    with open(cert_path,'w') as file_object:
+        file_object.write(crypto.dump_certificate(crypto.FILETYPE_PEM,cert))
+    return key_path,cert_path
+
+def group_name(given_index):
+    return 'bench-group-%03d' % given_index
+
+def computer_serial(given_index):
+    return 'C02SYN%06d' % given_index
+
+def make_repo(given_repo_dir,given_group_count,given_computer_count,given_random):
+    '''Writes group and computer manifests shaped like those the MES makes.'''
+    groups_dir = os.path.join(given_repo_dir,'manifests','groups')
+    computers_dir = os.path.join(given_repo_dir,'manifests','computers')
+    os.makedirs(groups_dir)
+    os.makedirs(computers_dir)
+    for i in range(given_group_count):
+        group_dict = {}
+        group_dict['_metadata'] = {'display_name':'Benchmark Group %s' % i,'description':'Synthetic group %s' % i,'computer_name_prefix':'BG%03d-' % i}
+        group_dict['catalogs'] = ['production']
+        group_dict['managed_installs'] = ['package-%s' % j for j in range(given_random.randint(5,40))]
+        plistlib.writePlist(group_dict,os.path.join(groups_dir,group_name(i)))
+    for i in range(given_computer_count):
+        computer_dict = {}
+        computer_dict['_metadata'] = {'computer_name':'SYN-%06d' % i}
+        computer_dict['catalogs'] = ['production']
+        computer_dict['included_manifests'] = ['groups/%s' % group_name(given_random.randrange(given_group_count))]
+        computer_dict['managed_installs'] = []
+        computer_dict['managed_uninstalls'] = []
+        plistlib.writePlist(computer_dict,os.path.join(computers_dir,computer_serial(i)))
+
+def parse_setting(given_setting):
+    '''Returns (section, key, value) from a Section.key=value argument.
+        The value is read as an integer, real or boolean when it looks like one.'''
+    name,value = given_setting.split('=',1)
+    section,key = name.split('.',1)
+    if value.lower() in ['true','false']:
+        return section,key,value.lower() == 'true'
+    for value_type in [int,float]:
+        try:
+            return section,key,value_type(value)
+        except ValueError:
+            pass
+    return section,key,value
+
+def stage_server(given_scratch_dir,given_arguments,given_port):
+    '''Copies the MES into the scratch directory with a configuration
+        pointing at the scratch CA and repository.  Returns its directory.'''
+    mes_dir = os.path.join(given_scratch_dir,'mes')
+    os.makedirs(mes_dir)
+    for file_name in os.listdir(SOURCE_DIR):
+        if file_name.endswith('.py') or file_name == 'munki_client_prefs.plist':
+            shutil.copy(os.path.join(SOURCE_DIR,file_name),mes_dir)
+    key_path,cert_path = make_ca(given_scratch_dir)
+    config_dict = plistlib.readPlist(os.path.join(SOURCE_DIR,'configuration.plist'))
+    config_dict['ServerApp']['port'] = given_port
+    config_dict['ServerApp']['debug_mode'] = False
+    config_dict['ServerApp']['temp_dir'] = os.path.join(given_scratch_dir,'tmp')
+    config_dict['ServerApp']['log_path'] = os.path.join(given_scratch_dir,'mes.log')
+    config_dict['ServerApp']['workers'] = given_arguments.workers
+    config_dict['MunkiManifests']['repo_path'] = os.path.join(given_scratch_dir,'repo')
+    config_dict['MunkiManifests']['default_group_manifest'] = group_name(0)
+    config_dict['CertificateAuthority']['private_key_path'] = key_path
+    config_dict['CertificateAuthority']['cert_path'] = cert_path
+    config_dict['CertificateAuthority']['private_key_passphrase'] = CA_PASSPHRASE
+    config_dict['CertificateAuthority']['ledger_path'] = os.path.join(given_scratch_dir,'ledger.sqlite')
+    for setting in given_arguments.set or []:
+        section,key,value = parse_setting(setting)
+        config_dict.setdefault(section,{})[key] = value
+    plistlib.writePlist(config_dict,os.path.join(mes_dir,'configuration.plist'))
+    os.makedirs(os.path.join(given_scratch_dir,'tmp'))
+    return mes_dir
+
+def free_port():
+    '''Returns a TCP port on 127.0.0.1 that is free now.'''
+    probe = socket.socket()
+    probe.bind(('127.0.0.1',0))
+    port = probe.getsockname()[1]
+    probe.close()
+    return port
+
+class InProcessTarget(object):
+    '''Sends requests to the app in this process through the Flask test client.'''
+    def __init__(self,given_mes_dir):
+        sys.path.insert(0,given_mes_dir)
+        import server
+        import key_pool
+        import crypto_pool
+        self.server = server
+        # As server.py does when run:
+        key_pool.start()
+        crypto_pool.start()
+        server.preload()
+        self.local = threading.local()
+
+    def post(self,given_form_dict):
+        '''Returns (status, headers dict, body).'''
+        client = getattr(self.local,'client',None)
+        if not client:
+            client = self.server.app.test_client()
+            self.local.client = client
+        response = client.post('/enroll',data=given_form_dict)
+        return response.status_code,dict(response.headers),response.data
+
+    def stop(self):
+        import key_pool
+        import crypto_pool
+        import metrics
+        import common
+        key_pool.stop()
+        crypto_pool.stop()
+        # Now rather than at exit, when the scratch directory is gone:
+        metrics.retire()
+        common.stop_log_writer()
+
+class WSGITarget(object):
+    '''Starts wsgi_server.py on a local port and sends requests over HTTP.'''
+    def __init__(self,given_mes_dir,given_port):
+        self.port = given_port
+        self.pid_file_path = os.path.join(given_mes_dir,'mes.pid')
+        self.process = subprocess.Popen([sys.executable,os.path.join(given_mes_dir,'wsgi_server.py'),self.pid_file_path],cwd=given_mes_dir,stdout=open(os.devnull,'w'),stderr=subprocess.STDOUT)
+        deadline = time.time() + 60
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError("wsgi_server.py exited with status %s." % self.process.returncode)
+            try:
+                socket.create_connection(('127.0.0.1',given_port),1).close()
+                return
+            except socket.error:
+                time.sleep(0.2)
+        self.stop()
+        raise RuntimeError("wsgi_server.py did not start listening on port %s." % given_port)
+
+    def post(self,given_form_dict):
+        '''Returns (status, headers dict, body).'''
+        connection = httplib.HTTPConnection('127.0.0.1',self.port,timeout=300)
+        try:
+            connection.request('POST','/enroll',urllib.urlencode(given_form_dict),{'Content-Type':'application/x-www-form-urlencoded'})
+            response = connection.getresponse()
+            return response.status,dict(response.getheaders()),response.read()
+        finally:
+            connection.close()
+
+    def stop(self):
+        if self.process.poll() is None:
+            self.process.send_signal(signal.SIGTERM)
+            self.process.wait()
+
+#PRAGMA MARK: CLIENTS
+
+class Identity(object):
+    '''An enrolled client: its serial, private key and certificate PEM.'''
+    def __init__(self,given_serial,given_tar_data):
+        tar_file = tarfile.open(fileobj=StringIO(given_tar_data))
+        identity_pem = tar_file.extractfile('client-identity.pem').read()
+        self.serial = given_serial
+        self.key = crypto.load_privatekey(crypto.FILETYPE_PEM,identity_pem)
+        cert_start = identity_pem.index('-----BEGIN CERTIFICATE')
+        cert_end = identity_pem.index('-----END CERTIFICATE') + len('-----END CERTIFICATE-----\n')
+        self.cert_pem = identity_pem[cert_start:cert_end]
+
+    def signed_form(self,given_command,given_message,given_hash_algorithm):
+        '''Returns the POST variables for an authenticated command.'''
+        form_dict = {}
+        form_dict['command'] = given_command
+        form_dict['message'] = given_message
+        form_dict['signature'] = base64.b64encode(crypto.sign(self.key,given_message,given_hash_algorithm))
+        form_dict['certificate'] = self.cert_pem
+        return form_dict
+
+def enroll(given_target,given_serial):
+    '''Sends request-enrollment.  Returns (status, headers, tar data or None).'''
+    status,headers,body = given_target.post({'command':'request-enrollment','message':given_serial})
+    tar_data = None
+    if status == 200:
+        try:
+            tar_data = base64.b64decode(body)
+            tarfile.open(fileobj=StringIO(tar_data)).getmember('client-enrollment.mobileconfig')
+        except (TypeError,KeyError,tarfile.TarError):
+            tar_data = None
+    return status,headers,tar_data
+
+def parse_server_timing(given_header):
+    '''Returns {stage: milliseconds} from a Server-Timing header value.'''
+    timings_dict = {}
+    for item in (given_header or '').split(','):
+        parts = item.strip().split(';dur=')
+        if len(parts) == 2:
+            try:
+                timings_dict[parts[0]] = float(parts[1])
+            except ValueError:
+                pass
+    return timings_dict
+
+class LoadRun(object):
+    '''Sends the timed requests and collects their results.'''
+    def __init__(self,given_target,given_identities,given_arguments,given_hash_algorithm):
+        self.target = given_target
+        self.identities = given_identities
+        self.arguments = given_arguments
+        self.hash_algorithm = given_hash_algorithm
+        self.mix = parse_mix(given_arguments.mix)
+        self.lock = threading.Lock()
+        self.next_index = 0
+        # Command -> array of seconds, and -> {status: count}:
+        self.latencies = dict([(command,[]) for command in COMMANDS])
+        self.statuses = dict([(command,{}) for command in COMMANDS])
+        self.errors = dict([(command,0) for command in COMMANDS])
+        # Stage -> array of milliseconds:
+        self.stages = {}
+
+    def take_index(self):
+        with self.lock:
+            if self.next_index >= self.arguments.requests:
+                return None
+            self.next_index += 1
+            return self.next_index - 1
+
+    def pick_command(self,given_random):
+        point = given_random.random()*sum([weight for command,weight in self.mix])
+        for command,weight in self.mix:
+            point -= weight
+            if point < 0:
+                return command
+        return self.mix[-1][0]
+
+    def send(self,given_index,given_random):
+        '''Sends one request.  Returns (command, status, seconds, ok, timings).'''
+        command = self.pick_command(given_random)
+        if command == 'request-enrollment':
+            if given_random.random() < self.arguments.reimage_share and self.arguments.computers:
+                serial = computer_serial(given_random.randrange(self.arguments.computers))
+            else:
+                serial = 'C02NEW%06d' % given_index
+            start = time.time()
+            status,headers,tar_data = enroll(self.target,serial)
+            elapsed = time.time() - start
+            return command,status,elapsed,tar_data is not None,parse_server_timing(headers.get('Server-Timing') or headers.get('server-timing'))
+        identity = given_random.choice(self.identities)
+        if command == 'transaction-a':
+            form_dict = identity.signed_form(command,identity.serial,self.hash_algorithm)
+        else:
+            message_dict = {}
+            message_dict['group_manifest_name'] = group_name(given_random.randrange(self.arguments.groups))
+            message_dict['desired_computer_name'] = 'BENCH-%06d' % given_index
+            form_dict = identity.signed_form(command,plistlib.writePlistToString(message_dict),self.hash_algorithm)
+        start = time.time()
+        status,headers,body = self.target.post(form_dict)
+        elapsed = time.time() - start
+        ok = status == 200
+        if ok:
+            try:
+                plistlib.readPlistFromString(body)
+            except Exception:
+                ok = False
+        return command,status,elapsed,ok,{}
+
+    def worker(self,given_thread_index):
+        thread_random = random.Random(self.arguments.seed*1000 + given_thread_index)
+        while True:
+            index = self.take_index()
+            if index is None:
+                return
+            try:
+                command,status,elapsed,ok,timings_dict = self.send(index,thread_random)
+            except (socket.error,httplib.HTTPException):
+                command,status,elapsed,ok,timings_dict = 'request-enrollment','connection',0.0,False,{}
+            with self.lock:
+                self.latencies[command].append(elapsed)
+                self.statuses[command][str(status)] = self.statuses[command].get(str(status),0) + 1
+                if not ok:
+                    self.errors[command] += 1
+                for stage_name in timings_dict:
+                    self.stages.setdefault(stage_name,[]).append(timings_dict[stage_name])
+
+    def run(self):
+        '''Sends the requests; returns the elapsed seconds.'''
+        threads = [threading.Thread(target=self.worker,args=(i,)) for i in range(self.arguments.concurrency)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.time() - start
+
+def parse_mix(given_mix):
+    '''Returns [(command, weight)] from "request-enrollment:20,transaction-a:50,...".'''
+    mix = []
+    for item in given_mix.split(','):
+        command,weight = item.split(':')
+        if command not in COMMANDS:
+            raise ValueError("Unknown command %s in --mix." % command)
+        mix.append((command,float(weight)))
+    return mix
+
+#PRAGMA MARK: RESULTS
+
+def percentile(given_sorted_values,given_percent):
+    '''Returns the nearest-rank percentile of sorted values.'''
+    if not given_sorted_values:
+        return None
+    rank = int(round(given_percent/100.0*len(given_sorted_values) + 0.5)) - 1
+    return given_sorted_values[max(0,min(len(given_sorted_values) - 1,rank))]
+
+def summarize(given_milliseconds):
+    '''Returns count, mean, p50, p95, p99 and max of the given times.'''
+    values = sorted(given_milliseconds)
+    summary_dict = {'count':len(values)}
+    if not values:
+        return summary_dict
+    summary_dict['mean_ms'] = round(sum(values)/len(values),3)
+    for percent in [50,95,99]:
+        summary_dict['p%s_ms' % percent] = round(percentile(values,percent),3)
+    summary_dict['max_ms'] = round(values[-1],3)
+    return summary_dict
+
+def git_commit():
+    '''Returns the commit of the source tree, or None.'''
+    try:
+        return subprocess.check_output(['git','rev-parse','HEAD'],cwd=SOURCE_DIR,stderr=open(os.devnull,'w')).strip()
+    except (OSError,subprocess.CalledProcessError):
+        return None
+
+def make_result(given_run,given_elapsed,given_arguments):
+    '''Returns the machine-readable result of a run.'''
+    result_dict = {}
+    result_dict['format_version'] = RESULT_FORMAT_VERSION
+    result_dict['started_at'] = time.strftime('%Y-%m-%dT%H:%M:%SZ',time.gmtime(time.time() - given_elapsed))
+    result_dict['environment'] = {'python':platform.python_version(),'implementation':platform.python_implementation(),'platform':platform.platform(),'cpus':multiprocessing.cpu_count(),'git_commit':git_commit()}
+    parameters_dict = {}
+    for name in ['target','groups','computers','identities','requests','concurrency','workers','mix','reimage_share','seed','set']:
+        parameters_dict[name] = getattr(given_arguments,name)
+    result_dict['parameters'] = parameters_dict
+    result_dict['duration_seconds'] = round(given_elapsed,3)
+    total_count = sum([len(given_run.latencies[command]) for command in COMMANDS])
+    result_dict['requests'] = total_count
+    result_dict['errors'] = sum(given_run.errors.values())
+    result_dict['throughput_rps'] = round(total_count/given_elapsed,3) if given_elapsed else None
+    result_dict['commands'] = {}
+    for command in COMMANDS:
+        summary_dict = summarize([seconds*1000.0 for seconds in given_run.latencies[command]])
+        summary_dict['errors'] = given_run.errors[command]
+        summary_dict['statuses'] = given_run.statuses[command]
+        summary_dict['throughput_rps'] = round(summary_dict['count']/given_elapsed,3) if given_elapsed else None
+        result_dict['commands'][command] = summary_dict
+    result_dict['stages'] = {}
+    for stage_name in given_run.stages:
+        result_dict['stages'][stage_name] = summarize(given_run.stages[stage_name])
+    return result_dict
+
+def print_result(given_result_dict):
+    print "%(requests)s requests in %(seconds).2f s: %(rps).1f requests/s, %(errors)s errors." % {'requests':given_result_dict['requests'],'seconds':given_result_dict['duration_seconds'],'rps':given_result_dict['throughput_rps'] or 0,'errors':given_result_dict['errors']}
+    print "  %-24s %7s %9s %9s %9s %9s %9s" % ("command / stage","count","mean ms","p50 ms","p95 ms","p99 ms","max ms")
+    rows = [(command,given_result_dict['commands'][command]) for command in COMMANDS]
+    rows += [("  %s" % stage_name,given_result_dict['stages'][stage_name]) for stage_name in sorted(given_result_dict['stages'])]
+    for name,summary_dict in rows:
+        if not summary_dict['count']:
+            continue
+        print "  %-24s %7s %9.1f %9.1f %9.1f %9.1f %9.1f" % (name,summary_dict['count'],summary_dict['mean_ms'],summary_dict['p50_ms'],summary_dict['p95_ms'],summary_dict['p99_ms'],summary_dict['max_ms'])
+
+def compare_results(given_old_dict,given_new_dict,given_max_regression):
+    '''Prints the change in each percentile from an earlier result.
+        Returns false if a p95 grew by more than given_max_regression percent.'''
+    passed = True
+    print "Change from the earlier result (old -> new ms):"
+    old_rps = given_old_dict.get('throughput_rps') or 0
+    if old_rps:
+        print "  throughput %(old).1f -> %(new).1f requests/s (%(change)+.1f%%)" % {'old':old_rps,'new':given_new_dict['throughput_rps'],'change':(given_new_dict['throughput_rps'] - old_rps)*100.0/old_rps}
+    for kind in ['commands','stages']:
+        for name in sorted(given_new_dict[kind]):
+            old_summary = given_old_dict.get(kind,{}).get(name,{})
+            new_summary = given_new_dict[kind][name]
+            changes = []
+            for key in ['p50_ms','p95_ms','p99_ms']:
+                if not old_summary.get(key) or new_summary.get(key) is None:
+                    continue
+                change = (new_summary[key] - old_summary[key])*100.0/old_summary[key]
+                changes.append("%(key)s %(old).1f -> %(new).1f (%(change)+.0f%%)" % {'key':key[:3],'old':old_summary[key],'new':new_summary[key],'change':change})
+                if key == 'p95_ms' and given_max_regression is not None and change > given_max_regression:
+                    passed = False
+                    changes[-1] += " REGRESSION"
+            if changes:
+                print "  %(name)-24s %(changes)s" % {'name':name,'changes':', '.join(changes)}
+    return passed
+
+#PRAGMA MARK: MAIN
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Load benchmark for the Munki Enrollment Server, run against a throwaway CA and repository.")
+    parser.add_argument('--target',choices=['inprocess','wsgi'],default='inprocess',help="send requests to the app in this process (default) or to wsgi_server.py over HTTP")
+    parser.add_argument('--groups',type=int,default=50,help="group manifests in the synthetic repository (default 50)")
+    parser.add_argument('--computers',type=int,default=1000,help="computer manifests in the synthetic repository (default 1000)")
+    parser.add_argument('--identities',type=int,default=20,help="clients enrolled before the timed run, for transaction-a and -b (default 20)")
+    parser.add_argument('--requests',type=int,default=500,help="timed requests (default 500)")
+    parser.add_argument('--concurrency',type=int,default=8,help="client threads (default 8)")
+    parser.add_argument('--workers',type=int,default=4,help="gunicorn workers with --target wsgi (default 4)")
+    parser.add_argument('--mix',default='request-enrollment:20,transaction-a:50,transaction-b:30',help="command weights (default request-enrollment:20,transaction-a:50,transaction-b:30)")
+    parser.add_argument('--reimage-share',type=float,default=0.5,help="share of enrollments for computers already in the repository (default 0.5)")
+    parser.add_argument('--set',action='append',metavar='SECTION.KEY=VALUE',help="override a configuration.plist key; may be repeated")
+    parser.add_argument('--seed',type=int,default=1,help="random seed (default 1)")
+    parser.add_argument('--output',help="write the result as JSON to this path")
+    parser.add_argument('--compare',metavar='PATH',help="print the change from an earlier JSON result")
+    parser.add_argument('--max-regression',type=float,metavar='PERCENT',help="with --compare, exit with status 1 if any p95 grew by more than this")
+    parser.add_argument('--keep',action='store_true',help="keep the scratch directory")
+    return parser.parse_args()
+
+def main():
+    arguments = parse_arguments()
+    if arguments.groups < 1 or arguments.identities < 1 or arguments.concurrency < 1:
+        print "--groups, --identities and --concurrency must be at least 1."
+        return 1
+    setup_random = random.Random(arguments.seed)
+    scratch_dir = tempfile.mkdtemp(prefix='mes-benchmark-')
+    target = None
+    try:
+        print "Setting up in %s..." % scratch_dir
+        make_repo(os.path.join(scratch_dir,'repo'),arguments.groups,arguments.computers,setup_random)
+        port = free_port()
+        mes_dir = stage_server(scratch_dir,arguments,port)
+        hash_algorithm = plistlib.readPlist(os.path.join(mes_dir,'configuration.plist'))['ClientCertificate']['csr_signing_hash_algorithm']
+        if arguments.target == 'wsgi':
+            target = WSGITarget(mes_dir,port)
+        else:
+            target = InProcessTarget(mes_dir)
+        identities = []
+        for i in range(arguments.identities):
+            serial = 'C02BID%06d' % i
+            status,headers,tar_data = enroll(target,serial)
+            if not tar_data:
+                print "Could not enroll client %(serial)s (HTTP %(status)s); see %(log)s." % {'serial':serial,'status':status,'log':os.path.join(scratch_dir,'mes.log')}
+                return 1
+            identities.append(Identity(serial,tar_data))
+        print "Sending %(requests)s requests from %(threads)s threads (%(target)s)..." % {'requests':arguments.requests,'threads':arguments.concurrency,'target':arguments.target}
+        load_run = LoadRun(target,identities,arguments,hash_algorithm)
+        elapsed = load_run.run()
+    finally:
+        if target:
+            target.stop()
+        if not arguments.keep:
+            shutil.rmtree(scratch_dir,True)
+    result_dict = make_result(load_run,elapsed,arguments)
+    print_result(result_dict)
+    if arguments.output:
+        with open(arguments.output,'w') as file_object:
+            json.dump(result_dict,file_object,indent=2,sort_keys=True)
+            file_object.write('\n')
+        print "Result written to %s." % arguments.output
+    if arguments.compare:
+        with open(arguments.compare,'r') as file_object:
+            old_result_dict = json.load(file_object)
+        if not compare_results(old_result_dict,result_dict,arguments.max_regression):
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
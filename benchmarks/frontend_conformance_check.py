@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+
+# frontend_conformance_check.py
+# Munki Enrollment Server
+# Sends the same requests to wsgi_server.py and async_server.py and checks
+# that both front ends give the same responses.
+
+# Written by Gerrit DeWitt (gdewitt@gsu.edu)
+# Project started 2015-06-15.  This file created 2026-10-18.
+# Copyright Georgia State University.
+# This script uses publicly-documented methods known to those skilled in the art.
+# References: See top level Read Me.
+
+# Usage: python frontend_conformance_check.py [--keep]
+# Runs offline.  A scratch directory gets a new CA and Munki repository, as
+# for enrollment_load_benchmark.py, and two copies of the MES that use them,
+# one started with wsgi_server.py and one with async_server.py.  A client is
+# enrolled, and then transaction-a, transaction-b, set-name, an unknown
+# command and malformed requests are sent to each server in turn.  The
+# client's computer manifest is put back as it was before each request, so
+# both servers start from the same repository.  Status codes and bodies are
+# compared byte for byte (headers such as Date and Server differ, and are
+# not compared).  Exits with status 1 on any difference.
+
+import os, sys, time, random, shutil, socket, signal, base64, urllib, httplib, plistlib, tempfile, subprocess
+from OpenSSL import crypto
+from enrollment_load_benchmark import SOURCE_DIR, CA_PASSPHRASE, make_ca, make_repo, group_name, free_port, Identity
+
+SERIAL = 'C02CNF000001'
+FRONT_ENDS = ['wsgi_server.py','async_server.py']
+
+#PRAGMA MARK: SERVERS
+
+def stage_front_end(given_scratch_dir,given_name,given_port,given_key_path,given_cert_path):
+    '''Copies the MES into the scratch directory with a configuration
+        pointing at the shared scratch CA and repository.  Returns its directory.'''
+    mes_dir = os.path.join(given_scratch_dir,given_name)
+    os.makedirs(mes_dir)
+    for file_name in os.listdir(SOURCE_DIR):
+        if file_name.endswith('.py') or file_name == 'munki_client_prefs.plist':
+            shutil.copy(os.path.join(SOURCE_DIR,file_name),mes_dir)
+    config_dict = plistlib.readPlist(os.path.join(SOURCE_DIR,'configuration.plist'))
+    config_dict['ServerApp']['port'] = given_port
+    config_dict['ServerApp']['debug_mode'] = False
+    config_dict['ServerApp']['temp_dir'] = os.path.join(mes_dir,'tmp')
+    config_dict['ServerApp']['log_path'] = os.path.join(mes_dir,'mes.log')
+    config_dict['ServerApp']['workers'] = 2
+    config_dict['MunkiManifests']['repo_path'] = os.path.join(given_scratch_dir,'repo')
+    config_dict['MunkiManifests']['default_group_manifest'] = group_name(0)
+    config_dict['CertificateAuthority']['private_key_path'] = given_key_path
+    config_dict['CertificateAuthority']['cert_path'] = given_cert_path
+    config_dict['CertificateAuthority']['private_key_passphrase'] = CA_PASSPHRASE
+    config_dict['CertificateAuthority']['ledger_path'] = os.path.join(mes_dir,'ledger.sqlite')
+    plistlib.writePlist(config_dict,os.path.join(mes_dir,'configuration.plist'))
+    os.makedirs(os.path.join(mes_dir,'tmp'))
+    return mes_dir
+
+class FrontEnd(object):
+    '''Starts one of the MES entry points on a local port.'''
+    def __init__(self,given_mes_dir,given_script_name,given_port):
+        self.name = given_script_name
+        self.port = given_port
+        self.log_path = os.path.join(given_mes_dir,'mes.log')
+        self.process = subprocess.Popen([sys.executable,os.path.join(given_mes_dir,given_script_name)],cwd=given_mes_dir,stdout=open(os.devnull,'w'),stderr=subprocess.STDOUT)
+        deadline = time.time() + 60
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError("%(name)s exited with status %(status)s." % {'name':self.name,'status':self.process.returncode})
+            try:
+                socket.create_connection(('127.0.0.1',given_port),1).close()
+                return
+            except socket.error:
+                time.sleep(0.2)
+        self.stop()
+        raise RuntimeError("%(name)s did not start listening on port %(port)s." % {'name':self.name,'port':given_port})
+
+    def send(self,given_method,given_path,given_body,given_headers_dict):
+        '''Returns (status, body).'''
+        connection = httplib.HTTPConnection('127.0.0.1',self.port,timeout=300)
+        try:
+            connection.request(given_method,given_path,given_body,given_headers_dict)
+            response = connection.getresponse()
+            return response.status,response.read()
+        finally:
+            connection.close()
+
+    def stop(self):
+        if self.process.poll() is None:
+            self.process.send_signal(signal.SIGTERM)
+            self.process.wait()
+
+#PRAGMA MARK: REQUESTS
+
+def form_request(given_form_dict):
+    '''Returns (method, path, body, headers) for a POST to /enroll.'''
+    return 'POST','/enroll',urllib.urlencode(given_form_dict),{'Content-Type':'application/x-www-form-urlencoded'}
+
+def make_cases(given_identity,given_hash_algorithm):
+    '''Returns a list of (name, request) pairs to send to both servers.'''
+    cases = []
+    transaction_b_dict = {'group_manifest_name':group_name(1),'desired_computer_name':'CONFORMANCE-B'}
+    cases.append(('transaction-a',form_request(given_identity.signed_form('transaction-a',SERIAL,given_hash_algorithm))))
+    cases.append(('transaction-b',form_request(given_identity.signed_form('transaction-b',plistlib.writePlistToString(transaction_b_dict),given_hash_algorithm))))
+    cases.append(('transaction-b unknown group',form_request(given_identity.signed_form('transaction-b',plistlib.writePlistToString({'group_manifest_name':'no-such-group'}),given_hash_algorithm))))
+    cases.append(('transaction-b not a plist',form_request(given_identity.signed_form('transaction-b','not a plist',given_hash_algorithm))))
+    cases.append(('set-name',form_request(given_identity.signed_form('set-name','CONFORMANCE-SET',given_hash_algorithm))))
+    cases.append(('unknown command',form_request(given_identity.signed_form('no-such-command',SERIAL,given_hash_algorithm))))
+    cases.append(('no command',form_request({'message':SERIAL})))
+    signed_form_dict = given_identity.signed_form('transaction-a',SERIAL,given_hash_algorithm)
+    for field_name in ['message','signature','certificate']:
+        form_dict = dict(signed_form_dict)
+        del form_dict[field_name]
+        cases.append(('transaction-a without %s' % field_name,form_request(form_dict)))
+    form_dict = dict(signed_form_dict)
+    form_dict['message'] = 'C02CNF999999'
+    cases.append(('transaction-a bad signature',form_request(form_dict)))
+    form_dict = dict(signed_form_dict)
+    form_dict['signature'] = 'not base64!'
+    cases.append(('transaction-a signature not base64',form_request(form_dict)))
+    form_dict = dict(signed_form_dict)
+    form_dict['certificate'] = 'not a certificate'
+    cases.append(('transaction-a bad certificate',form_request(form_dict)))
+    cases.append(('transaction-a foreign certificate',form_request(foreign_signed_form('transaction-a',SERIAL,given_hash_algorithm))))
+    cases.append(('request-enrollment bad response mode',form_request({'command':'request-enrollment','message':SERIAL,'response_mode':'no-such-mode'})))
+    cases.append(('body not a form',('POST','/enroll','\x00\xffnot a form',{'Content-Type':'application/octet-stream'})))
+    cases.append(('GET /enroll',('GET','/enroll',None,{})))
+    cases.append(('unknown path',('POST','/no-such-path',urllib.urlencode({'command':'transaction-a'}),{'Content-Type':'application/x-www-form-urlencoded'})))
+    return cases
+
+def foreign_signed_form(given_command,given_message,given_hash_algorithm):
+    '''Returns the POST variables for a command correctly signed by a
+        self-signed certificate that our CA did not issue.'''
+    key = crypto.PKey()
+    key.generate_key(crypto.TYPE_RSA,2048)
+    cert = crypto.X509()
+    cert.get_subject().CN = SERIAL
+    cert.set_serial_number(1)
+    cert.gmtime_adj_notBefore(0)
+    cert.gmtime_adj_notAfter(24*3600)
+    cert.set_issuer(cert.get_subject())
+    cert.set_pubkey(key)
+    cert.sign(key,'sha256')
+    form_dict = {}
+    form_dict['command'] = given_command
+    form_dict['message'] = given_message
+    form_dict['signature'] = base64.b64encode(crypto.sign(key,given_message,given_hash_algorithm))
+    form_dict['certificate'] = crypto.dump_certificate(crypto.FILETYPE_PEM,cert)
+    return form_dict
+
+#PRAGMA MARK: REPOSITORY STATE
+
+def read_computer_manifests(given_repo_dir):
+    '''Returns a dict of path: contents for the files holding the test
+        client's computer manifest.'''
+    manifest_dict = {}
+    for dir_path,dir_names,file_names in os.walk(os.path.join(given_repo_dir,'manifests','computers')):
+        for file_name in file_names:
+            file_path = os.path.join(dir_path,file_name)
+            if file_name == SERIAL and not os.path.islink(file_path):
+                with open(file_path,'r') as file_object:
+                    manifest_dict[file_path] = file_object.read()
+    return manifest_dict
+
+def restore_computer_manifests(given_manifest_dict):
+    '''Writes back what read_computer_manifests returned.'''
+    for file_path in given_manifest_dict:
+        with open(file_path,'w') as file_object:
+            file_object.write(given_manifest_dict[file_path])
+
+#PRAGMA MARK: MAIN
+
+def describe_body(given_body):
+    '''Returns the start of a response body for printing.'''
+    if len(given_body) > 200:
+        return repr(given_body[:200]) + '...'
+    return repr(given_body)
+
+def main():
+    keep_scratch_dir = '--keep' in sys.argv[1:]
+    scratch_dir = tempfile.mkdtemp(prefix='mes-conformance-')
+    front_ends = []
+    differences = 0
+    try:
+        print "Setting up in %s..." % scratch_dir
+        repo_dir = os.path.join(scratch_dir,'repo')
+        make_repo(repo_dir,3,10,random.Random(1))
+        key_path,cert_path = make_ca(scratch_dir)
+        for script_name in FRONT_ENDS:
+            port = free_port()
+            mes_dir = stage_front_end(scratch_dir,script_name.split('.')[0],port,key_path,cert_path)
+            front_ends.append(FrontEnd(mes_dir,script_name,port))
+        hash_algorithm = plistlib.readPlist(os.path.join(SOURCE_DIR,'configuration.plist'))['ClientCertificate']['csr_signing_hash_algorithm']
+        status,body = front_ends[0].send(*form_request({'command':'request-enrollment','message':SERIAL}))
+        if status != 200:
+            print "Could not enroll client %(serial)s (HTTP %(status)s); see %(log)s." % {'serial':SERIAL,'status':status,'log':front_ends[0].log_path}
+            return 1
+        identity = Identity(SERIAL,base64.b64decode(body))
+        manifest_dict = read_computer_manifests(repo_dir)
+        for case_name,case_request in make_cases(identity,hash_algorithm):
+            responses = []
+            for front_end in front_ends:
+                restore_computer_manifests(manifest_dict)
+                responses.append(front_end.send(*case_request))
+            if responses[0] == responses[1]:
+                print "same:      %(case)s (HTTP %(status)s)" % {'case':case_name,'status':responses[0][0]}
+                continue
+            differences += 1
+            print "DIFFERENT: %s" % case_name
+            for front_end,response in zip(front_ends,responses):
+                print "  %(name)s: HTTP %(status)s, %(body)s" % {'name':front_end.name,'status':response[0],'body':describe_body(response[1])}
+    finally:
+        for front_end in front_ends:
+            front_end.stop()
+        if not keep_scratch_dir:
+            shutil.rmtree(scratch_dir,True)
+    if differences:
+        print "%s requests got different responses." % differences
+        return 1
+    print "All requests got the same responses."
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+# logging_benchmark.py
+# Munki Enrollment Server
+# Measures what logging costs the thread handling a request: formatting of
+# filtered lines, and writing to a slow log with and without the queue.
+
+# Written by Gerrit DeWitt (gdewitt@gsu.edu)
+# Project started 2015-06-15.  This file created 2026-10-18.
+# Copyright Georgia State University.
+# This script uses publicly-documented methods known to those skilled in the art.
+# References: See top level Read Me.
+
+# Usage: python logging_benchmark.py [iterations] [stall ms]
+# The slow log is a stream that sleeps for the given time (default 1 ms) on
+# each write, as a busy disk or syslog daemon would.
+
+import os, sys, time, logging
+# Load MES modules from the source directory:
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.realpath(__file__)),'..','src-mes'))
+import common
+
+class SlowStream(object):
+    '''File-like object that discards what is written after a delay.'''
+    def __init__(self,given_stall):
+        self.stall = given_stall
+        self.lines = 0
+
+    def write(self,given_data):
+        time.sleep(self.stall)
+        self.lines += 1
+
+    def flush(self):
+        pass
+
+def time_us(given_label,given_iterations,given_function):
+    '''Runs the function and prints the mean time per call in microseconds.'''
+    start = time.time()
+    for i in xrange(given_iterations):
+        given_function(i)
+    elapsed = time.time() - start
+    print '%(label)-44s %(us)10.3f us/call' % {'label':given_label,'us':elapsed*1000000.0/given_iterations}
+
+def main():
+    iterations = 2000
+    stall = 0.001
+    if len(sys.argv) > 1:
+        iterations = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        stall = float(sys.argv[2])/1000.0
+    serial = 'C02BENCH0001'
+    timings = {'keygen':0.8124,'sign':0.0031}
+    root_logger = logging.getLogger()
+    # (With no handler at all, logging would add one writing to stderr.)
+    root_logger.handlers = [logging.NullHandler()]
+    # Info lines filtered out by the log level:
+    root_logger.setLevel(logging.ERROR)
+    print "Filtered info line (%s iterations):" % (iterations*50)
+    time_us("formatted before the call",iterations*50,lambda i: common.logging_info("Enrollment timings for %(serial)s: %(timings)s" % {'serial':serial,'timings':timings}))
+    time_us("arguments formatted by logging",iterations*50,lambda i: common.logging_info("Enrollment timings for %(serial)s: %(timings)s",{'serial':serial,'timings':timings}))
+    # Written to a slow log, by the calling thread or by the writer thread:
+    root_logger.setLevel(logging.INFO)
+    print "Written to a log that stalls %.1f ms per line (%s iterations):" % (stall*1000.0,iterations)
+    slow_stream = SlowStream(stall)
+    handler = logging.StreamHandler(slow_stream)
+    root_logger.handlers = [handler]
+    time_us("written by the caller",iterations,lambda i: common.logging_info("Enrollment timings for %(serial)s: %(timings)s",{'serial':serial,'timings':timings}))
+    common.config_app.LOG_QUEUE_SIZE = iterations*2
+    common.configure_logging()
+    common.LOG_TARGET_HANDLER.stream = SlowStream(stall)
+    time_us("queued for the writer thread",iterations,lambda i: common.logging_info("Enrollment timings for %(serial)s: %(timings)s",{'serial':serial,'timings':timings}))
+    start = time.time()
+    common.stop_log_writer()
+    print "Writer thread finished the queue %(seconds).2f s later; %(written)s written, %(dropped)s dropped." % {'seconds':time.time() - start,'written':common.LOG_RECORDS_WRITTEN,'dropped':common.LOG_RECORDS_DROPPED}
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+
+# metrics_overhead_benchmark.py
+# Munki Enrollment Server
+# Measures what the metrics layer adds to each timed block, with metrics
+# disabled and enabled, and the cost of a /metrics scrape.
+
+# Written by Gerrit DeWitt (gdewitt@gsu.edu)
+# Project started 2015-06-15.  This file created 2026-10-18.
+# Copyright Georgia State University.
+# This script uses publicly-documented methods known to those skilled in the art.
+# References: See top level Read Me.
+
+# Usage: python metrics_overhead_benchmark.py [iterations]
+# Snapshots are written to a temporary directory; the configured temp_dir
+# is not used.
+
+import os, sys, time, shutil, tempfile
+# Load MES modules from the source directory:
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.realpath(__file__)),'..','src-mes'))
+import metrics
+
+LABELS = (('stage','keygen'),)
+
+def time_us(given_label,given_iterations,given_function):
+    '''Runs the function and prints the mean time per call in microseconds.'''
+    start = time.time()
+    for i in xrange(given_iterations):
+        given_function()
+    elapsed = time.time() - start
+    print '%(label)-40s %(us)9.3f us/call' % {'label':given_label,'us':elapsed*1000000.0/given_iterations}
+
+def bare_block():
+    pass
+
+def timed_block():
+    with metrics.timer('mes_enrollment_stage_seconds',LABELS):
+        pass
+
+def observed_value():
+    metrics.observe('mes_enrollment_stage_seconds',LABELS,0.01)
+
+def main():
+    iterations = 200000
+    if len(sys.argv) > 1:
+        iterations = int(sys.argv[1])
+    temp_dir = tempfile.mkdtemp()
+    metrics.config_app.TEMP_DIR = temp_dir
+    try:
+        print "Per timed block (%s iterations):" % iterations
+        time_us("no instrumentation",iterations,bare_block)
+        metrics.config_app.METRICS_ENABLED = False
+        time_us("timer, metrics disabled",iterations,timed_block)
+        time_us("observe, metrics disabled",iterations,observed_value)
+        metrics.config_app.METRICS_ENABLED = True
+        time_us("timer, metrics enabled",iterations,timed_block)
+        time_us("observe, metrics enabled",iterations,observed_value)
+        # A scrape with the series an enrollment server has after some use:
+        for stage_name in ['reenroll_cache','manifest','ledger','crypto','keygen','csr','ca_payload','sign','pem','mobileconfig','tar']:
+            metrics.observe('mes_enrollment_stage_seconds',(('stage',stage_name),),0.01)
+        scrape_iterations = max(1,iterations//1000)
+        print "Per scrape (%s iterations):" % scrape_iterations
+        time_us("write snapshot",scrape_iterations,lambda: metrics.write_snapshot(True))
+        time_us("render /metrics",scrape_iterations,metrics.render)
+    finally:
+        metrics.config_app.METRICS_ENABLED = False
+        shutil.rmtree(temp_dir)
+
+if __name__ == "__main__":
+    main()
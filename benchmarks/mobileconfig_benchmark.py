@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+
+# mobileconfig_benchmark.py
+# Munki Enrollment Server
+# Checks that profiles rendered from the compiled template match profiles
+# written in full by plistlib, and compares their cost.
+
+# Written by Gerrit DeWitt (gdewitt@gsu.edu)
+# Project started 2015-06-15.  This file created 2026-10-18.
+# Copyright Georgia State University.
+# This script uses publicly-documented methods known to those skilled in the art.
+# References: See top level Read Me.
+
+# Usage: python mobileconfig_benchmark.py [iterations]
+# Reads the Munki client prefs from the configuration; exits with status 1
+# if any rendered profile differs from the plistlib output.
+
+import os, sys, plistlib
+# Load MES modules from the source directory:
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.realpath(__file__)),'..','src-mes'))
+import mobileconfig
+from ca_payload_benchmark import time_it
+
+def make_cases():
+    '''Returns per-client value dicts covering both templates, CA names
+        that need escaping, CA payloads of several sizes, and values with
+        control characters, which neither may write.'''
+    cases = []
+    for ca_cert_cn in ["MES CA","R&D <Lab> CA","MES\x01CA"]:
+        for password in ["C02CASE0001",None]:
+            for data_size in [0,1,57,58,2500]:
+                cases.append(mobileconfig.make_values_dict('c02case0001',os.urandom(data_size),ca_cert_cn,password))
+    # A serial that cannot be written, as a client could send it:
+    cases.append(mobileconfig.make_values_dict('c02case\x010001',os.urandom(57),"MES CA","C02CASE0001"))
+    return cases
+
+def main():
+    iterations = 2000
+    if len(sys.argv) > 1:
+        iterations = int(sys.argv[1])
+    mismatches = 0
+    for values_dict in make_cases():
+        rendered = mobileconfig.render(values_dict)
+        written = mobileconfig.write_plist(values_dict)
+        if rendered != written or (rendered and plistlib.readPlistFromString(rendered) != plistlib.readPlistFromString(written)):
+            mismatches += 1
+            print "MISMATCH: CN %(cn)r, password %(password)r, %(size)s bytes" % {'cn':values_dict['ca_cert_cn'],'password':values_dict['ca_payload_password'],'size':len(values_dict['ca_payload_data'])}
+    print "Compared %(count)s profiles: %(mismatches)s mismatches." % {'count':len(make_cases()),'mismatches':mismatches}
+    values_dict = mobileconfig.make_values_dict('c02bench0001',os.urandom(2500),"MES CA","C02BENCH0001")
+    print "Configuration profile (%s iterations):" % iterations
+    time_it("plistlib (whole profile)",iterations,lambda i: mobileconfig.write_plist(values_dict))
+    time_it("compiled template",iterations,lambda i: mobileconfig.render(values_dict))
+    if mismatches:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -41,7 +41,7 @@ declare -x PYPY_PAGE_URL="https://github.com/squeaky-pl/portable-pypy#portable-p
 declare -x PYPY_HREF_LABEL="PyPy\s\d*.*\sx86_64" # Example: PyPy 5.3.3 x86_64
 
 # Dependencies:
-declare -a MES_DEPENDENCIES=("pyasn1" "idna" "enum34" "ipaddress" "six" "cryptography" "pyOpenSSL" "itsdangerous" "MarkupSafe" "Jinja2" "Werkzeug" "Flask")
+declare -a MES_DEPENDENCIES=("pyasn1" "idna" "enum34" "ipaddress" "six" "cryptography" "pyOpenSSL" "itsdangerous" "MarkupSafe" "Jinja2" "Werkzeug" "Flask" "gunicorn")
 
 # MARK: pre_cleanup()
 # Sets up environment.
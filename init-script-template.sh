@@ -5,7 +5,7 @@
 # Munki Enrollment Server (MES) Init Script.
 # gdewitt@gsu.edu, 2015-06-15, 2015-06-15, 2016-03-04, 2016-03-14, 2016-04-25, 2016-07-06, 2016-08-02, 2016-08-09 (NetBoot Server Container)
 # 2016-09-19, 2016-10-18, 2016-10-25.
-# 2017-02-08
+# 2017-02-08, 2026-10-18
 # to do: modify this script to work on distros besides RHEL
 
 # References: See top level Read Me.
@@ -29,8 +29,9 @@ declare -x SERVER_HOSTNAME="$(hostname)"
 declare -i CAN_START=0
 
 # MES:
-declare -x PYTHON_FILE_MES="$CONTAINER_DIR/__%MES_VENV_DIR_BASENAME%__/mes/server.py"
-declare -x CMD_MES=(su "$MES_RUN_AS_USER_NAME" -p -c '"$CONTAINER_DIR/__%MES_VENV_DIR_BASENAME%__/bin/pypy" "$PYTHON_FILE_MES" > /dev/null 2>&1')
+declare -x PYTHON_FILE_MES="$CONTAINER_DIR/__%MES_VENV_DIR_BASENAME%__/mes/wsgi_server.py"
+declare -x PID_FILE_MES="$CONTAINER_DIR/mes.pid"
+declare -x CMD_MES=(su "$MES_RUN_AS_USER_NAME" -p -c '"$CONTAINER_DIR/__%MES_VENV_DIR_BASENAME%__/bin/pypy" "$PYTHON_FILE_MES" "$PID_FILE_MES" > /dev/null 2>&1')
 declare -a CONF_FILE_MES="$CONTAINER_DIR/__%MES_VENV_DIR_BASENAME%__/mes/configuration.plist"
 declare -a CONF_FILE_MUNKI_CLIENT="$CONTAINER_DIR/__%MES_VENV_DIR_BASENAME%__/mes/munki_client_prefs.plist"
 declare -a APP_FILES_ARRAY=("$PYTHON_FILE_MES" "$CONF_FILE_MES" "$CONF_FILE_MUNKI_CLIENT")
@@ -118,12 +119,26 @@ function stop() {
     echo "$APP_DISPLAY_NAME stopped."
 }
 
-# MARK: reload()
-function reload() {
-    echo "Reloading $APP_DISPLAY_NAME..."
+# MARK: restart()
+function restart() {
+    echo "Restarting $APP_DISPLAY_NAME..."
     stop
     sleep 5
     start
+    echo "$APP_DISPLAY_NAME restarted."
+}
+
+# MARK: reload()
+function reload() {
+    # Graceful reload: the MES master process replaces its workers without
+    # dropping requests.  Falls back to a restart if the MES is not running.
+    echo "Reloading $APP_DISPLAY_NAME..."
+    if [ -f "$PID_FILE_MES" ] && kill -HUP "$(cat "$PID_FILE_MES")" > /dev/null 2>&1; then
+        echo "   Sent HUP to MES master process $(cat "$PID_FILE_MES")."
+    else
+        echo "   MES is not running; restarting instead."
+        restart
+    fi
     echo "$APP_DISPLAY_NAME reloaded."
 }
 
@@ -210,7 +225,7 @@ function uninstall() {
 
 # MARK: help()
 function help() {
-    echo "Usage: $0 [start|stop|reload|install|uninstall]"
+    echo "Usage: $0 [start|stop|reload|restart|install|uninstall]"
 }
 
 case "$1" in
@@ -224,7 +239,7 @@ case "$1" in
         reload
         ;;
     restart)
-        reload
+        restart
         ;;
     install)
         install
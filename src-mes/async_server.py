@@ -0,0 +1,350 @@
+#!/usr/bin/env python
+
+# async_server.py
+# Munki Enrollment Server
+# Alternative entry point: an event-driven HTTP front end that holds many idle
+# or slow client connections in one process and runs the Flask app from
+# server.py in a bounded pool of threads.
+
+# Written by Gerrit DeWitt (gdewitt@gsu.edu)
+# Project started 2015-06-15.  This file created 2026-10-18.
+# Copyright Georgia State University.
+# This script uses publicly-documented methods known to those skilled in the art.
+# References: See top level Read Me.
+
+# Usage: async_server.py
+# Connections are read and written by one asyncore loop, so a client that is
+# slow to send its request or to read its response costs a socket and a buffer
+# rather than a thread.  Only complete requests are handed to the thread pool,
+# where the same WSGI app as the other entry points produces the response.
+# Enrollment crypto runs in the crypto pool; set crypto_pool_workers when
+# using this entry point.
+
+import os, sys, time, errno, signal, socket, asyncore, Queue
+from cStringIO import StringIO
+from email.utils import formatdate
+from multiprocessing.pool import ThreadPool
+from werkzeug.http import HTTP_STATUS_CODES
+# Load our modules:
+import common
+# Import configuration:
+import configuration_classes as config
+config_server_app = config.ServerApp()
+
+# Limits on what a client may send:
+MAX_HEADER_BYTES = 65536
+MAX_BODY_BYTES = 1048576
+READ_SIZE = 65536
+
+# Channels and listener for the loop:
+SOCKET_MAP = {}
+# Responses finished by the thread pool, waiting to be queued on their channel:
+FINISHED_RESPONSES = Queue.Queue()
+# Set by SIGTERM/SIGINT to leave the loop:
+SHUTDOWN_REQUESTED = False
+
+def make_simple_response(given_status_code,given_close=True):
+    '''Returns the bytes of a plain text error response.'''
+    body = "%s\n" % HTTP_STATUS_CODES.get(given_status_code,"Error")
+    header_lines = ["HTTP/1.1 %(code)s %(reason)s" % {'code':given_status_code,'reason':HTTP_STATUS_CODES.get(given_status_code,"Error")}]
+    header_lines.append("Date: %s" % formatdate(usegmt=True))
+    header_lines.append("Content-Type: text/plain")
+    header_lines.append("Content-Length: %s" % len(body))
+    if given_close:
+        header_lines.append("Connection: close")
+    return "\r\n".join(header_lines) + "\r\n\r\n" + body
+
+#PRAGMA MARK: WSGI
+
+def make_environ(given_channel,given_method,given_target,given_version,given_headers_dict,given_body):
+    '''Returns the WSGI environ dict for a parsed request.'''
+    path,question_mark,query_string = given_target.partition('?')
+    environ = {}
+    environ['REQUEST_METHOD'] = given_method
+    environ['SCRIPT_NAME'] = ''
+    environ['PATH_INFO'] = path
+    environ['QUERY_STRING'] = query_string
+    environ['SERVER_NAME'] = given_channel.server_name
+    environ['SERVER_PORT'] = str(given_channel.server_port)
+    environ['SERVER_PROTOCOL'] = given_version
+    environ['REMOTE_ADDR'] = given_channel.client_address
+    environ['CONTENT_TYPE'] = given_headers_dict.pop('content-type','')
+    environ['CONTENT_LENGTH'] = str(len(given_body))
+    given_headers_dict.pop('content-length',None)
+    for header_name in given_headers_dict:
+        environ['HTTP_%s' % header_name.upper().replace('-','_')] = given_headers_dict[header_name]
+    environ['wsgi.version'] = (1,0)
+    environ['wsgi.url_scheme'] = 'http'
+    environ['wsgi.input'] = StringIO(given_body)
+    environ['wsgi.errors'] = sys.stderr
+    environ['wsgi.multithread'] = True
+    environ['wsgi.multiprocess'] = False
+    environ['wsgi.run_once'] = False
+    return environ
+
+def run_wsgi_app(given_app,given_environ,given_keep_alive):
+    '''Runs the WSGI app for one request in a pool thread.
+        Returns (response bytes, keep alive).'''
+    status_and_headers = []
+    body_chunks = []
+    def start_response(given_status,given_headers,given_exc_info=None):
+        status_and_headers[:] = [given_status,given_headers]
+        return body_chunks.append
+    try:
+        result = given_app(given_environ,start_response)
+        try:
+            for chunk in result:
+                body_chunks.append(chunk)
+        finally:
+            if hasattr(result,'close'):
+                result.close()
+    except:
+        common.logging_error("Generic error.  The enrollment server could not complete the request.")
+        return make_simple_response(500),False
+    body = ''.join(body_chunks)
+    status,headers = status_and_headers
+    header_lines = ["HTTP/1.1 %s" % status]
+    header_names = []
+    for header_name,header_value in headers:
+        header_names.append(header_name.lower())
+        header_lines.append("%(name)s: %(value)s" % {'name':header_name,'value':header_value})
+    if 'date' not in header_names:
+        header_lines.append("Date: %s" % formatdate(usegmt=True))
+    if 'content-length' not in header_names:
+        header_lines.append("Content-Length: %s" % len(body))
+    if not given_keep_alive:
+        header_lines.append("Connection: close")
+    elif given_environ['SERVER_PROTOCOL'] == 'HTTP/1.0':
+        header_lines.append("Connection: keep-alive")
+    return "\r\n".join(header_lines) + "\r\n\r\n" + body,given_keep_alive
+
+#PRAGMA MARK: CONNECTIONS
+
+class HTTPChannel(asyncore.dispatcher):
+    '''One client connection.  Reads a request, hands it to the thread pool,
+        and writes the response, one request at a time.'''
+    def __init__(self,given_server,given_socket,given_client_address):
+        asyncore.dispatcher.__init__(self,given_socket,map=SOCKET_MAP)
+        self.server = given_server
+        self.server_name,self.server_port = given_server.address
+        self.client_address = given_client_address[0]
+        self.in_buffer = ''
+        self.out_buffer = ''
+        self.busy = False
+        self.close_when_sent = False
+        self.sent_continue = False
+        self.last_activity = time.time()
+
+    def readable(self):
+        # Stop reading while a request is in the pool or a response is going out:
+        return not self.busy and not self.out_buffer and not self.close_when_sent
+
+    def writable(self):
+        return bool(self.out_buffer)
+
+    def handle_read(self):
+        try:
+            data = self.recv(READ_SIZE)
+        except socket.error:
+            self.close()
+            return
+        if not data:
+            return
+        self.last_activity = time.time()
+        self.in_buffer += data
+        self.parse_request()
+
+    def parse_request(self):
+        '''Hands the buffered request to the thread pool once it is complete.'''
+        header_end = self.in_buffer.find("\r\n\r\n")
+        if header_end < 0:
+            if len(self.in_buffer) > MAX_HEADER_BYTES:
+                self.send_error(431)
+            return
+        header_lines = self.in_buffer[:header_end].split("\r\n")
+        try:
+            method,target,version = header_lines[0].split(" ")
+        except ValueError:
+            self.send_error(400)
+            return
+        headers_dict = {}
+        for line in header_lines[1:]:
+            name,colon,value = line.partition(":")
+            if not colon:
+                self.send_error(400)
+                return
+            name = name.strip().lower()
+            if name in headers_dict:
+                headers_dict[name] += ", %s" % value.strip()
+            else:
+                headers_dict[name] = value.strip()
+        if 'chunked' in headers_dict.get('transfer-encoding','').lower():
+            self.send_error(411)
+            return
+        try:
+            content_length = int(headers_dict.get('content-length','0'))
+        except ValueError:
+            self.send_error(400)
+            return
+        if content_length < 0 or content_length > MAX_BODY_BYTES:
+            self.send_error(413)
+            return
+        body_start = header_end + 4
+        if len(self.in_buffer) - body_start < content_length:
+            # Clients such as curl wait for this before sending a large body:
+            if headers_dict.get('expect','').lower() == '100-continue' and not self.sent_continue:
+                self.sent_continue = True
+                self.out_buffer += "HTTP/1.1 100 Continue\r\n\r\n"
+            return
+        body = self.in_buffer[body_start:body_start+content_length]
+        self.in_buffer = self.in_buffer[body_start+content_length:]
+        self.sent_continue = False
+        connection = headers_dict.get('connection','').lower()
+        if version == 'HTTP/1.0':
+            keep_alive = connection == 'keep-alive'
+        else:
+            keep_alive = connection != 'close'
+        environ = make_environ(self,method,target,version,headers_dict,body)
+        self.busy = True
+        self.server.submit(self,environ,keep_alive)
+
+    def send_error(self,given_status_code):
+        '''Queues an error response and closes the connection once it is sent.'''
+        self.out_buffer += make_simple_response(given_status_code)
+        self.in_buffer = ''
+        self.close_when_sent = True
+
+    def finish_response(self,given_response,given_keep_alive):
+        '''Called in the loop thread when the pool has produced a response.'''
+        self.busy = False
+        self.last_activity = time.time()
+        self.out_buffer += given_response
+        if not given_keep_alive:
+            self.close_when_sent = True
+
+    def handle_write(self):
+        try:
+            sent = self.send(self.out_buffer)
+        except socket.error:
+            self.close()
+            return
+        self.out_buffer = self.out_buffer[sent:]
+        self.last_activity = time.time()
+        if not self.out_buffer:
+            if self.close_when_sent:
+                self.close()
+            elif self.in_buffer:
+                # A pipelined request arrived with the previous one:
+                self.parse_request()
+
+    def handle_close(self):
+        self.close()
+
+    def handle_error(self):
+        common.logging_error("Closing client connection after an error: %s" % str(sys.exc_info()[1]))
+        self.close()
+
+class ResponseTrigger(asyncore.file_dispatcher):
+    '''Wakes the loop when pool threads finish responses.'''
+    def __init__(self):
+        self.read_fd,self.write_fd = os.pipe()
+        asyncore.file_dispatcher.__init__(self,self.read_fd,map=SOCKET_MAP)
+
+    def pull(self):
+        '''Called from any thread; makes the loop call handle_read.'''
+        try:
+            os.write(self.write_fd,'x')
+        except OSError:
+            pass
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        try:
+            self.recv(4096)
+        except (OSError,socket.error):
+            pass
+        while True:
+            try:
+                channel,response,keep_alive = FINISHED_RESPONSES.get_nowait()
+            except Queue.Empty:
+                break
+            if channel.connected:
+                channel.finish_response(response,keep_alive)
+
+class EnrollmentServer(asyncore.dispatcher):
+    '''Listening socket.  Accepts connections and owns the thread pool.'''
+    def __init__(self,given_app,given_host,given_port):
+        asyncore.dispatcher.__init__(self,map=SOCKET_MAP)
+        self.app = given_app
+        self.create_socket(socket.AF_INET,socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((given_host,given_port))
+        self.address = self.socket.getsockname()
+        self.listen(1024)
+        self.trigger = ResponseTrigger()
+        self.thread_pool = ThreadPool(config_server_app.ASYNC_THREADS)
+
+    def handle_accept(self):
+        try:
+            accepted = self.accept()
+        except socket.error as e:
+            if e.args[0] in (errno.EMFILE,errno.ENFILE):
+                common.logging_error("Out of file descriptors; raise the open files limit for the MES account.")
+            return
+        if accepted:
+            HTTPChannel(self,accepted[0],accepted[1])
+
+    def submit(self,given_channel,given_environ,given_keep_alive):
+        '''Runs the app for a complete request in the thread pool.'''
+        def callback(given_result):
+            FINISHED_RESPONSES.put((given_channel,given_result[0],given_result[1]))
+            self.trigger.pull()
+        self.thread_pool.apply_async(run_wsgi_app,(self.app,given_environ,given_keep_alive),callback=callback)
+
+    def close_idle_channels(self):
+        '''Closes connections that have been idle longer than async_idle_timeout.'''
+        cutoff = time.time() - config_server_app.ASYNC_IDLE_TIMEOUT
+        for channel in SOCKET_MAP.values():
+            if isinstance(channel,HTTPChannel) and not channel.busy and channel.last_activity < cutoff:
+                channel.close()
+
+    def handle_error(self):
+        common.logging_error("Error accepting a connection: %s" % str(sys.exc_info()[1]))
+
+def handle_shutdown(signum,frame):
+    '''Signal handler for SIGTERM and SIGINT: leave the loop.'''
+    global SHUTDOWN_REQUESTED
+    SHUTDOWN_REQUESTED = True
+
+def serve(given_server):
+    '''Runs the loop until shutdown is requested.'''
+    while not SHUTDOWN_REQUESTED:
+        asyncore.loop(timeout=1.0,use_poll=True,map=SOCKET_MAP,count=1)
+        given_server.close_idle_channels()
+    given_server.close()
+    given_server.thread_pool.close()
+    given_server.thread_pool.join()
+
+# Launch:
+if __name__ == "__main__":
+    import server
+    import key_pool
+    import crypto_pool
+    signal.signal(signal.SIGHUP,server.handle_sighup)
+    signal.signal(signal.SIGTERM,handle_shutdown)
+    signal.signal(signal.SIGINT,handle_shutdown)
+    key_pool.start()
+    crypto_pool.start()
+    server.preload()
+    if config_server_app.DEBUG_MODE:
+        print "WARNING: Web app is running in debug mode!"
+        host = "0.0.0.0"
+    else:
+        host = "127.0.0.1"
+    enrollment_server = EnrollmentServer(server.app,host,config_server_app.PORT)
+    common.logging_info("Event-driven MES listening on %(host)s:%(port)s with %(threads)s threads." % {'host':host,'port':config_server_app.PORT,'threads':config_server_app.ASYNC_THREADS})
+    serve(enrollment_server)
+    crypto_pool.stop()
+    key_pool.stop()
@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+
+# batch_enroll.py
+# Munki Enrollment Server
+# Enrolls a list of computers at once, ahead of their first boot.
+
+# Written by Gerrit DeWitt (gdewitt@gsu.edu)
+# Project started 2015-06-15.  This file created 2026-10-18.
+# Copyright Georgia State University.
+# This script uses publicly-documented methods known to those skilled in the art.
+# References: See top level Read Me.
+
+# Usage: batch_enroll.py [--processes N] [--batch-size N] [--archive] [--failures PATH] CSV OUTPUT
+#
+# CSV has one computer per line: serial[,group[,computer_name]].  A first
+# line starting with "serial" is taken as a header; blank lines and lines
+# starting with # are skipped.
+#
+# Each computer gets its manifest (created as for request-enrollment, then
+# added to the group and named if those are given) and the archive the
+# client would receive from request-enrollment.  Archives are written to
+# the OUTPUT directory as SERIAL.tar (SERIAL.tar.gz with tar_gzip), or with
+# --archive into the single tar file OUTPUT, one member per computer.  They
+# hold private keys, so only the MES account can read them.
+#
+# Computers are handled in batches by --processes processes (default: one
+# per CPU).  Each process syncs the manifests directory once per batch rather
+# than after each manifest.  A computer that fails is reported, with the
+# reason, and does not stop the others; --failures writes those lines to a
+# CSV that can be given back to batch_enroll.py.  Run as the MES account,
+# with the same configuration as the MES.
+
+import os, sys, csv, time, signal, tarfile, argparse, multiprocessing
+from cStringIO import StringIO
+# Load our modules:
+import common
+import devices
+import ca_cache
+import security
+import mobileconfig
+import group_index
+import manifests
+import manifest_store
+import enrollment
+import ledger
+# Import configuration:
+import configuration_classes as config
+config_app = config.ServerApp()
+
+# Output files are synced as they are written; their directory is synced
+# after every OUTPUT_SYNC_INTERVAL files and at the end:
+OUTPUT_SYNC_INTERVAL = 500
+
+#PRAGMA MARK: INPUT
+
+def read_rows(given_csv_path):
+    '''Reads the computer list.  Returns a tuple of (array of row dicts with
+        serial, group and computer_name, array of (line number, error) tuples).'''
+    rows_array = []
+    errors_array = []
+    seen_serials = set()
+    with open(given_csv_path,'rU') as file_object:
+        for line_number,fields in enumerate(csv.reader(file_object),1):
+            fields = [field.strip() for field in fields]
+            if not fields or not fields[0] or fields[0].startswith('#'):
+                continue
+            if line_number == 1 and fields[0].lower() == 'serial':
+                continue
+            row_dict = {}
+            row_dict['serial'] = devices.validate_serial_number(fields[0])
+            row_dict['group'] = fields[1] if len(fields) > 1 else ''
+            row_dict['computer_name'] = fields[2] if len(fields) > 2 else ''
+            if not row_dict['serial']:
+                errors_array.append((line_number,"invalid serial %s" % fields[0]))
+            elif row_dict['serial'] in seen_serials:
+                errors_array.append((line_number,"%s listed more than once" % row_dict['serial']))
+            else:
+                seen_serials.add(row_dict['serial'])
+                rows_array.append(row_dict)
+    return rows_array,errors_array
+
+def check_groups(given_rows_array):
+    '''Returns a dict of serial -> error for rows naming a group that is not
+        in the repository, so that they fail before a certificate is issued.'''
+    group_names = set([group_dict['name'] for group_dict in group_index.list_groups()])
+    errors_dict = {}
+    for row_dict in given_rows_array:
+        if row_dict['group'] and row_dict['group'] not in group_names:
+            errors_dict[row_dict['serial']] = "group %s not found" % row_dict['group']
+    return errors_dict
+
+#PRAGMA MARK: WORKERS
+
+def worker_initializer():
+    '''Runs in each worker process as it starts.'''
+    # The workers are the parallelism; do not start a crypto pool in each:
+    config_app.CRYPTO_POOL_WORKERS = 0
+    common.log_synchronously()
+    manifest_store.defer_directory_syncs()
+    # Ctrl-C is handled by the parent, which stops the workers:
+    signal.signal(signal.SIGINT,signal.SIG_IGN)
+
+def enroll_row(given_row_dict):
+    '''Enrolls one computer.  Returns a tuple of (tar data, error); one of
+        them is None.'''
+    serial = given_row_dict['serial']
+    # Manifest, identity and profile, as for request-enrollment:
+    tar_data = enrollment.make_enrollment_archive(serial)
+    if not tar_data:
+        return None,"enrollment failed"
+    # Group and name, as transaction-b would set them:
+    metadata_dict = None
+    if given_row_dict['computer_name']:
+        metadata_dict = {'computer_name':given_row_dict['computer_name']}
+    if given_row_dict['group'] or metadata_dict:
+        joined_group,wrote_metadata = manifests.update_computer_manifest(serial,given_row_dict['group'] or None,metadata_dict)
+        if given_row_dict['group'] and not joined_group:
+            return None,"could not add to group %s" % given_row_dict['group']
+        if metadata_dict and not wrote_metadata:
+            return None,"could not record computer name"
+    return tar_data,None
+
+def enroll_batch(given_rows_array):
+    '''Runs in a worker process: enrolls each computer in the batch, then
+        syncs the manifest directories and writes the ledger rows once.
+        Returns an array of (row dict, tar data, error) tuples.'''
+    results_array = []
+    for row_dict in given_rows_array:
+        try:
+            tar_data,error = enroll_row(row_dict)
+        except Exception as e:
+            common.logging_error("Batch enrollment of %(serial)s failed: %(error)r",{'serial':row_dict['serial'],'error':e})
+            tar_data,error = None,"error: %r" % e
+        results_array.append((row_dict,tar_data,error))
+    manifest_store.flush_directory_syncs()
+    ledger.flush()
+    return results_array
+
+#PRAGMA MARK: OUTPUT
+
+class DirectoryOutput(object):
+    '''Writes each archive to its own file in a directory.'''
+    def __init__(self,given_dir_path):
+        self.dir_path = given_dir_path
+        if not os.path.isdir(given_dir_path):
+            os.makedirs(given_dir_path,0700)
+        self.unsynced_count = 0
+
+    def add(self,given_file_name,given_data):
+        path = os.path.join(self.dir_path,given_file_name)
+        temp_path = "%(path)s.%(pid)s" % {'path':path,'pid':os.getpid()}
+        fd = os.open(temp_path,os.O_WRONLY|os.O_CREAT|os.O_TRUNC,0600)
+        try:
+            os.write(fd,given_data)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.rename(temp_path,path)
+        self.unsynced_count += 1
+        if self.unsynced_count >= OUTPUT_SYNC_INTERVAL:
+            self.sync()
+
+    def sync(self):
+        manifest_store.sync_directory(self.dir_path)
+        self.unsynced_count = 0
+
+    def close(self):
+        self.sync()
+
+class ArchiveOutput(object):
+    '''Writes every archive as a member of one tar file.  The file appears
+        at its path only once it is complete.'''
+    def __init__(self,given_path):
+        self.path = given_path
+        self.temp_path = "%(path)s.%(pid)s" % {'path':given_path,'pid':os.getpid()}
+        self.file_object = os.fdopen(os.open(self.temp_path,os.O_WRONLY|os.O_CREAT|os.O_TRUNC,0600),'w')
+        self.tar_file = tarfile.open(fileobj=self.file_object,mode='w')
+
+    def add(self,given_file_name,given_data):
+        file_info = tarfile.TarInfo(given_file_name)
+        file_info.size = len(given_data)
+        file_info.mtime = time.time()
+        file_info.mode = 0600
+        self.tar_file.addfile(file_info,StringIO(given_data))
+
+    def close(self):
+        self.tar_file.close()
+        self.file_object.flush()
+        os.fsync(self.file_object.fileno())
+        self.file_object.close()
+        os.rename(self.temp_path,self.path)
+        manifest_store.sync_directory(os.path.dirname(os.path.abspath(self.path)))
+
+def archive_file_name(given_serial):
+    '''Returns the file name for a computer's archive.'''
+    if config_app.TAR_GZIP:
+        return "%s.tar.gz" % given_serial
+    return "%s.tar" % given_serial
+
+def write_failures(given_path,given_failures_array):
+    '''Writes failed rows as a CSV that batch_enroll.py can read again,
+        with the reason in a fourth column.'''
+    with open(given_path,'wb') as file_object:
+        writer = csv.writer(file_object)
+        writer.writerow(['serial','group','computer_name','error'])
+        for row_dict,error in given_failures_array:
+            writer.writerow([row_dict['serial'],row_dict['group'],row_dict['computer_name'],error])
+
+#PRAGMA MARK: MAIN
+
+def parse_arguments(given_arguments):
+    parser = argparse.ArgumentParser(description="Enroll a list of computers at once, writing their manifests and enrollment archives.")
+    parser.add_argument('csv_path',metavar='CSV',help="computers to enroll: serial[,group[,computer_name]] per line")
+    parser.add_argument('output_path',metavar='OUTPUT',help="directory for the archives, or the tar file with --archive")
+    parser.add_argument('--archive',action='store_true',help="write one tar file holding every archive")
+    parser.add_argument('--processes',type=int,default=multiprocessing.cpu_count(),help="worker processes (default: one per CPU)")
+    parser.add_argument('--batch-size',type=int,default=50,help="computers handed to a worker at a time (default 50)")
+    parser.add_argument('--failures',metavar='PATH',help="write the computers that failed to this CSV")
+    return parser.parse_args(given_arguments)
+
+def main(given_arguments):
+    '''Handles the command line; returns the exit status.'''
+    arguments = parse_arguments(given_arguments)
+    common.configure_logging()
+    try:
+        rows_array,input_errors_array = read_rows(arguments.csv_path)
+    except (IOError,csv.Error) as e:
+        print "Could not read %(path)s: %(error)s" % {'path':arguments.csv_path,'error':e}
+        return 1
+    for line_number,error in input_errors_array:
+        print "%(path)s line %(line)s: %(error)s; skipped." % {'path':arguments.csv_path,'line':line_number,'error':error}
+    if not os.path.isdir(config.MunkiManifests().COMPUTER_MANIFESTS_PATH):
+        print "Computer manifests directory not found at %s." % config.MunkiManifests().COMPUTER_MANIFESTS_PATH
+        return 1
+    # Loaded once here and shared with the workers:
+    ca_cache.refresh()
+    if not security.read_ca_cert():
+        print "Could not read the CA certificate."
+        return 1
+    mobileconfig.preload()
+    group_errors_dict = check_groups(rows_array)
+    failures_array = [(row_dict,group_errors_dict[row_dict['serial']]) for row_dict in rows_array if row_dict['serial'] in group_errors_dict]
+    rows_array = [row_dict for row_dict in rows_array if row_dict['serial'] not in group_errors_dict]
+    try:
+        if arguments.archive:
+            output = ArchiveOutput(arguments.output_path)
+        else:
+            output = DirectoryOutput(arguments.output_path)
+    except (IOError,OSError) as e:
+        print "Could not create %(path)s: %(error)s" % {'path':arguments.output_path,'error':e}
+        return 1
+    batch_size = max(1,arguments.batch_size)
+    batches_array = [rows_array[i:i+batch_size] for i in range(0,len(rows_array),batch_size)]
+    common.logging_info("Batch enrollment of %(count)s computers with %(processes)s processes.",{'count':len(rows_array),'processes':arguments.processes})
+    start_time = time.time()
+    enrolled_count = 0
+    pool = multiprocessing.Pool(max(1,arguments.processes),worker_initializer)
+    try:
+        for results_array in pool.imap_unordered(enroll_batch,batches_array):
+            for row_dict,tar_data,error in results_array:
+                if tar_data:
+                    try:
+                        output.add(archive_file_name(row_dict['serial']),tar_data)
+                        enrolled_count += 1
+                        continue
+                    except (IOError,OSError,tarfile.TarError) as e:
+                        error = "could not write archive: %s" % e
+                failures_array.append((row_dict,error))
+            print "%(done)s of %(total)s enrolled, %(failed)s failed, %(seconds).0f s." % {'done':enrolled_count,'total':len(rows_array) + len(group_errors_dict),'failed':len(failures_array),'seconds':time.time() - start_time}
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        print "Interrupted; archives written so far are kept."
+    pool.join()
+    output.close()
+    elapsed = time.time() - start_time
+    for row_dict,error in failures_array:
+        print "%(serial)s: %(error)s" % {'serial':row_dict['serial'],'error':error}
+    if arguments.failures and failures_array:
+        write_failures(arguments.failures,failures_array)
+    summary = "Enrolled %(count)s computers in %(seconds).1f s; %(failed)s failed." % {'count':enrolled_count,'seconds':elapsed,'failed':len(failures_array)}
+    common.logging_info(summary)
+    print summary
+    if failures_array or input_errors_array:
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
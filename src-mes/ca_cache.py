@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+
+# ca_cache.py
+# Munki Enrollment Server
+# Keeps the parsed CA certificate and decrypted CA private key in memory.
+
+# Written by Gerrit DeWitt (gdewitt@gsu.edu)
+# Project started 2015-06-15.  This file created 2026-10-18.
+# Copyright Georgia State University.
+# This script uses publicly-documented methods known to those skilled in the art.
+# References: See top level Read Me.
+
+import os, threading
+from OpenSSL import crypto
+# Load our modules:
+import common
+# Import configuration:
+import configuration_classes as config
+config_ca = config.CertificateAuthority()
+
+# Cached material and the (inode, mtime, size) of the file each came from:
+CA_CERT = None
+CA_CERT_SIGNATURE = None
+CA_KEY = None
+CA_KEY_SIGNATURE = None
+# Incremented whenever either item is reloaded; lets other caches
+# built from the CA material notice that it changed:
+GENERATION = 0
+RELOAD_REQUESTED = False
+# Configuration generation the material was loaded with; the passphrase
+# or paths may have changed since:
+CONFIG_GENERATION = None
+LOCK = threading.Lock()
+
+def file_signature(given_path):
+    '''Returns (inode, mtime, size) for the given path or None if it cannot be read.'''
+    try:
+        s = os.stat(given_path)
+    except OSError:
+        return None
+    return (s.st_ino,s.st_mtime,s.st_size)
+
+def invalidate():
+    '''Asks for the CA material to be reloaded on next use.  Safe to call
+        from a signal handler because it only sets a flag.'''
+    global RELOAD_REQUESTED
+    RELOAD_REQUESTED = True
+
+def refresh():
+    '''Loads the CA certificate and key if they have not been loaded yet,
+        if their files changed, or if a reload was requested.'''
+    global CA_CERT, CA_CERT_SIGNATURE, CA_KEY, CA_KEY_SIGNATURE, GENERATION, RELOAD_REQUESTED, CONFIG_GENERATION
+    with LOCK:
+        if CONFIG_GENERATION != config.GENERATION:
+            if CONFIG_GENERATION is not None:
+                RELOAD_REQUESTED = True
+            CONFIG_GENERATION = config.GENERATION
+        if RELOAD_REQUESTED:
+            common.logging_info("Reloading CA material on request.")
+            CA_CERT_SIGNATURE = None
+            CA_KEY_SIGNATURE = None
+            RELOAD_REQUESTED = False
+        cert_signature = file_signature(config_ca.CA_CERT_FILE_PATH)
+        if cert_signature != CA_CERT_SIGNATURE or not CA_CERT:
+            CA_CERT = load_ca_cert_file()
+            CA_CERT_SIGNATURE = cert_signature
+            GENERATION += 1
+        key_signature = file_signature(config_ca.CA_PRIVATE_KEY_FILE_PATH)
+        if key_signature != CA_KEY_SIGNATURE or not CA_KEY:
+            CA_KEY = load_ca_key_file()
+            CA_KEY_SIGNATURE = key_signature
+            GENERATION += 1
+
+def get_ca_cert():
+    '''Returns the cached CA certificate object or None.'''
+    refresh()
+    return CA_CERT
+
+def get_ca_key():
+    '''Returns the cached, decrypted CA private key object or None.'''
+    refresh()
+    return CA_KEY
+
+#PRAGMA MARK: FILE LOADING
+
+def load_ca_cert_file():
+    '''Loads CA certificate from the filesystem and returns it as an object.
+        Returns None if something went wrong.'''
+    common.logging_info("Loading CA certificate.")
+    # Check for missing CA certificate:
+    if not os.path.exists(config_ca.CA_CERT_FILE_PATH):
+        common.logging_error("No CA certificate file found at %s." % config_ca.CA_CERT_FILE_PATH)
+        return None
+    # Read and load CA certificate:
+    try:
+        file_object = open(config_ca.CA_CERT_FILE_PATH,'r')
+        file_contents = file_object.read()
+        file_object.close()
+    except IOError:
+        return None
+    try:
+        return crypto.load_certificate(crypto.FILETYPE_PEM,file_contents)
+    except crypto.Error:
+        common.logging_error("Could not read CA certificate from %s." % config_ca.CA_CERT_FILE_PATH)
+        return None
+
+def load_ca_key_file():
+    '''Loads and decrypts the CA private key from the filesystem.
+        Returns the key object or None if something went wrong.'''
+    common.logging_info("Loading CA private key.")
+    # Check for missing CA key file:
+    if not os.path.exists(config_ca.CA_PRIVATE_KEY_FILE_PATH):
+        common.logging_error("No CA private key file found at %s." % config_ca.CA_PRIVATE_KEY_FILE_PATH)
+        return None
+    # Read and load CA private key:
+    try:
+        file_object = open(config_ca.CA_PRIVATE_KEY_FILE_PATH,'r')
+        file_contents = file_object.read()
+        file_object.close()
+    except IOError:
+        return None
+    try:
+        return crypto.load_privatekey(crypto.FILETYPE_PEM,file_contents,config_ca.CA_PRIVATE_KEY_PASSPHRASE)
+    except crypto.Error:
+        common.logging_error("Could not read CA private key from %s." % config_ca.CA_PRIVATE_KEY_FILE_PATH)
+        return None
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+# cert_cache.py
+# Munki Enrollment Server
+# Cache of parsed client certificates for authenticated transactions.
+
+# Written by Gerrit DeWitt (gdewitt@gsu.edu)
+# Project started 2015-06-15.  This file created 2026-10-18.
+# Copyright Georgia State University.
+# This script uses publicly-documented methods known to those skilled in the art.
+# References: See top level Read Me.
+
+import time, hashlib, threading, collections
+# Load our modules:
+import security
+import ca_cache
+# Import configuration:
+import configuration_classes as config
+config_client_pki = config.ClientCertificate()
+
+# LRU cache of fingerprint -> entry dict, least recently used first.
+# Entry keys:
+#  * cert: certificate object
+#  * cn: subject CN of the certificate
+#  * chain_valid: True once the certificate passed the check against the CA,
+#    or None if it has not passed
+#  * chain_generation: ca_cache generation of the CA it was checked against
+#  * not_after: end of the certificate's validity window (seconds since the epoch)
+#  * expires_at: time after which the entry is dropped
+CACHE = collections.OrderedDict()
+CACHE_HITS = 0
+CACHE_MISSES = 0
+CACHE_EXPIRED = 0
+CHAIN_CHECKS = 0
+CHAIN_CHECKS_SKIPPED = 0
+LOCK = threading.Lock()
+
+def fingerprint(given_pem):
+    '''Returns the cache key for a PEM string: the SHA-256 of its text.
+        Hashing the text avoids decoding the PEM to find the DER fingerprint.'''
+    return hashlib.sha256(given_pem.strip()).hexdigest()
+
+def lookup(given_pem):
+    '''Returns the cache entry for the certificate in the given PEM string,
+        parsing and adding it if needed.  Entries are shared; callers must
+        not modify them except through set_chain_valid.  Returns None if the
+        PEM is not a valid certificate.'''
+    global CACHE_HITS, CACHE_MISSES, CACHE_EXPIRED
+    cert_fingerprint = fingerprint(given_pem)
+    now = time.time()
+    with LOCK:
+        entry = CACHE.pop(cert_fingerprint,None)
+        if entry and entry['expires_at'] > now:
+            CACHE[cert_fingerprint] = entry
+            CACHE_HITS += 1
+            return entry
+        if entry:
+            CACHE_EXPIRED += 1
+        CACHE_MISSES += 1
+    cert = security.pem_to_cert(given_pem)
+    if not cert:
+        return None
+    entry = {}
+    entry['fingerprint'] = cert_fingerprint
+    entry['cert'] = cert
+    entry['cn'] = security.read_cert_cn(cert)
+    entry['chain_valid'] = None
+    entry['chain_generation'] = None
+    entry['not_after'] = security.read_cert_not_after(cert) or 0
+    entry['expires_at'] = now + config_client_pki.CERT_CACHE_TTL
+    with LOCK:
+        if config_client_pki.CERT_CACHE_SIZE > 0:
+            CACHE[cert_fingerprint] = entry
+            while len(CACHE) > config_client_pki.CERT_CACHE_SIZE:
+                CACHE.popitem(last=False)
+    return entry
+
+def set_chain_valid(given_entry,given_result,given_generation):
+    '''Records the result of checking a cached certificate against the CA
+        of the given ca_cache generation.'''
+    with LOCK:
+        given_entry['chain_valid'] = given_result
+        given_entry['chain_generation'] = given_generation
+
+def is_chain_valid(given_entry):
+    '''Returns true if the cached certificate was issued by the CA and has
+        not expired.  A certificate that passed is not checked again until
+        the CA is reloaded or the entry expires, so repeat requests cost a
+        few comparisons.  Certificates that failed are checked every time.'''
+    global CHAIN_CHECKS, CHAIN_CHECKS_SKIPPED
+    if given_entry['chain_valid'] and given_entry['chain_generation'] == ca_cache.GENERATION and not ca_cache.RELOAD_REQUESTED and time.time() < given_entry['not_after']:
+        CHAIN_CHECKS_SKIPPED += 1
+        return True
+    CHAIN_CHECKS += 1
+    # Read before checking: if the CA is reloaded meanwhile, the
+    # certificate is checked again on its next use rather than trusted:
+    generation = ca_cache.GENERATION
+    if not security.verify_cert_chain(given_entry['cert']):
+        return False
+    set_chain_valid(given_entry,True,generation)
+    return True
+
+def stats():
+    '''Returns a dict with cache hit, miss and expiry counters and the current size.'''
+    stats_dict = {}
+    stats_dict['hits'] = CACHE_HITS
+    stats_dict['misses'] = CACHE_MISSES
+    stats_dict['expired'] = CACHE_EXPIRED
+    stats_dict['chain_checks'] = CHAIN_CHECKS
+    stats_dict['chain_checks_skipped'] = CHAIN_CHECKS_SKIPPED
+    stats_dict['entries'] = len(CACHE)
+    stats_dict['capacity'] = config_client_pki.CERT_CACHE_SIZE
+    stats_dict['ttl'] = config_client_pki.CERT_CACHE_TTL
+    return stats_dict
@@ -6,22 +6,260 @@
 
 # Written by Gerrit DeWitt (gdewitt@gsu.edu)
 # Project started 2015-06-15.  This file created 2015-07-23.
-# 2016-09-19.
+# 2016-09-19, 2026-10-18.
 # Copyright Georgia State University.
 # This script uses publicly-documented methods known to those skilled in the art.
 # References: See top level Read Me.
 
-import logging
+import os, re, sys, json, time, uuid, Queue, random, atexit, socket, logging, logging.handlers, signal, threading
 # Import configuration:
 import configuration_classes as config
 config_app = config.ServerApp()
 
-def logging_info(given_message):
-    logging.info(given_message)
+# Request IDs sent by the front end web server (X-Request-ID) are used if
+# they match this; otherwise a new one is made:
+REQUEST_ID_PATTERN = re.compile(r'^[A-Za-z0-9._-]{1,64}$')
+# ID and sampling decision of the request this thread is handling:
+REQUEST_CONTEXT = threading.local()
+
+# Log writer for this process (see configure_logging).  Records are queued
+# by the thread logging them and written by a background thread, so that a
+# slow disk or syslog does not hold up requests:
+LOG_QUEUE = None
+LOG_WRITER = None
+LOG_WRITER_PID = None
+LOG_WRITER_LOCK = threading.Lock()
+# Handler that writes the records (stream, file or syslog):
+LOG_TARGET_HANDLER = None
+# Helper processes (key pool, crypto pool) write their own records at once:
+LOG_SYNCHRONOUSLY = False
+LOG_STOP = object()
+# Line format when log_format is "text":
+TEXT_LOG_FORMAT = "%(asctime)s %(levelname)s [%(process)d] [%(request_id)s] %(message)s"
+# Counters for this process:
+LOG_RECORDS_WRITTEN = 0
+LOG_RECORDS_DROPPED = 0
+LOG_RECORDS_DROPPED_REPORTED = 0
+
+def logging_info(given_message,*given_args):
+    '''Logs an info message.  Any arguments are formatted into the message
+        with % only if the message is written.'''
+    logging.info(given_message,*given_args)
     if config_app.DEBUG_MODE:
-        print '  %s' % given_message
+        print '  %s' % format_message(given_message,given_args)
+
+def logging_info_sampled(given_message,*given_args):
+    '''Logs a routine info message, written only for the share of requests
+        set by log_info_sample_rate (see begin_request).'''
+    if getattr(REQUEST_CONTEXT,'sampled',True):
+        logging_info(given_message,*given_args)
 
-def logging_error(given_message):
-    logging.error(given_message)
+def logging_error(given_message,*given_args):
+    '''Logs an error message; errors are never sampled.'''
+    logging.error(given_message,*given_args)
     if config_app.DEBUG_MODE:
-        print '  %s' % given_message
\ No newline at end of file
+        print '  %s' % format_message(given_message,given_args)
+
+def format_message(given_message,given_args):
+    '''Formats arguments into a message as logging does.'''
+    if len(given_args) == 1 and isinstance(given_args[0],dict):
+        return given_message % given_args[0]
+    if given_args:
+        return given_message % given_args
+    return given_message
+
+def reset_inherited_signals():
+    '''Restores default handlers for signals a helper process inherits from
+        the server process that forked it.  gunicorn workers ignore SIGTERM
+        while busy, which would keep terminate() from ending helper processes.'''
+    for signal_number in [signal.SIGTERM,signal.SIGINT,signal.SIGQUIT,signal.SIGHUP]:
+        signal.signal(signal_number,signal.SIG_DFL)
+    try:
+        signal.set_wakeup_fd(-1)
+    except ValueError:
+        pass
+
+#PRAGMA MARK: REQUEST CONTEXT
+
+def begin_request(given_request_id=None):
+    '''Sets the ID of the request this thread is handling and decides
+        whether its routine info lines are logged.  Returns the ID.'''
+    if given_request_id and REQUEST_ID_PATTERN.match(given_request_id):
+        request_id = given_request_id
+    else:
+        request_id = uuid.uuid4().hex[:16]
+    REQUEST_CONTEXT.request_id = request_id
+    REQUEST_CONTEXT.sampled = random.random() < config_app.LOG_INFO_SAMPLE_RATE
+    return request_id
+
+def end_request():
+    '''Clears the request context of this thread.'''
+    REQUEST_CONTEXT.request_id = None
+    REQUEST_CONTEXT.sampled = True
+
+def get_request_context():
+    '''Returns the request context of this thread as a tuple that can be
+        passed to another process.'''
+    return (get_request_id(),getattr(REQUEST_CONTEXT,'sampled',True))
+
+def set_request_context(given_context):
+    '''Sets the request context of this thread from get_request_context.'''
+    REQUEST_CONTEXT.request_id,REQUEST_CONTEXT.sampled = given_context
+
+def get_request_id():
+    '''Returns the ID of the request this thread is handling, or None.'''
+    return getattr(REQUEST_CONTEXT,'request_id',None)
+
+class RequestContextFilter(logging.Filter):
+    '''Adds the request ID of the logging thread to each record.'''
+    def filter(self,record):
+        record.request_id = get_request_id() or "-"
+        return True
+
+#PRAGMA MARK: LOG OUTPUT
+
+class JSONFormatter(logging.Formatter):
+    '''Writes each record as one line of JSON.'''
+    def format(self,record):
+        entry_dict = {}
+        entry_dict['time'] = "%(time)s.%(ms)03dZ" % {'time':time.strftime('%Y-%m-%dT%H:%M:%S',time.gmtime(record.created)),'ms':record.msecs}
+        entry_dict['level'] = record.levelname.lower()
+        entry_dict['message'] = record.getMessage()
+        entry_dict['pid'] = record.process
+        entry_dict['logger'] = record.name
+        request_id = getattr(record,'request_id',"-")
+        if request_id != "-":
+            entry_dict['request_id'] = request_id
+        if record.levelno <= logging.INFO and config_app.LOG_INFO_SAMPLE_RATE < 1.0:
+            entry_dict['sample_rate'] = config_app.LOG_INFO_SAMPLE_RATE
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry_dict['exception'] = record.exc_text
+        return json.dumps(entry_dict,sort_keys=True)
+
+class QueueHandler(logging.Handler):
+    '''Queues records for the log writer thread of this process.  When the
+        queue is full, records are dropped and counted rather than making
+        the caller wait.'''
+    def emit(self,record):
+        global LOG_RECORDS_DROPPED
+        if LOG_SYNCHRONOUSLY:
+            write_record(record)
+            return
+        log_queue = get_log_queue()
+        # Tracebacks refer to frames that will have changed by the time the
+        # writer gets to the record:
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        try:
+            log_queue.put_nowait(record)
+        except Queue.Full:
+            LOG_RECORDS_DROPPED += 1
+
+def write_record(given_record):
+    '''Writes a record with the target handler.'''
+    global LOG_RECORDS_WRITTEN
+    LOG_TARGET_HANDLER.handle(given_record)
+    LOG_RECORDS_WRITTEN += 1
+
+def get_log_queue():
+    '''Returns the log queue of this process, starting its writer thread on
+        first use.  Forked processes (gunicorn workers) start their own.'''
+    global LOG_QUEUE, LOG_WRITER, LOG_WRITER_PID
+    if LOG_WRITER_PID == os.getpid():
+        return LOG_QUEUE
+    with LOG_WRITER_LOCK:
+        if LOG_WRITER_PID != os.getpid():
+            # The lock may have been held by the parent's writer when we forked:
+            LOG_TARGET_HANDLER.createLock()
+            LOG_QUEUE = Queue.Queue(max(1,config_app.LOG_QUEUE_SIZE))
+            LOG_WRITER = threading.Thread(target=log_writer,args=(LOG_QUEUE,),name="mes-log-writer")
+            LOG_WRITER.daemon = True
+            LOG_WRITER.start()
+            LOG_WRITER_PID = os.getpid()
+    return LOG_QUEUE
+
+def log_writer(given_queue):
+    '''Writes queued records until stop_log_writer queues LOG_STOP.'''
+    global LOG_RECORDS_DROPPED_REPORTED
+    while True:
+        record = given_queue.get()
+        if record is LOG_STOP:
+            return
+        write_record(record)
+        if LOG_RECORDS_DROPPED != LOG_RECORDS_DROPPED_REPORTED:
+            dropped_count = LOG_RECORDS_DROPPED - LOG_RECORDS_DROPPED_REPORTED
+            LOG_RECORDS_DROPPED_REPORTED = LOG_RECORDS_DROPPED
+            write_record(logging.LogRecord("root",logging.WARNING,__file__,0,"Log queue full; dropped %s records.",(dropped_count,),None))
+
+def stop_log_writer():
+    '''Writes the records still queued and stops the writer thread.'''
+    if LOG_WRITER_PID != os.getpid() or not LOG_WRITER:
+        return
+    try:
+        LOG_QUEUE.put(LOG_STOP,timeout=1.0)
+    except Queue.Full:
+        return
+    LOG_WRITER.join(5.0)
+
+atexit.register(stop_log_writer)
+
+def log_synchronously():
+    '''Makes this process write its records itself; for helper processes,
+        which may exit before a writer thread would get to them.'''
+    global LOG_SYNCHRONOUSLY
+    LOG_SYNCHRONOUSLY = True
+    # As in get_log_queue, a lock held by another thread when we forked
+    # would never be released:
+    if LOG_TARGET_HANDLER:
+        LOG_TARGET_HANDLER.createLock()
+
+def make_target_handler():
+    '''Returns the handler that writes records where log_path says:
+        standard error (empty), syslog ("syslog") or a file.'''
+    if config_app.LOG_PATH == "syslog":
+        handler = logging.handlers.SysLogHandler(address='/dev/log')
+    elif config_app.LOG_PATH:
+        # Reopens the file after logrotate moves it:
+        handler = logging.handlers.WatchedFileHandler(config_app.LOG_PATH)
+    else:
+        handler = logging.StreamHandler(sys.stderr)
+    if config_app.LOG_FORMAT == "json":
+        handler.setFormatter(JSONFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(TEXT_LOG_FORMAT))
+    return handler
+
+def configure_logging():
+    '''Sends the MES log to the queue and writer thread, with the level,
+        format and destination from the ServerApp configuration.  Called
+        once, when the app is imported; later calls do nothing.'''
+    global LOG_TARGET_HANDLER
+    if LOG_TARGET_HANDLER:
+        return
+    try:
+        LOG_TARGET_HANDLER = make_target_handler()
+    except (IOError,OSError,socket.error) as e:
+        logging.error("Could not open log %(path)s: %(error)s" % {'path':config_app.LOG_PATH,'error':e})
+        LOG_TARGET_HANDLER = logging.StreamHandler(sys.stderr)
+        LOG_TARGET_HANDLER.setFormatter(logging.Formatter(TEXT_LOG_FORMAT))
+    queue_handler = QueueHandler()
+    queue_handler.addFilter(RequestContextFilter())
+    root_logger = logging.getLogger()
+    # Replace the handler logging adds if something was logged before now:
+    for handler in list(root_logger.handlers):
+        root_logger.removeHandler(handler)
+    root_logger.addHandler(queue_handler)
+    root_logger.setLevel(getattr(logging,config_app.LOG_LEVEL.upper(),logging.INFO))
+
+def stats():
+    '''Returns a dict with log writer counters for this process.'''
+    stats_dict = {}
+    stats_dict['written'] = LOG_RECORDS_WRITTEN
+    stats_dict['dropped'] = LOG_RECORDS_DROPPED
+    stats_dict['queued'] = 0
+    if LOG_QUEUE and LOG_WRITER_PID == os.getpid():
+        stats_dict['queued'] = LOG_QUEUE.qsize()
+    return stats_dict
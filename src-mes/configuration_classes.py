@@ -6,26 +6,118 @@
 
 # Written by Gerrit DeWitt (gdewitt@gsu.edu)
 # Project started 2015-06-15.  This file created 2015-07-24.
-# 2016-09-19, 2016-10-11, 2016-10-18.
+# 2016-09-19, 2016-10-11, 2016-10-18, 2026-10-18.
 # Copyright Georgia State University.
 # This script uses publicly-documented methods known to those skilled in the art.
 # References: See top level Read Me.
 
-import os
+import os, time, logging, threading
 import read_configuration as r
 
-class Site(object):
+# The configuration files are parsed once per process.  Each section class
+# below has one instance per process, shared by every module that asks for
+# it, so a reload only has to replace the values of those instances.
+#
+# refresh() runs before each request: it reloads the configuration when
+# reload was requested (SIGHUP) or, checked at most every
+# CONFIG_CHECK_INTERVAL seconds, when a file changed.  A reload reads the
+# new files and every section first; if anything is missing or invalid the
+# running configuration is kept.  Settings used only at startup (port, worker
+# and pool sizes, ledger_path) take effect when the MES is restarted.
+CONFIG_CHECK_INTERVAL = 5.0
+# Incremented at each reload; lets caches built from the configuration
+# notice that it changed:
+GENERATION = 0
+RELOAD_REQUESTED = False
+LAST_CHECK_TIME = time.time()
+RELOAD_LOCK = threading.Lock()
+
+class ConfigSection(object):
+    '''Base class for configuration sections.  Instantiating a section
+        returns the instance shared by the process, loading it on first use.
+        Subclasses read their keys in load().'''
+    INSTANCES = {}
+
+    def __new__(cls):
+        with RELOAD_LOCK:
+            instance = ConfigSection.INSTANCES.get(cls)
+            if not instance:
+                r.read_config_files()
+                instance = object.__new__(cls)
+                instance.load()
+                ConfigSection.INSTANCES[cls] = instance
+            return instance
+
+    def load(self):
+        '''Reads the section's keys into attributes of the instance.  Each
+            subclass reads its own; the base class has none.'''
+        pass
+
+def request_reload():
+    '''Asks for the configuration to be reloaded before the next request.
+        Safe to call from a signal handler because it only sets a flag.'''
+    global RELOAD_REQUESTED
+    RELOAD_REQUESTED = True
+
+def refresh():
+    '''Reloads the configuration if a reload was requested or, at most every
+        CONFIG_CHECK_INTERVAL seconds, if a file changed.  Returns true if
+        it was reloaded.'''
+    global LAST_CHECK_TIME
+    now = time.time()
+    if not RELOAD_REQUESTED and now - LAST_CHECK_TIME < CONFIG_CHECK_INTERVAL:
+        return False
+    LAST_CHECK_TIME = now
+    return reload_config(RELOAD_REQUESTED)
+
+def reload_config(given_force=False):
+    '''Reads the configuration files again if they changed (or if forced)
+        and swaps in the new values of every section at once.  Returns true
+        if the configuration was reloaded.'''
+    global GENERATION, RELOAD_REQUESTED
+    with RELOAD_LOCK:
+        RELOAD_REQUESTED = False
+        signature = r.files_signature()
+        if not given_force and signature == r.FILES_SIGNATURE:
+            return False
+        # Read the files and build each section aside; sections in use are
+        # not touched until everything has been read:
+        old_dicts = (r.CONFIG_FILE_ROOT_DICT,r.MUNKI_CLIENT_PREFS_DICT)
+        r.RELOADING = True
+        try:
+            r.CONFIG_FILE_ROOT_DICT,r.MUNKI_CLIENT_PREFS_DICT = r.parse_config_files()
+            r.MISSING_KEYS_LOGGED.clear()
+            section_dicts = {}
+            for section_class in ConfigSection.INSTANCES:
+                section = object.__new__(section_class)
+                section.load()
+                section_dicts[section_class] = section.__dict__
+        except r.ConfigurationError:
+            r.CONFIG_FILE_ROOT_DICT,r.MUNKI_CLIENT_PREFS_DICT = old_dicts
+            section_dicts = None
+        finally:
+            r.RELOADING = False
+        # Do not try these files again until they change:
+        r.FILES_SIGNATURE = signature
+        if section_dicts is None:
+            logging.error("Configuration not reloaded; keeping the running configuration.")
+            return False
+        for section_class in section_dicts:
+            ConfigSection.INSTANCES[section_class].__dict__ = section_dicts[section_class]
+        GENERATION += 1
+    logging.info("Configuration reloaded (generation %s)." % GENERATION)
+    return True
+
+class Site(ConfigSection):
     '''Object containing site specific configuration.'''
-    def __init__(self):
-        r.read_config_files()
+    def load(self):
         self.ORGANIZATION_NAME = r.read_config_key('Site','organization_name')
         self.SUB_ORGANIZATION_NAME = r.read_config_key('Site','sub_organization_name')
         self.ORGANIZATION_ID_PREFIX = r.read_config_key('Site','organization_prefix')
 
-class ServerApp(object):
+class ServerApp(ConfigSection):
     '''Object containing server app configuration.'''
-    def __init__(self):
-        r.read_config_files()
+    def load(self):
         self.PORT = r.read_optional_config_key('ServerApp','port',int(3000))
         # IMPORTANT NOTE REGARDING DEBUG MODE:
         # When true, not only is the top level try-except block
@@ -36,17 +128,45 @@ class ServerApp(object):
         # clear text HTTP on any port!
         self.DEBUG_MODE = r.read_optional_config_key('ServerApp','debug_mode',False)
         self.TEMP_DIR = r.read_optional_config_key('ServerApp','temp_dir',"/tmp")
+        self.TAR_GZIP = r.read_optional_config_key('ServerApp','tar_gzip',False)
+        # Production (wsgi_server.py) settings; 0 workers means one per CPU:
+        self.WORKERS = r.read_optional_config_key('ServerApp','workers',int(0))
+        self.MAX_REQUESTS = r.read_optional_config_key('ServerApp','max_requests',int(1000))
+        self.MAX_REQUESTS_JITTER = r.read_optional_config_key('ServerApp','max_requests_jitter',int(50))
+        self.REQUEST_TIMEOUT = r.read_optional_config_key('ServerApp','request_timeout',int(120))
+        self.GRACEFUL_TIMEOUT = r.read_optional_config_key('ServerApp','graceful_timeout',int(30))
+        self.PRELOAD_APP = r.read_optional_config_key('ServerApp','preload_app',True)
+        # Crypto pool (crypto_pool.py); 0 workers runs crypto in the request process,
+        # and a queue limit of 0 admits every enrollment request:
+        self.CRYPTO_POOL_WORKERS = r.read_optional_config_key('ServerApp','crypto_pool_workers',int(0))
+        self.CRYPTO_QUEUE_LIMIT = r.read_optional_config_key('ServerApp','crypto_queue_limit',int(0))
+        self.CRYPTO_TIMEOUT = r.read_optional_config_key('ServerApp','crypto_timeout',int(60))
+        self.CRYPTO_RETRY_AFTER = r.read_optional_config_key('ServerApp','crypto_retry_after',int(10))
+        # Event-driven front end (async_server.py):
+        self.ASYNC_THREADS = r.read_optional_config_key('ServerApp','async_threads',int(16))
+        self.ASYNC_IDLE_TIMEOUT = r.read_optional_config_key('ServerApp','async_idle_timeout',int(60))
+        # Re-enrollment window (reenroll_cache.py); disabled when the TTL is 0:
+        self.REENROLL_CACHE_TTL = r.read_optional_config_key('ServerApp','reenroll_cache_ttl',int(0))
+        self.REENROLL_CACHE_SIZE = r.read_optional_config_key('ServerApp','reenroll_cache_size',int(256))
+        # Latency histograms and counters served at /metrics (metrics.py):
+        self.METRICS_ENABLED = r.read_optional_config_key('ServerApp','metrics_enabled',False)
+        # Log output (common.configure_logging):
+        self.LOG_PATH = r.read_optional_config_key('ServerApp','log_path',"")
+        self.LOG_FORMAT = r.read_optional_config_key('ServerApp','log_format',"text")
+        self.LOG_LEVEL = r.read_optional_config_key('ServerApp','log_level',"info")
+        self.LOG_QUEUE_SIZE = r.read_optional_config_key('ServerApp','log_queue_size',int(10000))
+        self.LOG_INFO_SAMPLE_RATE = r.read_optional_config_key('ServerApp','log_info_sample_rate',float(1.0))
         self.TRANSACTIONS = ['request-enrollment',
                              'transaction-a',
+                             'transaction-b',
                              'get-group-manifests',
                              'join-manifest',
                              'set-name']
         self.ANON_TRANSACTIONS = ['request-enrollment']
 
-class MunkiManifests(object):
+class MunkiManifests(ConfigSection):
     '''Object containing Munki repository config.'''
-    def __init__(self):
-        r.read_config_files()
+    def load(self):
         self.MUNKI_REPO_PATH = r.read_config_key('MunkiManifests','repo_path')
         # Manifests subdir:
         d = r.read_optional_config_key('MunkiManifests','manifests_dirname',"manifests")
@@ -56,24 +176,37 @@ class MunkiManifests(object):
         self.GROUP_MANIFESTS_PATH = os.path.join(self.MUNKI_MANIFESTS_PATH,d)
         # Computer manifests subdir:
         d = r.read_optional_config_key('MunkiManifests','computer_manifests_dirname',"computers")
+        self.COMPUTER_MANIFESTS_DIRNAME = d
         self.COMPUTER_MANIFESTS_PATH = os.path.join(self.MUNKI_MANIFESTS_PATH,d)
+        # Directory levels computer manifests are spread over (0: all in one
+        # directory) and characters of the serial naming each level:
+        self.COMPUTER_SHARD_LEVELS = max(0,r.read_optional_config_key('MunkiManifests','computer_shard_levels',int(0)))
+        self.COMPUTER_SHARD_WIDTH = max(1,r.read_optional_config_key('MunkiManifests','computer_shard_width',int(2)))
         # Misc defaults:
         self.CATALOG_ARRAY = r.read_config_key('MunkiManifests','catalog_array')
         self.DEFAULT_GROUP = r.read_config_key('MunkiManifests','default_group_manifest')
         self.DEFAULT_COMPUTER_NAME_PREFIX = r.read_config_key('MunkiManifests','default_computer_name_prefix')
+        # Number of parsed manifests kept in memory (0 disables the cache):
+        self.MANIFEST_CACHE_SIZE = r.read_optional_config_key('MunkiManifests','manifest_cache_size',int(1024))
 
-class CertificateAuthority(object):
+class CertificateAuthority(ConfigSection):
     '''Paths and details to access the CA.'''
-    def __init__(self):
-        r.read_config_files()
+    def load(self):
         self.CA_PRIVATE_KEY_FILE_PATH = r.read_config_key('CertificateAuthority','private_key_path')
         self.CA_CERT_FILE_PATH = r.read_config_key('CertificateAuthority','cert_path')
         self.CA_PRIVATE_KEY_PASSPHRASE = r.read_config_key('CertificateAuthority','private_key_passphrase')
+        # Issuance ledger (ledger.py); disabled when no path is set:
+        self.LEDGER_PATH = r.read_optional_config_key('CertificateAuthority','ledger_path',"")
+        self.LEDGER_SERIAL_BLOCK = r.read_optional_config_key('CertificateAuthority','ledger_serial_block',int(100))
+        self.LEDGER_BATCH_SIZE = r.read_optional_config_key('CertificateAuthority','ledger_batch_size',int(50))
+        self.LEDGER_FLUSH_INTERVAL = r.read_optional_config_key('CertificateAuthority','ledger_flush_interval',float(1.0))
+        # Certificate revocation list (crl.py):
+        self.CRL_REFRESH_INTERVAL = r.read_optional_config_key('CertificateAuthority','crl_refresh_interval',int(3600))
+        self.CRL_NEXT_UPDATE_DAYS = r.read_optional_config_key('CertificateAuthority','crl_next_update_days',int(7))
 
-class ClientCertificate(object):
+class ClientCertificate(ConfigSection):
     '''Object containing details for client certificates.'''
-    def __init__(self):
-        r.read_config_files()
+    def load(self):
         self.PRIVATE_KEY_BITS = r.read_config_key('ClientCertificate','private_key_bits')
         self.CSR_SIGNING_HASH_ALGORITHM = r.read_config_key('ClientCertificate','csr_signing_hash_algorithm')
         self.CSR_COUNTRY = r.read_config_key('ClientCertificate','csr_country')
@@ -82,15 +215,28 @@ class ClientCertificate(object):
         self.CSR_ORG = r.read_config_key('ClientCertificate','csr_org')
         self.CSR_OU = r.read_config_key('ClientCertificate','csr_ou')
         self.CERT_LIFE_YEARS = r.read_config_key('ClientCertificate','cert_life_years')
+        # Pre-generated key pool (0 disables it):
+        self.KEY_POOL_SIZE = r.read_optional_config_key('ClientCertificate','key_pool_size',int(0))
+        self.KEY_POOL_WORKERS = r.read_optional_config_key('ClientCertificate','key_pool_workers',int(1))
+        self.KEY_POOL_SEALED_DIR = r.read_optional_config_key('ClientCertificate','key_pool_sealed_dir',"")
+        # Cache of parsed client certificates (0 disables it):
+        self.CERT_CACHE_SIZE = r.read_optional_config_key('ClientCertificate','cert_cache_size',int(4096))
+        self.CERT_CACHE_TTL = r.read_optional_config_key('ClientCertificate','cert_cache_ttl',int(600))
 
-class ClientMunkiPrefs(object):
+class ClientMunkiPrefs(ConfigSection):
     '''Object containing Munki client prefs.'''
-    def __init__(self):
-        r.read_config_files()
+    def load(self):
         self.CONFIG_PROFILE_ORG = r.read_config_key('ClientMunkiPrefs','config_profile_org')
         self.CONFIG_PROFILE_DISPLAY_NAME = r.read_config_key('ClientMunkiPrefs','config_profile_display_name')
         self.CONFIG_PROFILE_DESCRIPTION = r.read_config_key('ClientMunkiPrefs','config_profile_description')
         self.P12_CA_DISPLAY_NAME = r.read_config_key('ClientMunkiPrefs','p12_ca_display_name')
+        # How the CA certificate is delivered in the profile:
+        self.CA_PAYLOAD_MODES = ['p12','p12-cached','cert']
+        self.CA_PAYLOAD_MODE = r.read_optional_config_key('ClientMunkiPrefs','ca_payload_mode',"p12")
+        if self.CA_PAYLOAD_MODE not in self.CA_PAYLOAD_MODES:
+            logging.error("Unknown ca_payload_mode %s; defaulting to \"p12\"." % self.CA_PAYLOAD_MODE)
+            self.CA_PAYLOAD_MODE = "p12"
+        self.CA_PAYLOAD_P12_PASSPHRASE = r.read_optional_config_key('ClientMunkiPrefs','ca_payload_p12_passphrase',"")
         self.MUNKI_MCX_PAYLOAD_DISPLAY_NAME = r.read_config_key('ClientMunkiPrefs','munki_mcx_payload_display_name')
         self.MUNKI_MCX_DEFAULTS_DOMAIN = r.read_config_key('ClientMunkiPrefs','munki_mcx_defaults_domain')
         self.MUNKI_CLIENT_PREFS_DICT = r.MUNKI_CLIENT_PREFS_DICT
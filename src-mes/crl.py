@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+
+# crl.py
+# Munki Enrollment Server
+# Certificate revocation list built from the issuance ledger.
+
+# Written by Gerrit DeWitt (gdewitt@gsu.edu)
+# Project started 2015-06-15.  This file created 2026-10-18.
+# Copyright Georgia State University.
+# This script uses publicly-documented methods known to those skilled in the art.
+# References: See top level Read Me.
+
+# Usage:
+#  crl.py revoke CERT_SERIAL [REASON]
+#  crl.py revoke-machine MACHINE_SERIAL [REASON]
+#  crl.py write PATH
+# The write command saves the CRL (PEM) for a web server that reads it from
+# a file, such as nginx with ssl_crl.  The MES also serves it at /crl (DER)
+# and /crl.pem.
+#
+# The CRL is kept signed in memory and re-signed only when a certificate is
+# revoked or when its lastUpdate moves to the next crl_refresh_interval
+# boundary.  lastUpdate and nextUpdate are aligned to those boundaries, so
+# every MES process signs byte-identical CRLs and they share one ETag.
+
+import os, sys, time, hashlib, threading
+from OpenSSL import crypto
+# Load our modules:
+import common
+import ca_cache
+import ledger
+# Import configuration:
+import configuration_classes as config
+config_ca = config.CertificateAuthority()
+config_client_pki = config.ClientCertificate()
+
+# Seconds between checks of the ledger for new revocations:
+REVOCATION_CHECK_INTERVAL = 1.0
+
+# Revocations read from the ledger so far, for this process:
+#  * seq: sequence number of the latest one
+#  * entries: array of revocation dicts (see ledger.revocations_since), oldest first
+#  * revoked_serials: set of revoked certificate serials
+#  * checked_at: time of the last check for new revocations
+REVOCATIONS = {'seq':0,'entries':[],'revoked_serials':set(),'checked_at':0}
+# Signed CRL for this process once built; keys:
+#  * crl: CRL object, to which new revocations are added
+#  * boundary: crl_refresh_interval boundary it was built for
+#  * ca_generation: ca_cache generation of the CA that signed it
+#  * seq: latest revocation it includes
+#  * this_update, next_update: its validity (seconds since the epoch)
+#  * der, pem, etag: the signed output
+SIGNED_CRL = None
+LOCK = threading.RLock()
+# Counters for this process:
+SIGN_COUNT = 0
+REBUILD_COUNT = 0
+
+def format_crl_time(given_time):
+    '''Returns seconds since the epoch in the YYYYMMDDhhmmssZ form used in CRLs.'''
+    return time.strftime('%Y%m%d%H%M%SZ',time.gmtime(given_time))
+
+def refresh_revocations(given_force=False):
+    '''Reads revocations made since the last check from the ledger.
+        Checks at most every REVOCATION_CHECK_INTERVAL seconds unless forced.
+        Returns true if new revocations were found.'''
+    now = time.time()
+    with LOCK:
+        if not given_force and now - REVOCATIONS['checked_at'] < REVOCATION_CHECK_INTERVAL:
+            return False
+        REVOCATIONS['checked_at'] = now
+        version = ledger.revocation_version()
+        if version is None or version == REVOCATIONS['seq']:
+            return False
+        new_entries = ledger.revocations_since(REVOCATIONS['seq'])
+        if not new_entries:
+            return False
+        REVOCATIONS['entries'].extend(new_entries)
+        REVOCATIONS['revoked_serials'].update([entry['cert_serial'] for entry in new_entries])
+        REVOCATIONS['seq'] = new_entries[-1]['seq']
+        return True
+
+def is_serial_revoked(given_cert_serial):
+    '''Returns true if the certificate with the given serial has been
+        revoked.  Certificates issued without a ledger serial (serial 0 or
+        None) cannot be revoked.'''
+    if not given_cert_serial or not ledger.is_enabled():
+        return False
+    refresh_revocations()
+    return given_cert_serial in REVOCATIONS['revoked_serials']
+
+def is_revoked(given_cert):
+    '''Returns true if the given certificate has been revoked.'''
+    try:
+        return is_serial_revoked(given_cert.get_serial_number())
+    except crypto.Error:
+        return False
+
+#PRAGMA MARK: SIGNING
+
+def make_revoked(given_entry):
+    '''Returns a Revoked object for a revocation dict.'''
+    revoked = crypto.Revoked()
+    revoked.set_serial('%x' % given_entry['cert_serial'])
+    revoked.set_rev_date(format_crl_time(given_entry['revoked_at']))
+    if given_entry['reason']:
+        revoked.set_reason(str(given_entry['reason']))
+    return revoked
+
+def build_crl(given_entries,given_boundary):
+    '''Returns a new CRL object with the given revocations, leaving out
+        certificates that expired before the given boundary.'''
+    global REBUILD_COUNT
+    REBUILD_COUNT += 1
+    crl = crypto.CRL()
+    for entry in given_entries:
+        if include_entry(entry,given_boundary):
+            crl.add_revoked(make_revoked(entry))
+    return crl
+
+def include_entry(given_entry,given_boundary):
+    '''Expired certificates need not stay on the CRL.'''
+    return not given_entry['not_after'] or given_entry['not_after'] >= given_boundary
+
+def sign_crl(given_crl,given_this_update,given_next_update):
+    '''Signs the CRL with the CA.  Returns (DER, PEM) or None.'''
+    global SIGN_COUNT
+    ca_cert = ca_cache.get_ca_cert()
+    ca_key = ca_cache.get_ca_key()
+    if not ca_cert or not ca_key:
+        common.logging_error("Cannot sign CRL - CA material error.")
+        return None
+    try:
+        given_crl.set_lastUpdate(format_crl_time(given_this_update))
+        given_crl.set_nextUpdate(format_crl_time(given_next_update))
+        given_crl.sign(ca_cert,ca_key,config_client_pki.CSR_SIGNING_HASH_ALGORITHM)
+        crl_der = crypto.dump_crl(crypto.FILETYPE_ASN1,given_crl)
+        crl_pem = crypto.dump_crl(crypto.FILETYPE_PEM,given_crl)
+    except crypto.Error:
+        common.logging_error("Could not sign CRL.")
+        return None
+    SIGN_COUNT += 1
+    return crl_der,crl_pem
+
+def get_crl():
+    '''Returns a dict with the current signed CRL (der, pem, etag,
+        this_update, next_update), re-signing it first if revocations were
+        added, the refresh boundary passed, or the CA was reloaded.
+        Returns None if the CRL cannot be built.'''
+    global SIGNED_CRL
+    with LOCK:
+        refresh_revocations()
+        now = time.time()
+        boundary = int(now) - int(now) % max(1,config_ca.CRL_REFRESH_INTERVAL)
+        signed_crl = SIGNED_CRL
+        ca_cert = ca_cache.get_ca_cert()
+        if signed_crl and signed_crl['boundary'] == boundary and signed_crl['ca_generation'] == ca_cache.GENERATION and signed_crl['seq'] == REVOCATIONS['seq']:
+            return signed_crl
+        if not ca_cert:
+            common.logging_error("Cannot build CRL - CA certificate error.")
+            return None
+        if signed_crl and signed_crl['boundary'] == boundary:
+            # Same boundary: add only the new revocations.
+            crl = signed_crl['crl']
+            for entry in REVOCATIONS['entries']:
+                if entry['seq'] > signed_crl['seq'] and include_entry(entry,boundary):
+                    crl.add_revoked(make_revoked(entry))
+        else:
+            crl = build_crl(REVOCATIONS['entries'],boundary)
+        # lastUpdate is the boundary, or the latest revocation if it is newer,
+        # so that it is the same in every process:
+        this_update = boundary
+        if REVOCATIONS['entries']:
+            this_update = max(boundary,REVOCATIONS['entries'][-1]['revoked_at'])
+        next_update = boundary + config_ca.CRL_NEXT_UPDATE_DAYS*24*3600
+        signed = sign_crl(crl,this_update,next_update)
+        if not signed:
+            SIGNED_CRL = None
+            return None
+        signed_crl = {}
+        signed_crl['crl'] = crl
+        signed_crl['boundary'] = boundary
+        signed_crl['ca_generation'] = ca_cache.GENERATION
+        signed_crl['seq'] = REVOCATIONS['seq']
+        signed_crl['this_update'] = this_update
+        signed_crl['next_update'] = next_update
+        signed_crl['der'],signed_crl['pem'] = signed
+        signed_crl['etag'] = hashlib.sha1(signed_crl['der']).hexdigest()
+        SIGNED_CRL = signed_crl
+        common.logging_info("Signed CRL with %(count)s entries (seq %(seq)s)." % {'count':len(crl.get_revoked() or []),'seq':signed_crl['seq']})
+        return signed_crl
+
+def stats():
+    '''Returns a dict with revocation and signing counters for this process.'''
+    stats_dict = {}
+    stats_dict['revoked'] = len(REVOCATIONS['revoked_serials'])
+    stats_dict['seq'] = REVOCATIONS['seq']
+    stats_dict['signed'] = SIGN_COUNT
+    stats_dict['rebuilt'] = REBUILD_COUNT
+    return stats_dict
+
+#PRAGMA MARK: COMMAND LINE
+
+def write_crl_file(given_path):
+    '''Atomically writes the current CRL (PEM) to the given path.
+        Returns true on success.'''
+    signed_crl = get_crl()
+    if not signed_crl:
+        return False
+    temp_path = "%(path)s.%(pid)s" % {'path':given_path,'pid':os.getpid()}
+    try:
+        file_object = open(temp_path,'w')
+        file_object.write(signed_crl['pem'])
+        file_object.close()
+        os.rename(temp_path,given_path)
+    except (IOError,OSError):
+        common.logging_error("Could not write CRL to %s." % given_path)
+        return False
+    return True
+
+def main(given_arguments):
+    '''Handles the command line; returns the exit status.'''
+    if not ledger.is_enabled():
+        print "The issuance ledger is not configured (ledger_path)."
+        return 1
+    if len(given_arguments) >= 2 and given_arguments[0] in ['revoke','revoke-machine']:
+        reason = None
+        if len(given_arguments) > 2:
+            reason = given_arguments[2]
+            if reason not in crypto.Revoked().all_reasons():
+                print "Unknown reason %(reason)s; use one of: %(reasons)s" % {'reason':reason,'reasons':', '.join(crypto.Revoked().all_reasons())}
+                return 1
+        if given_arguments[0] == 'revoke':
+            try:
+                cert_serials = [int(given_arguments[1])]
+            except ValueError:
+                print "Certificate serial must be a number."
+                return 1
+        else:
+            cert_serials = [row['cert_serial'] for row in ledger.find_by_machine_serial(given_arguments[1]) if not row['revoked_at']]
+        revoked_count = 0
+        for cert_serial in cert_serials:
+            if ledger.revoke(cert_serial,reason):
+                revoked_count += 1
+        print "Revoked %s certificates." % revoked_count
+        return 0
+    if len(given_arguments) == 2 and given_arguments[0] == 'write':
+        if not write_crl_file(given_arguments[1]):
+            return 1
+        return 0
+    print "Usage: crl.py revoke CERT_SERIAL [REASON] | revoke-machine MACHINE_SERIAL [REASON] | write PATH"
+    return 1
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+
+# crypto_pool.py
+# Munki Enrollment Server
+# Process pool for the CPU-bound steps of enrollment, with admission control
+# and per-stage timings.
+
+# Written by Gerrit DeWitt (gdewitt@gsu.edu)
+# Project started 2015-06-15.  This file created 2026-10-18.
+# Copyright Georgia State University.
+# This script uses publicly-documented methods known to those skilled in the art.
+# References: See top level Read Me.
+
+import os, time, random, fcntl, signal, atexit, threading, contextlib, multiprocessing
+# Load our modules:
+import common
+import metrics
+# Import configuration:
+import configuration_classes as config
+config_app = config.ServerApp()
+
+# Admission slot lock files live on the local filesystem, so the queue
+# limit applies to all MES processes on this server:
+SLOT_DIR_NAME = "mes-crypto-slots"
+
+# Pool for this process; started on first use:
+POOL = None
+LOCK = threading.Lock()
+# Counters for this process:
+ADMITTED_COUNT = 0
+REJECTED_COUNT = 0
+TIMEOUT_COUNT = 0
+# Stage name -> [count, total seconds, max seconds]:
+STAGE_TIMINGS = {}
+
+class PoolBusy(Exception):
+    '''Raised when the crypto queue is full.  The client should retry later.'''
+    pass
+
+#PRAGMA MARK: ADMISSION CONTROL
+
+def acquire_slot():
+    '''Takes a free admission slot without waiting.  Returns the open slot
+        lock file, True if admission control is off, or None if every slot is
+        taken.  A slot is freed when its holder releases it or exits.'''
+    if config_app.CRYPTO_QUEUE_LIMIT <= 0:
+        return True
+    slot_dir = os.path.join(config_app.TEMP_DIR,SLOT_DIR_NAME)
+    if not os.path.isdir(slot_dir):
+        try:
+            os.makedirs(slot_dir,0700)
+        except OSError:
+            pass # created by another process
+    # Start at a random slot so that processes do not all contend for the first:
+    first_slot = random.randrange(config_app.CRYPTO_QUEUE_LIMIT)
+    for i in range(config_app.CRYPTO_QUEUE_LIMIT):
+        slot_path = os.path.join(slot_dir,"slot-%s.lock" % ((first_slot + i) % config_app.CRYPTO_QUEUE_LIMIT))
+        try:
+            slot_file = open(slot_path,'a')
+        except IOError:
+            common.logging_error("Could not open admission slot %s." % slot_path)
+            continue
+        try:
+            fcntl.flock(slot_file.fileno(),fcntl.LOCK_EX|fcntl.LOCK_NB)
+            return slot_file
+        except IOError:
+            slot_file.close()
+    return None
+
+def release_slot(given_slot_file):
+    '''Releases a slot taken with acquire_slot.'''
+    if given_slot_file is True:
+        return
+    try:
+        fcntl.flock(given_slot_file.fileno(),fcntl.LOCK_UN)
+    finally:
+        given_slot_file.close()
+
+class Admission(object):
+    '''Admits one enrollment request, used as a context manager:
+        with Admission():
+            ...
+        Raises PoolBusy on entry if crypto_queue_limit requests are already
+        being handled, so the server can turn the client away at once.'''
+    def __init__(self):
+        self.slot_file = None
+
+    def __enter__(self):
+        global ADMITTED_COUNT, REJECTED_COUNT
+        self.slot_file = acquire_slot()
+        if not self.slot_file:
+            REJECTED_COUNT += 1
+            raise PoolBusy()
+        ADMITTED_COUNT += 1
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        release_slot(self.slot_file)
+        return False
+
+#PRAGMA MARK: POOL
+
+def pool_initializer():
+    '''Runs in each pool process as it starts.  Pool processes ignore SIGTERM
+        and SIGINT: a pool process killed while waiting for work leaves the
+        pool unable to shut down, and the init script signals every MES process
+        at once.  stop() ends them instead, and they exit on their own if the
+        process that started them dies.'''
+    common.reset_inherited_signals()
+    common.log_synchronously()
+    signal.signal(signal.SIGTERM,signal.SIG_IGN)
+    signal.signal(signal.SIGINT,signal.SIG_IGN)
+
+def start():
+    '''Starts the pool for this process if crypto_pool_workers is set.
+        Returns true if the pool is running.'''
+    global POOL
+    if config_app.CRYPTO_POOL_WORKERS <= 0:
+        return False
+    with LOCK:
+        if POOL:
+            return True
+        POOL = multiprocessing.Pool(config_app.CRYPTO_POOL_WORKERS,pool_initializer)
+    common.logging_info("Crypto pool started: %s processes." % config_app.CRYPTO_POOL_WORKERS)
+    atexit.register(stop)
+    return True
+
+def stop():
+    '''Stops the pool for this process once its current jobs finish.'''
+    global POOL
+    with LOCK:
+        if not POOL:
+            return
+        POOL.close()
+        POOL.join()
+        POOL = None
+    common.logging_info("Crypto pool stopped: %s" % stats())
+
+def run(given_function,*given_args):
+    '''Runs the given module-level function with the given arguments in the
+        pool, or in this process if the pool is disabled, and returns its
+        result.  Arguments and results must be picklable (PEM strings rather
+        than OpenSSL objects).  Returns None if the pool does not answer within
+        crypto_timeout seconds.'''
+    global TIMEOUT_COUNT
+    if not start():
+        return given_function(*given_args)
+    async_result = POOL.apply_async(run_in_request_context,(common.get_request_context(),given_function,given_args))
+    try:
+        return async_result.get(config_app.CRYPTO_TIMEOUT)
+    except multiprocessing.TimeoutError:
+        TIMEOUT_COUNT += 1
+        common.logging_error("Crypto pool did not answer within %s seconds." % config_app.CRYPTO_TIMEOUT)
+        return None
+
+def run_in_request_context(given_request_context,given_function,given_args):
+    '''Runs in a pool process: calls the function with the request context
+        of the caller, so that lines it logs carry the request's ID.'''
+    # Pool processes serve no requests of their own, so nothing else reloads
+    # their configuration.  Check the files on every task rather than every
+    # CONFIG_CHECK_INTERVAL seconds, so that a pool process is never behind
+    # the worker (after a CA key and passphrase change, ca_cache would
+    # otherwise read the new key with the old passphrase):
+    config.reload_config()
+    common.set_request_context(given_request_context)
+    try:
+        return given_function(*given_args)
+    finally:
+        common.end_request()
+
+#PRAGMA MARK: TIMINGS
+
+@contextlib.contextmanager
+def stage(given_timings_dict,given_stage_name):
+    '''Context manager adding the seconds spent in its block to
+        given_timings_dict[given_stage_name].'''
+    start_time = time.time()
+    try:
+        yield
+    finally:
+        given_timings_dict[given_stage_name] = given_timings_dict.get(given_stage_name,0.0) + time.time() - start_time
+
+def record_timings(given_timings_dict):
+    '''Adds one request's stage timings to the totals for this process
+        and to the enrollment stage histograms.'''
+    for stage_name in given_timings_dict:
+        metrics.observe('mes_enrollment_stage_seconds',(('stage',stage_name),),given_timings_dict[stage_name])
+    with LOCK:
+        for stage_name in given_timings_dict:
+            totals = STAGE_TIMINGS.setdefault(stage_name,[0,0.0,0.0])
+            totals[0] += 1
+            totals[1] += given_timings_dict[stage_name]
+            totals[2] = max(totals[2],given_timings_dict[stage_name])
+
+def format_timings(given_timings_dict):
+    '''Returns stage timings in milliseconds as a Server-Timing header value,
+        e.g. "keygen;dur=812.4, sign;dur=3.1".'''
+    return ", ".join(["%(stage)s;dur=%(ms).1f" % {'stage':stage_name,'ms':given_timings_dict[stage_name]*1000.0} for stage_name in sorted(given_timings_dict)])
+
+def stats():
+    '''Returns a dict describing the pool, admission counters for this
+        process, and the count, mean and max milliseconds of each stage.'''
+    stats_dict = {}
+    stats_dict['workers'] = config_app.CRYPTO_POOL_WORKERS
+    stats_dict['queue_limit'] = config_app.CRYPTO_QUEUE_LIMIT
+    stats_dict['admitted'] = ADMITTED_COUNT
+    stats_dict['rejected'] = REJECTED_COUNT
+    stats_dict['timeouts'] = TIMEOUT_COUNT
+    stats_dict['stages'] = {}
+    with LOCK:
+        for stage_name in STAGE_TIMINGS:
+            count,total,maximum = STAGE_TIMINGS[stage_name]
+            stats_dict['stages'][stage_name] = {'count':count,'mean_ms':round(total*1000.0/count,3),'max_ms':round(maximum*1000.0,3)}
+    return stats_dict
@@ -6,18 +6,24 @@
 
 # Written by Gerrit DeWitt (gdewitt@gsu.edu)
 # Project started 2015-06-15.  This file created 2015-07-23.
-# 2016-09-19, 2017-02-10.
+# 2016-09-19, 2017-02-10, 2026-10-18.
 # Copyright Georgia State University.
 # This script uses publicly-documented methods known to those skilled in the art.
 # References: See top level Read Me.
 
-import os, base64, uuid, plistlib, xml, tarfile
+import base64, tarfile
 from cStringIO import StringIO
+from OpenSSL import crypto
 # Load our modules:
 import common
 import devices
 import manifests
 import security
+import key_pool
+import crypto_pool
+import ledger
+import reenroll_cache
+import mobileconfig
 # Import configuration:
 import configuration_classes as config
 config_site = config.Site()
@@ -26,50 +32,129 @@ config_munki_client = config.ClientMunkiPrefs()
 
 def do_enrollment(given_serial):
     '''Abstracted method covering the enrollment procedure.
-        Returns tar file contents or None.'''
+        Returns base64-encoded tar file contents or None.'''
+    tar_data = make_enrollment_archive(given_serial)
+    if not tar_data:
+        return None
+    return base64.b64encode(tar_data)
+
+def make_enrollment_archive(given_serial,given_timings_dict=None):
+    '''Performs the enrollment procedure.  The CPU-bound steps run in the
+        crypto pool.  A repeated request within the re-enrollment window
+        returns the archive issued before.  Seconds spent in each stage are
+        added to given_timings_dict if one is given.
+        Returns raw tar file contents or None.'''
+    if given_timings_dict is None:
+        given_timings_dict = {}
     # Validate serial:
     given_serial = devices.validate_serial_number(given_serial)
     if not given_serial:
         common.logging_error("Serial number failed validation.")
         return None
+    # Repeat request within the re-enrollment window: return the same archive.
+    with crypto_pool.stage(given_timings_dict,'reenroll_cache'):
+        tar_data = reenroll_cache.lookup(given_serial)
+    if tar_data:
+        return tar_data
     # Generate manifest:
-    manifests.make_computer_manifest(given_serial)
+    with crypto_pool.stage(given_timings_dict,'manifest'):
+        manifests.make_computer_manifest(given_serial)
+    # Unique certificate serial from the issuance ledger, if enabled:
+    with crypto_pool.stage(given_timings_dict,'ledger'):
+        cert_serial = ledger.allocate_serial()
+    if ledger.is_enabled() and not cert_serial:
+        common.logging_error("Could not allocate a certificate serial for %s." % given_serial)
+        return None
+    # Private key (from the pool when it is running), signed certificate and CA payload:
+    with crypto_pool.stage(given_timings_dict,'crypto'):
+        identity_dict = crypto_pool.run(issue_client_identity,given_serial,key_pool.take_key_pem(),cert_serial)
+    if not identity_dict:
+        common.logging_error("Failed to issue a client identity for %s." % given_serial)
+        return None
+    given_timings_dict.update(identity_dict['timings'])
+    # Record the issued certificate (written in the background):
+    if cert_serial:
+        ledger.record_issuance(cert_serial,given_serial,identity_dict['cert_fingerprint'],identity_dict['cert_not_before'],identity_dict['cert_not_after'])
+    # Generate mobileconfig:
+    with crypto_pool.stage(given_timings_dict,'mobileconfig'):
+        mobileconfig_contents = make_mobileconfig(given_serial,identity_dict['ca_payload_data'],identity_dict['ca_cert_cn'],identity_dict['ca_payload_password'])
+    if not mobileconfig_contents:
+        common.logging_error("Failed to generate mobileconfig_contents.")
+        return None
+    # Return tar file:
+    with crypto_pool.stage(given_timings_dict,'tar'):
+        tar_data = make_tar_data(given_serial,identity_dict['pki_contents'],mobileconfig_contents)
+    if tar_data:
+        with crypto_pool.stage(given_timings_dict,'reenroll_cache'):
+            reenroll_cache.store(given_serial,tar_data,cert_serial)
+    return tar_data
+
+def issue_client_identity(given_serial,given_key_pem=None,given_cert_serial=None):
+    '''Performs the CPU-bound steps of enrollment: private key (unless one
+        from the key pool is given as PEM), signed client certificate with
+        the given certificate serial, and CA payload.  Runs in a crypto pool
+        process, so it takes and returns strings rather than OpenSSL objects.
+        Returns a dict with pki_contents, ca_payload_data, ca_payload_password,
+        ca_cert_cn, cert_fingerprint, cert_not_before, cert_not_after and
+        timings (seconds per stage), or None.'''
+    timings_dict = {}
     # Create private key:
-    client_key = security.generate_private_key()
+    with crypto_pool.stage(timings_dict,'keygen'):
+        client_key = None
+        if given_key_pem:
+            try:
+                client_key = crypto.load_privatekey(crypto.FILETYPE_PEM,given_key_pem)
+            except crypto.Error:
+                common.logging_error("Could not load a private key from the key pool.")
+        if not client_key:
+            client_key = security.generate_private_key()
     # Create CSR:
-    client_csr = security.generate_csr(client_key,given_serial)
+    with crypto_pool.stage(timings_dict,'csr'):
+        client_csr = security.generate_csr(client_key,given_serial)
     # Read CA certificate:
     ca_cert = security.read_ca_cert()
-    ca_cert_p12_data = security.make_p12_with_ca_cert(ca_cert,given_serial)
-    ca_cert_cn = security.read_cert_cn(ca_cert)
+    if not ca_cert:
+        common.logging_error("Failed to read the CA certificate.")
+        return None
+    with crypto_pool.stage(timings_dict,'ca_payload'):
+        ca_payload_data,ca_payload_password = make_ca_payload_data(ca_cert,given_serial)
     # Sign CSR:
-    client_cert = security.sign_with_ca(client_csr,ca_cert)
-    # Generate mobileconfig:
-    mobileconfig_contents = make_mobileconfig(given_serial,ca_cert_p12_data,ca_cert_cn)
-    if not mobileconfig_contents:
-        common.logging_error("Failed to generate mobileconfig_contents.")
+    with crypto_pool.stage(timings_dict,'sign'):
+        client_cert = security.sign_with_ca(client_csr,ca_cert,given_cert_serial)
+    if not client_cert:
+        common.logging_error("Failed to sign the client certificate.")
         return None
     # Generate identity PEM (client key + client cert + CA cert):
-    pki_contents = security.make_identity_pem_string(client_key,client_cert,ca_cert)
+    with crypto_pool.stage(timings_dict,'pem'):
+        pki_contents = security.make_identity_pem_string(client_key,client_cert,ca_cert)
     if not pki_contents:
         common.logging_error("Failed to generate pki_contents.")
         return None
-    # Return tar file:
-    return make_tar_file(given_serial,pki_contents,mobileconfig_contents)
+    identity_dict = {}
+    identity_dict['pki_contents'] = pki_contents
+    identity_dict['ca_payload_data'] = ca_payload_data
+    identity_dict['ca_payload_password'] = ca_payload_password
+    identity_dict['ca_cert_cn'] = security.read_cert_cn(ca_cert)
+    identity_dict['cert_fingerprint'] = security.cert_fingerprint(client_cert)
+    identity_dict['cert_not_before'] = security.read_cert_time(client_cert.get_notBefore())
+    identity_dict['cert_not_after'] = security.read_cert_not_after(client_cert)
+    identity_dict['timings'] = timings_dict
+    return identity_dict
 
 def make_tar_file(given_serial,given_pki_contents,given_mobileconfig_contents):
     '''Creates a tarfile with the configuration profile and client identity.
         Returns base64-encoded data representing the tarfile contents or
         None if something went wrong.'''
-    common.logging_info("Generating tar file response for %s." % given_serial)
-
-    tar_file_name = "mes-%s.tar" % given_serial.upper()
-    tar_file_path = os.path.join(config_app.TEMP_DIR,tar_file_name)
+    tar_data = make_tar_data(given_serial,given_pki_contents,given_mobileconfig_contents)
+    if not tar_data:
+        return None
+    return base64.b64encode(tar_data)
 
-    # Remove existing archive:
-    if os.path.exists(tar_file_path):
-        os.remove(tar_file_path)
-        common.logging_info("Removed existing temp file: %s." % tar_file_path)
+def make_tar_data(given_serial,given_pki_contents,given_mobileconfig_contents):
+    '''Creates a tarfile in memory with the configuration profile and client identity.
+        The archive is gzip-compressed if tar_gzip is set in the configuration.
+        Returns the raw tarfile contents or None if something went wrong.'''
+    common.logging_info_sampled("Generating tar file response for %s.",given_serial)
 
     # Create file objects:
     member_files_array = []
@@ -87,11 +172,17 @@ def make_tar_file(given_serial,given_pki_contents,given_mobileconfig_contents):
     member_file_meta_dict['file_object'] = StringIO(given_pki_contents)
     member_files_array.append(member_file_meta_dict)
 
-    # Create new archive:
+    # Create new archive in a memory buffer; nothing touches the filesystem,
+    # so simultaneous requests for the same serial cannot collide:
+    if config_app.TAR_GZIP:
+        tar_mode = 'w:gz'
+    else:
+        tar_mode = 'w'
+    tar_buffer = StringIO()
     try:
-        tar_file = tarfile.open(tar_file_path,'w')
+        tar_file = tarfile.open(fileobj=tar_buffer,mode=tar_mode)
     except tarfile.TarError:
-        common.logging_error("Failed to create archive file at %s." % tar_file_path)
+        common.logging_error("Failed to create archive for %s." % given_serial)
         return None
 
     # Add files to tar:
@@ -105,93 +196,34 @@ def make_tar_file(given_serial,given_pki_contents,given_mobileconfig_contents):
         except:
             common.logging_error("Failed to add %s to archive." % m['file_name'])
 
-    tar_file.close()
-
-    # Read archive:
     try:
-        tar_file = open(tar_file_path,'r')
-        attachment_contents = base64.b64encode(tar_file.read())
         tar_file.close()
     except tarfile.TarError:
-        common.logging_error("Failed to read newly created archive at %s." % tar_file_path)
+        common.logging_error("Failed to finish archive for %s." % given_serial)
         return None
 
-    # Remove archive:
-    if os.path.exists(tar_file_path):
-        os.remove(tar_file_path)
-        common.logging_info("Removed archive: %s." % tar_file_path)
-
     # Return:
-    return attachment_contents
-
-def make_mobileconfig(given_serial,given_ca_cert_p12_data,given_ca_cert_cn):
-    '''Generates a configuration profile with a P12 payload containing the given CA P12 data
+    return tar_buffer.getvalue()
+
+def make_ca_payload_data(given_ca_cert,given_serial):
+    '''Returns a tuple of (data, password) for the CA payload of the
+        configuration profile, according to the configured ca_payload_mode.
+        The password is None for the certificate-only mode.'''
+    if config_munki_client.CA_PAYLOAD_MODE == 'cert':
+        return security.cert_to_der(given_ca_cert),None
+    if config_munki_client.CA_PAYLOAD_MODE == 'p12-cached':
+        return security.get_cached_p12_with_ca_cert(given_ca_cert)
+    # Default: new P12 for this client, with its serial as the password:
+    return security.make_p12_with_ca_cert(given_ca_cert,given_serial),given_serial
+
+def make_mobileconfig(given_serial,given_ca_payload_data,given_ca_cert_cn,given_ca_payload_password=None):
+    '''Generates a configuration profile with a CA payload containing the given CA data
         and a MCX payload with the ManagedInstalls.plist for the munki_client.
+        The CA payload is a P12 payload protected by the given password, or a
+        root certificate payload (DER data) if the payload mode is "cert".
+        The profile is rendered from a template compiled once (see mobileconfig.py).
         Returns the XML contents of the config file or None.'''
-    common.logging_info("Generating configuration profile for %s." % given_serial)
-
-    # New profile main dict:
-    mobileconfig_top_dict = {}
-    mobileconfig_top_dict['PayloadVersion'] = int(1)
-    mobileconfig_top_dict['PayloadType'] = "Configuration"
-    mobileconfig_top_dict['PayloadScope'] = "System"
-    mobileconfig_top_dict['PayloadIdentifier'] = "%s.config.profile.munki-enrollment" % config_site.ORGANIZATION_ID_PREFIX
-    mobileconfig_top_dict['PayloadUUID'] = str(uuid.uuid4())
-    mobileconfig_top_dict['PayloadOrganization'] = config_munki_client.CONFIG_PROFILE_ORG
-    mobileconfig_top_dict['PayloadDisplayName'] = config_munki_client.CONFIG_PROFILE_DISPLAY_NAME
-    mobileconfig_top_dict['PayloadDescription'] = config_munki_client.CONFIG_PROFILE_DESCRIPTION
-    mobileconfig_top_dict['PayloadContent'] = [] # This is an array of other dicts.
-
-    
-    # P12 CA Payload:
-    payload_p12_dict = {}
-    payload_p12_dict['PayloadVersion'] = int(1)
-    payload_p12_dict['PayloadType'] = "com.apple.security.pkcs12"
-    payload_p12_dict['PayloadUUID'] = str(uuid.uuid4())
-    payload_p12_dict['PayloadIdentifier'] = "%s.config.payload.com.apple.security.pkcs12.ca-cert" % config_site.ORGANIZATION_ID_PREFIX
-    payload_p12_dict['PayloadDisplayName'] = config_munki_client.P12_CA_DISPLAY_NAME
-    payload_p12_dict['PayloadDescription'] = "CA: %s" % given_ca_cert_cn
-    payload_p12_dict['PayloadContent'] = plistlib.Data(given_ca_cert_p12_data)
-    payload_p12_dict['Password'] = given_serial
-    mobileconfig_top_dict['PayloadContent'].append(payload_p12_dict)
-    p12_server_ca = None
-
-    # Munki client prefs start with template file read by our configuration:
-    mcx_preference_settings = config_munki_client.MUNKI_CLIENT_PREFS_DICT
-    # Test for mandatory keys:
-    for key in config_munki_client.MUNKI_CLIENT_MANDATORY_KEYS:
-        try:
-            value = mcx_preference_settings[key]
-        except KeyError:
-            return None
-    # Add key overrides:
-    mcx_preference_settings['UseClientCertificate'] = True
-    mcx_preference_settings['UseClientCertificateCNAsClientIdentifier'] = False
-    mcx_preference_settings['ClientIdentifier'] = 'computers/%s' % given_serial.upper()
-    # Random password for the Munki keychain:
-    mcx_preference_settings['KeychainPassword'] = str(uuid.uuid4()).replace('-','')
-    # Set the keychain name so that it's clear it can be removed as long as the
-    # client's identity PEM file is present.
-    mcx_preference_settings['KeychainName'] = "munki-temp.keychain"
-    
-    # Munki config profile payload:
-    payload_mcx_munki_client_dict = {}
-    payload_mcx_munki_client_dict['PayloadVersion'] = int(1)
-    payload_mcx_munki_client_dict['PayloadType'] = "com.apple.ManagedClient.preferences"
-    payload_mcx_munki_client_dict['PayloadUUID'] = str(uuid.uuid4())
-    payload_mcx_munki_client_dict['PayloadIdentifier'] = "%s.config.payload.com.apple.ManagedClient.preferences.munki" % config_site.ORGANIZATION_ID_PREFIX
-    payload_mcx_munki_client_dict['PayloadDisplayName'] = config_munki_client.MUNKI_MCX_PAYLOAD_DISPLAY_NAME
-    payload_mcx_munki_client_dict['PayloadDescription'] = "Server: %s" % mcx_preference_settings['SoftwareRepoURL'].replace('https://','').replace('/','')
-    payload_mcx_munki_client_dict['PayloadContent'] = {}
-    payload_mcx_munki_client_dict['PayloadContent'][config_munki_client.MUNKI_MCX_DEFAULTS_DOMAIN] = {}
-    payload_mcx_munki_client_dict['PayloadContent'][config_munki_client.MUNKI_MCX_DEFAULTS_DOMAIN]['Forced'] = [{}]
-    payload_mcx_munki_client_dict['PayloadContent'][config_munki_client.MUNKI_MCX_DEFAULTS_DOMAIN]['Forced'][0]['mcx_preference_settings'] = mcx_preference_settings
-    mobileconfig_top_dict['PayloadContent'].append(payload_mcx_munki_client_dict)
-
-    # Return XML of the mobileconfig:
-    try:
-        return plistlib.writePlistToString(mobileconfig_top_dict)
-    except xml.parsers.expat.ExpatError:
-        return None
-    except TypeError:
+    common.logging_info_sampled("Generating configuration profile for %s.",given_serial)
+    if not given_ca_payload_data:
         return None
+    return mobileconfig.render(mobileconfig.make_values_dict(given_serial,given_ca_payload_data,given_ca_cert_cn,given_ca_payload_password))
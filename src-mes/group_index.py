@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+
+# group_index.py
+# Munki Enrollment Server
+# Index of group manifests so that transaction-a does not parse every group on every request.
+
+# Written by Gerrit DeWitt (gdewitt@gsu.edu)
+# Project started 2015-06-15.  This file created 2026-10-18.
+# Copyright Georgia State University.
+# This script uses publicly-documented methods known to those skilled in the art.
+# References: See top level Read Me.
+
+import os, stat, time, json, plistlib, xml, threading
+# Load our modules:
+import common
+# Import configuration:
+import configuration_classes as config
+config_app = config.ServerApp()
+munki_repo = config.MunkiManifests()
+
+# Index file shared by all worker processes on this server:
+SHARED_INDEX_FILE_NAME = "mes-group-index.json"
+# Key under which the groups appear in the transaction-a response:
+GROUPS_RESPONSE_KEY = 'group_manifests_array'
+
+# Index for this process.  Keys:
+#  * dir_mtime: mtime of the group manifests directory when indexed
+#  * indexed_at: time the index was built
+#  * files: dict of file name -> [mtime, size]
+#  * groups: dict of file name -> group details dict
+INDEX = None
+# Serialized groups for the response, built lazily as (index, XML string):
+SERIALIZED_GROUPS = None
+LOCK = threading.Lock()
+
+def read_group_details(given_manifest_path):
+    '''Parses a group manifest and returns a dict with its name, display_name,
+        description, and computer_name_prefix.  Returns None if the manifest is invalid.'''
+    try:
+        manifest_dict = plistlib.readPlist(given_manifest_path)
+    except (xml.parsers.expat.ExpatError,IOError):
+        # Skip manifests that cannot be parsed as plists:
+        common.logging_error("Skipping invalid group manifest: %s" % given_manifest_path)
+        return None
+    # Build dictionary representing this group:
+    group_details_dict = {}
+    # At least the name is present:
+    group_details_dict['name'] = os.path.basename(given_manifest_path)
+    # Assign defaults unless we can override them with metadata:
+    group_details_dict['display_name'] = group_details_dict['name']
+    group_details_dict['description'] = group_details_dict['name']
+    group_details_dict['computer_name_prefix'] = munki_repo.DEFAULT_COMPUTER_NAME_PREFIX
+    # Check for metadata in the manifest:
+    try:
+        manifest_metadata_dict = manifest_dict['_metadata']
+    except (KeyError,TypeError):
+        return group_details_dict
+    # Attempt to read various metadata keys:
+    for key in ['display_name','description','computer_name_prefix']:
+        try:
+            group_details_dict[key] = manifest_metadata_dict[key]
+        except (KeyError,TypeError):
+            pass
+    return group_details_dict
+
+def scan_group_files(given_dir_mtime,given_previous_index):
+    '''Returns a dict of file name -> [mtime, size] for the group manifests.
+        The directory is only listed when its mtime suggests that files were
+        added or removed; otherwise the previously indexed files are stat'd.'''
+    files_dict = {}
+    # An mtime within a second of indexing may hide a later change on
+    # filesystems with coarse timestamps, so list the directory again then:
+    if given_previous_index and given_previous_index['dir_mtime'] == given_dir_mtime and given_dir_mtime < given_previous_index['indexed_at'] - 1:
+        file_names = given_previous_index['files'].keys()
+    else:
+        file_names = os.listdir(munki_repo.GROUP_MANIFESTS_PATH)
+    for file_name in file_names:
+        # Same as glob's '*': skip hidden files:
+        if file_name.startswith('.'):
+            continue
+        try:
+            s = os.stat(os.path.join(munki_repo.GROUP_MANIFESTS_PATH,file_name))
+        except OSError:
+            continue
+        if not stat.S_ISDIR(s.st_mode):
+            files_dict[file_name] = [s.st_mtime,s.st_size]
+    return files_dict
+
+def build_index(given_dir_mtime,given_files_dict,given_previous_index):
+    '''Builds a new index, parsing only the group manifests that changed
+        since the previous index.'''
+    new_index = {}
+    new_index['dir_mtime'] = given_dir_mtime
+    new_index['indexed_at'] = time.time()
+    new_index['files'] = given_files_dict
+    new_index['groups'] = {}
+    parsed_count = 0
+    for file_name in given_files_dict:
+        if given_previous_index and given_previous_index['files'].get(file_name) == given_files_dict[file_name]:
+            if file_name in given_previous_index['groups']:
+                new_index['groups'][file_name] = given_previous_index['groups'][file_name]
+            continue
+        group_details_dict = read_group_details(os.path.join(munki_repo.GROUP_MANIFESTS_PATH,file_name))
+        parsed_count += 1
+        if group_details_dict:
+            new_index['groups'][file_name] = group_details_dict
+    common.logging_info("Indexed group manifests: %(parsed)s parsed, %(total)s total." % {'parsed':parsed_count,'total':len(given_files_dict)})
+    return new_index
+
+#PRAGMA MARK: SHARED INDEX FILE
+
+def shared_index_path():
+    '''Path of the index file shared by worker processes.'''
+    return os.path.join(config_app.TEMP_DIR,SHARED_INDEX_FILE_NAME)
+
+def read_shared_index():
+    '''Returns the index stored by another worker or None.  Only trusts a
+        file owned by this account, since TEMP_DIR may be shared.'''
+    index_path = shared_index_path()
+    try:
+        if os.stat(index_path).st_uid != os.getuid():
+            return None
+        file_object = open(index_path,'r')
+        shared_index = json.load(file_object)
+        file_object.close()
+    except (OSError,IOError,ValueError):
+        return None
+    try:
+        if shared_index['groups_path'] != munki_repo.GROUP_MANIFESTS_PATH:
+            return None
+        return shared_index
+    except (KeyError,TypeError):
+        return None
+
+def write_shared_index(given_index):
+    '''Atomically replaces the shared index file with the given index.'''
+    index_path = shared_index_path()
+    temp_path = "%(path)s.%(pid)s" % {'path':index_path,'pid':os.getpid()}
+    shared_index = dict(given_index)
+    shared_index['groups_path'] = munki_repo.GROUP_MANIFESTS_PATH
+    try:
+        fd = os.open(temp_path,os.O_WRONLY|os.O_CREAT|os.O_TRUNC,0600)
+        file_object = os.fdopen(fd,'w')
+        json.dump(shared_index,file_object)
+        file_object.close()
+        os.rename(temp_path,index_path)
+    except (OSError,IOError):
+        common.logging_error("Could not write shared group index to %s." % index_path)
+
+#PRAGMA MARK: PUBLIC METHODS
+
+def get_index():
+    '''Returns an up-to-date index of the group manifests, or None if the
+        group manifests directory is missing.'''
+    global INDEX
+    with LOCK:
+        try:
+            dir_mtime = os.stat(munki_repo.GROUP_MANIFESTS_PATH).st_mtime
+            files_dict = scan_group_files(dir_mtime,INDEX)
+        except OSError:
+            common.logging_error("Missing group manifests directory.")
+            return None
+        if INDEX and INDEX['dir_mtime'] == dir_mtime and INDEX['files'] == files_dict:
+            return INDEX
+        # Another worker may have indexed this state already:
+        shared_index = read_shared_index()
+        if shared_index and shared_index['dir_mtime'] == dir_mtime and shared_index['files'] == files_dict:
+            common.logging_info_sampled("Using shared group index.")
+            INDEX = shared_index
+        else:
+            INDEX = build_index(dir_mtime,files_dict,shared_index or INDEX)
+            write_shared_index(INDEX)
+        return INDEX
+
+def list_groups(given_index=None):
+    '''Returns an array of group detail dicts, sorted by group name.'''
+    index = given_index or get_index()
+    if not index:
+        return []
+    return [index['groups'][name] for name in sorted(index['groups'])]
+
+def serialized_groups():
+    '''Returns the plist XML for the groups as it appears inside the
+        transaction-a response dict, built once per index.'''
+    global SERIALIZED_GROUPS
+    index = get_index()
+    serialized = SERIALIZED_GROUPS
+    if serialized and serialized[0] is index:
+        return serialized[1]
+    plist_str = plistlib.writePlistToString({GROUPS_RESPONSE_KEY:list_groups(index)})
+    # Keep only the key and array lines between the top level <dict> and </dict>:
+    start = plist_str.index('<dict>\n') + len('<dict>\n')
+    end = plist_str.rindex('</dict>\n</plist>')
+    SERIALIZED_GROUPS = (index,plist_str[start:end])
+    return SERIALIZED_GROUPS[1]
+
+def write_response_with_groups(given_response_dict):
+    '''Returns the plist XML string for the given response dict with the
+        group list added under group_manifests_array.  Identical to running
+        plistlib.writePlistToString on the combined dict, but reuses the
+        serialized groups.'''
+    # plistlib sorts keys; splicing only works if the groups come last:
+    if [key for key in given_response_dict if key >= GROUPS_RESPONSE_KEY]:
+        response_dict = dict(given_response_dict)
+        response_dict[GROUPS_RESPONSE_KEY] = list_groups()
+        return plistlib.writePlistToString(response_dict)
+    plist_str = plistlib.writePlistToString(given_response_dict)
+    end = plist_str.rindex('</dict>\n</plist>')
+    return plist_str[:end] + serialized_groups() + plist_str[end:]
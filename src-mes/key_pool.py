@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+
+# key_pool.py
+# Munki Enrollment Server
+# Pool of pre-generated client private keys, refilled by background processes.
+
+# Written by Gerrit DeWitt (gdewitt@gsu.edu)
+# Project started 2015-06-15.  This file created 2026-10-18.
+# Copyright Georgia State University.
+# This script uses publicly-documented methods known to those skilled in the art.
+# References: See top level Read Me.
+
+import os, glob, time, uuid, atexit, multiprocessing, Queue
+from OpenSSL import crypto
+# Load our modules:
+import common
+import security
+# Import configuration:
+import configuration_classes as config
+config_client_pki = config.ClientCertificate()
+config_ca = config.CertificateAuthority()
+
+# Pool state for this process; set up by start():
+KEY_QUEUE = None
+REFILL_PROCESSES = []
+# Set by stop(); refill processes check it between keys:
+STOP_EVENT = None
+STARTED_AT = None
+# Keys generated by the refill processes (shared with them):
+KEYS_GENERATED = None
+# Counters for this process:
+KEYS_SERVED = 0
+KEYS_UNSEALED = 0
+FALLBACK_COUNT = 0
+
+# Seconds stop() waits for the refill processes to finish their current key:
+STOP_TIMEOUT = 30.0
+
+def refill_worker(given_queue,given_counter,given_stop_event):
+    '''Body of a refill process.  Generates keys until given_stop_event is
+        set, waiting whenever the pool is full.  Keys travel as PEM strings
+        because PKey objects cannot be pickled.'''
+    common.reset_inherited_signals()
+    common.log_synchronously()
+    while not given_stop_event.is_set():
+        key = security.generate_private_key()
+        if not key:
+            common.logging_error("Key pool refill process could not generate a key.")
+            time.sleep(1)
+            continue
+        try:
+            key_pem = crypto.dump_privatekey(crypto.FILETYPE_PEM,key)
+        except crypto.Error:
+            continue
+        # Wait for room in the pool, but not past stop():
+        while not given_stop_event.is_set():
+            try:
+                given_queue.put(key_pem,timeout=0.5)
+            except Queue.Full:
+                continue
+            with given_counter.get_lock():
+                given_counter.value += 1
+            break
+
+def start():
+    '''Starts the refill processes for this server process.  Loads any keys
+        sealed to disk by a previous stop() first.  Returns true if the pool
+        is running, false if it is disabled.'''
+    global KEY_QUEUE, REFILL_PROCESSES, STOP_EVENT, STARTED_AT, KEYS_GENERATED
+    if config_client_pki.KEY_POOL_SIZE <= 0:
+        common.logging_info("Key pool disabled; private keys will be generated inline.")
+        return False
+    if KEY_QUEUE:
+        return True
+    KEY_QUEUE = multiprocessing.Queue(config_client_pki.KEY_POOL_SIZE)
+    KEYS_GENERATED = multiprocessing.Value('L',0)
+    STOP_EVENT = multiprocessing.Event()
+    STARTED_AT = time.time()
+    unseal_keys()
+    for i in range(max(1,config_client_pki.KEY_POOL_WORKERS)):
+        p = multiprocessing.Process(target=refill_worker,args=(KEY_QUEUE,KEYS_GENERATED,STOP_EVENT))
+        p.daemon = True
+        p.start()
+        REFILL_PROCESSES.append(p)
+    common.logging_info("Key pool started: %(size)s keys, %(workers)s refill processes." % {'size':config_client_pki.KEY_POOL_SIZE,'workers':len(REFILL_PROCESSES)})
+    # Registered after multiprocessing's own exit handler, so this runs first:
+    atexit.register(stop)
+    return True
+
+def stop():
+    '''Stops the refill processes and seals any unused keys to disk
+        if a sealed key directory is configured.  The refill processes
+        are asked to stop and the queue is drained while they finish, since
+        a process that has put keys cannot exit until they are read, and
+        one terminated while putting a key could leave the queue corrupt.'''
+    global KEY_QUEUE, REFILL_PROCESSES
+    if not KEY_QUEUE:
+        return
+    common.logging_info("Key pool stopping: %s" % stats())
+    STOP_EVENT.set()
+    key_pems = drain_keys()
+    if REFILL_PROCESSES:
+        common.logging_error("Key pool refill processes did not stop within %s seconds; terminating them." % STOP_TIMEOUT)
+        # The queue may be corrupt now; nothing more is read from it:
+        for p in REFILL_PROCESSES:
+            p.terminate()
+        for p in REFILL_PROCESSES:
+            p.join(5)
+        REFILL_PROCESSES = []
+    if config_client_pki.KEY_POOL_SEALED_DIR:
+        seal_keys(key_pems)
+    KEY_QUEUE = None
+
+def drain_keys():
+    '''Takes every key from the queue until the refill processes have
+        exited, or for at most STOP_TIMEOUT seconds.  Processes that exited
+        (is_alive reaps them) are removed from REFILL_PROCESSES.
+        Returns an array of key PEMs.'''
+    global REFILL_PROCESSES
+    key_pems = []
+    deadline = time.time() + STOP_TIMEOUT
+    while True:
+        REFILL_PROCESSES = [p for p in REFILL_PROCESSES if p.is_alive()]
+        try:
+            key_pems.append(KEY_QUEUE.get(timeout=0.1))
+            continue
+        except (Queue.Empty,IOError,EOFError):
+            pass
+        # Queue empty; done once every process has exited:
+        if not REFILL_PROCESSES or time.time() > deadline:
+            break
+    return key_pems
+
+def take_key_pem():
+    '''Returns a private key from the pool as a PEM string, or None if the
+        pool is disabled or empty.  The caller generates a key itself then.'''
+    global KEYS_SERVED, FALLBACK_COUNT
+    if not KEY_QUEUE:
+        return None
+    try:
+        key_pem = KEY_QUEUE.get_nowait()
+        KEYS_SERVED += 1
+        return key_pem
+    except Queue.Empty:
+        FALLBACK_COUNT += 1
+        common.logging_info("Key pool empty; a private key will be generated for this request.")
+        return None
+
+def get_private_key():
+    '''Returns a private key from the pool.  Falls back to generating one
+        inline if the pool is disabled or empty.  Returns None if something
+        went wrong.'''
+    key_pem = take_key_pem()
+    if key_pem:
+        try:
+            return crypto.load_privatekey(crypto.FILETYPE_PEM,key_pem)
+        except crypto.Error:
+            common.logging_error("Could not load a private key from the key pool.")
+    return security.generate_private_key()
+
+def stats():
+    '''Returns a dict describing the key pool: depth, refill rate (keys
+        per second since start), and how often requests fell back to
+        inline generation.'''
+    stats_dict = {}
+    stats_dict['enabled'] = bool(KEY_QUEUE)
+    stats_dict['capacity'] = config_client_pki.KEY_POOL_SIZE
+    stats_dict['depth'] = 0
+    stats_dict['keys_generated'] = 0
+    stats_dict['refill_rate'] = 0.0
+    stats_dict['keys_served'] = KEYS_SERVED
+    stats_dict['keys_unsealed'] = KEYS_UNSEALED
+    stats_dict['fallbacks'] = FALLBACK_COUNT
+    if KEY_QUEUE:
+        try:
+            stats_dict['depth'] = KEY_QUEUE.qsize()
+        except NotImplementedError:
+            stats_dict['depth'] = -1
+        stats_dict['keys_generated'] = KEYS_GENERATED.value
+        elapsed = time.time() - STARTED_AT
+        if elapsed > 0:
+            stats_dict['refill_rate'] = round(KEYS_GENERATED.value / elapsed,3)
+    return stats_dict
+
+#PRAGMA MARK: SEALED KEYS
+
+def seal_keys(given_key_pems):
+    '''Writes the given unused keys (PEM) to the sealed key directory.  Each
+        key is written encrypted with the CA private key passphrase and
+        readable only by the MES system account.'''
+    sealed_dir = config_client_pki.KEY_POOL_SEALED_DIR
+    if not os.path.isdir(sealed_dir):
+        try:
+            os.makedirs(sealed_dir,0700)
+        except OSError:
+            common.logging_error("Could not create sealed key directory at %s." % sealed_dir)
+            return
+    sealed_count = 0
+    for key_pem in given_key_pems:
+        try:
+            key = crypto.load_privatekey(crypto.FILETYPE_PEM,key_pem)
+            sealed_pem = crypto.dump_privatekey(crypto.FILETYPE_PEM,key,'aes256',config_ca.CA_PRIVATE_KEY_PASSPHRASE)
+        except crypto.Error:
+            continue
+        sealed_path = os.path.join(sealed_dir,"key-%s.pem" % uuid.uuid4())
+        try:
+            fd = os.open(sealed_path,os.O_WRONLY|os.O_CREAT|os.O_EXCL,0600)
+            os.write(fd,sealed_pem)
+            os.close(fd)
+            sealed_count += 1
+        except OSError:
+            common.logging_error("Could not write sealed key to %s." % sealed_path)
+    common.logging_info("Sealed %(count)s unused keys to %(dir)s." % {'count':sealed_count,'dir':sealed_dir})
+
+def unseal_keys():
+    '''Moves keys sealed by a previous run into the pool.  Each file is
+        removed as soon as it is read so that no key is ever handed out twice.'''
+    global KEYS_UNSEALED
+    sealed_dir = config_client_pki.KEY_POOL_SEALED_DIR
+    if not sealed_dir or not os.path.isdir(sealed_dir):
+        return
+    for sealed_path in glob.glob(os.path.join(sealed_dir,'key-*.pem')):
+        if KEY_QUEUE.full():
+            break
+        try:
+            file_object = open(sealed_path,'r')
+            sealed_pem = file_object.read()
+            file_object.close()
+            os.remove(sealed_path)
+        except (IOError,OSError):
+            continue
+        try:
+            key = crypto.load_privatekey(crypto.FILETYPE_PEM,sealed_pem,config_ca.CA_PRIVATE_KEY_PASSPHRASE)
+            KEY_QUEUE.put_nowait(crypto.dump_privatekey(crypto.FILETYPE_PEM,key))
+            KEYS_UNSEALED += 1
+        except (crypto.Error,Queue.Full):
+            common.logging_error("Discarding unusable sealed key %s." % sealed_path)
+    if KEYS_UNSEALED:
+        common.logging_info("Loaded %(count)s sealed keys from %(dir)s." % {'count':KEYS_UNSEALED,'dir':sealed_dir})
@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+
+# ledger.py
+# Munki Enrollment Server
+# Record of the client certificates issued by the MES, kept in SQLite.
+
+# Written by Gerrit DeWitt (gdewitt@gsu.edu)
+# Project started 2015-06-15.  This file created 2026-10-18.
+# Copyright Georgia State University.
+# This script uses publicly-documented methods known to those skilled in the art.
+# References: See top level Read Me.
+
+# Each certificate is one row keyed by its certificate serial number (the
+# table's rowid), with indexes on machine serial, fingerprint and notAfter,
+# so lookups stay O(log n) as the ledger grows.  Certificate serials are
+# reserved from the ledger in blocks, so concurrent MES processes never
+# issue the same serial, and issuances are written in batches by a
+# background thread so that requests do not wait on the database.
+
+import os, time, atexit, sqlite3, threading
+# Load our modules:
+import common
+# Import configuration:
+import configuration_classes as config
+config_ca = config.CertificateAuthority()
+
+SCHEMA_STATEMENTS = ["CREATE TABLE IF NOT EXISTS certificates (cert_serial INTEGER PRIMARY KEY, machine_serial TEXT NOT NULL, fingerprint TEXT NOT NULL, not_before INTEGER, not_after INTEGER, issued_at INTEGER NOT NULL, revoked_at INTEGER, revocation_reason TEXT)",
+                     "CREATE INDEX IF NOT EXISTS certificates_machine_serial ON certificates (machine_serial)",
+                     "CREATE UNIQUE INDEX IF NOT EXISTS certificates_fingerprint ON certificates (fingerprint)",
+                     "CREATE INDEX IF NOT EXISTS certificates_not_after ON certificates (not_after)",
+                     "CREATE TABLE IF NOT EXISTS serial_allocator (id INTEGER PRIMARY KEY CHECK (id = 1), next_serial INTEGER NOT NULL)",
+                     "INSERT OR IGNORE INTO serial_allocator (id, next_serial) VALUES (1, 1)",
+                     # Revocations in the order they were made; seq lets readers fetch only new ones:
+                     "CREATE TABLE IF NOT EXISTS revocations (seq INTEGER PRIMARY KEY AUTOINCREMENT, cert_serial INTEGER NOT NULL UNIQUE, revoked_at INTEGER NOT NULL, reason TEXT)"]
+CERTIFICATE_COLUMNS = ['cert_serial','machine_serial','fingerprint','not_before','not_after','issued_at','revoked_at','revocation_reason']
+
+# State for this process; reset after a fork:
+STATE_PID = None
+CONNECTION = None
+# Reserved serials: next one to hand out and the end of the block (exclusive):
+NEXT_SERIAL = 0
+SERIAL_BLOCK_END = 0
+# Issuances waiting to be written, and the thread writing them:
+PENDING_ROWS = []
+WRITER_THREAD = None
+WRITER_WAKE = threading.Event()
+WRITER_STOPPING = False
+LOCK = threading.RLock()
+# Counters for this process:
+ROWS_WRITTEN = 0
+BATCHES_WRITTEN = 0
+
+def is_enabled():
+    '''Returns true if a ledger_path is configured.'''
+    return bool(config_ca.LEDGER_PATH)
+
+def get_connection():
+    '''Returns this process's connection to the ledger, opening it (and
+        creating the schema) on first use.  Returns None if the ledger is
+        disabled or cannot be opened.  Call with LOCK held.'''
+    global STATE_PID, CONNECTION, NEXT_SERIAL, SERIAL_BLOCK_END, PENDING_ROWS, WRITER_THREAD
+    if not is_enabled():
+        return None
+    if STATE_PID != os.getpid():
+        # New process (or forked child): nothing is shared with the parent.
+        STATE_PID = os.getpid()
+        CONNECTION = None
+        NEXT_SERIAL = SERIAL_BLOCK_END = 0
+        PENDING_ROWS = []
+        WRITER_THREAD = None
+    if CONNECTION:
+        return CONNECTION
+    try:
+        # Transactions are begun explicitly (isolation_level=None), and the
+        # connection is shared by the threads of this process under LOCK:
+        CONNECTION = sqlite3.connect(config_ca.LEDGER_PATH,timeout=30,isolation_level=None,check_same_thread=False)
+        # Readers do not block the writer, and writers from several MES
+        # processes wait for each other rather than failing:
+        CONNECTION.execute("PRAGMA journal_mode=WAL")
+        CONNECTION.execute("PRAGMA synchronous=NORMAL")
+        run_transaction(CONNECTION,SCHEMA_STATEMENTS)
+    except sqlite3.Error as e:
+        common.logging_error("Could not open issuance ledger at %(path)s: %(error)s" % {'path':config_ca.LEDGER_PATH,'error':str(e)})
+        CONNECTION = None
+    return CONNECTION
+
+def run_transaction(given_connection,given_statements):
+    '''Runs the given statements in one write transaction.  Each item is a
+        SQL string or a (SQL string, parameters) tuple.  Returns the cursor
+        of the last statement.  Raises sqlite3.Error after rolling back if
+        any statement fails.'''
+    cursor = None
+    # BEGIN IMMEDIATE takes the write lock before anything is read:
+    given_connection.execute("BEGIN IMMEDIATE")
+    try:
+        for statement in given_statements:
+            if isinstance(statement,tuple):
+                cursor = given_connection.execute(*statement)
+            else:
+                cursor = given_connection.execute(statement)
+        given_connection.execute("COMMIT")
+    except sqlite3.Error:
+        given_connection.execute("ROLLBACK")
+        raise
+    return cursor
+
+#PRAGMA MARK: SERIAL NUMBERS
+
+def reserve_serial_block(given_connection):
+    '''Reserves the next block of serials for this process.
+        Returns (first serial, end of block) or None.'''
+    block_size = max(1,config_ca.LEDGER_SERIAL_BLOCK)
+    try:
+        # The update and read happen in one write transaction, so two
+        # processes cannot reserve the same block:
+        cursor = run_transaction(given_connection,[("UPDATE serial_allocator SET next_serial = next_serial + ? WHERE id = 1",(block_size,)),
+                                                   "SELECT next_serial FROM serial_allocator WHERE id = 1"])
+        block_end = cursor.fetchone()[0]
+    except sqlite3.Error as e:
+        common.logging_error("Could not reserve certificate serials: %s" % str(e))
+        return None
+    return block_end - block_size,block_end
+
+def allocate_serial():
+    '''Returns a certificate serial number no other certificate from this
+        CA has used, or None if the ledger is disabled or unavailable.
+        Serials increase within each process.'''
+    global NEXT_SERIAL, SERIAL_BLOCK_END
+    with LOCK:
+        connection = get_connection()
+        if not connection:
+            return None
+        if NEXT_SERIAL >= SERIAL_BLOCK_END:
+            block = reserve_serial_block(connection)
+            if not block:
+                return None
+            NEXT_SERIAL,SERIAL_BLOCK_END = block
+        serial_number = NEXT_SERIAL
+        NEXT_SERIAL += 1
+        return serial_number
+
+#PRAGMA MARK: RECORDING
+
+def record_issuance(given_cert_serial,given_machine_serial,given_fingerprint,given_not_before,given_not_after):
+    '''Queues a row for an issued certificate.  Rows are written in batches
+        of ledger_batch_size, or after ledger_flush_interval seconds.'''
+    with LOCK:
+        if not get_connection():
+            return
+        PENDING_ROWS.append((given_cert_serial,given_machine_serial.upper(),given_fingerprint.lower(),given_not_before,given_not_after,int(time.time())))
+        start_writer()
+        if len(PENDING_ROWS) >= config_ca.LEDGER_BATCH_SIZE:
+            WRITER_WAKE.set()
+
+def start_writer():
+    '''Starts the thread writing batches for this process.  Call with LOCK held.'''
+    global WRITER_THREAD
+    if WRITER_THREAD and WRITER_THREAD.is_alive():
+        return
+    WRITER_THREAD = threading.Thread(target=writer_loop,name="ledger-writer")
+    WRITER_THREAD.daemon = True
+    WRITER_THREAD.start()
+
+def writer_loop():
+    '''Body of the writer thread.  Returns once stop_writer is called.'''
+    while not WRITER_STOPPING:
+        WRITER_WAKE.wait(config_ca.LEDGER_FLUSH_INTERVAL)
+        WRITER_WAKE.clear()
+        flush()
+
+def stop_writer():
+    '''Runs at exit: stops the writer thread before the interpreter tears
+        down the modules it uses, then writes any rows still queued.'''
+    global WRITER_STOPPING
+    WRITER_STOPPING = True
+    WRITER_WAKE.set()
+    writer_thread = WRITER_THREAD
+    if writer_thread and writer_thread.is_alive():
+        writer_thread.join(5)
+    flush()
+
+def flush():
+    '''Writes queued rows in one transaction.  Rows stay queued if the
+        write fails and are retried with the next batch.'''
+    global PENDING_ROWS, ROWS_WRITTEN, BATCHES_WRITTEN
+    with LOCK:
+        if not PENDING_ROWS or STATE_PID != os.getpid():
+            return
+        connection = get_connection()
+        if not connection:
+            return
+        rows = PENDING_ROWS
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                connection.executemany("INSERT OR REPLACE INTO certificates (cert_serial, machine_serial, fingerprint, not_before, not_after, issued_at) VALUES (?, ?, ?, ?, ?, ?)",rows)
+                connection.execute("COMMIT")
+            except sqlite3.Error:
+                connection.execute("ROLLBACK")
+                raise
+        except sqlite3.Error as e:
+            common.logging_error("Could not write %(count)s issuance records; will retry: %(error)s" % {'count':len(rows),'error':str(e)})
+            return
+        PENDING_ROWS = []
+        ROWS_WRITTEN += len(rows)
+        BATCHES_WRITTEN += 1
+
+# Write anything still queued when the process exits:
+atexit.register(stop_writer)
+
+#PRAGMA MARK: LOOKUPS
+
+def query_certificates(given_where_clause,given_parameters):
+    '''Returns rows of the certificates table matching the given clause as
+        an array of dicts, newest first.  Queued rows are written first.'''
+    flush()
+    with LOCK:
+        connection = get_connection()
+        if not connection:
+            return []
+        try:
+            cursor = connection.execute("SELECT %(columns)s FROM certificates WHERE %(where)s ORDER BY cert_serial DESC" % {'columns':', '.join(CERTIFICATE_COLUMNS),'where':given_where_clause},given_parameters)
+            return [dict(zip(CERTIFICATE_COLUMNS,row)) for row in cursor.fetchall()]
+        except sqlite3.Error as e:
+            common.logging_error("Could not read issuance ledger: %s" % str(e))
+            return []
+
+def find_by_machine_serial(given_machine_serial):
+    '''Returns every certificate issued to the given machine serial.'''
+    return query_certificates("machine_serial = ?",(given_machine_serial.upper(),))
+
+def find_by_fingerprint(given_fingerprint):
+    '''Returns the certificate with the given SHA-256 fingerprint (an array of
+        at most one dict).'''
+    return query_certificates("fingerprint = ?",(given_fingerprint.lower(),))
+
+def find_by_cert_serial(given_cert_serial):
+    '''Returns the certificate with the given serial number (an array of
+        at most one dict).'''
+    return query_certificates("cert_serial = ?",(given_cert_serial,))
+
+def find_expiring(given_before_time,given_after_time=0):
+    '''Returns certificates whose notAfter falls in the given range of
+        times (seconds since the epoch).'''
+    return query_certificates("not_after >= ? AND not_after < ?",(given_after_time,given_before_time))
+
+#PRAGMA MARK: REVOCATION
+
+def revoke(given_cert_serial,given_reason=None):
+    '''Revokes the certificate with the given serial number.  Returns true
+        if it was revoked now, false if it was already revoked, is not in the
+        ledger, or the ledger is unavailable.'''
+    flush()
+    revoked_at = int(time.time())
+    with LOCK:
+        connection = get_connection()
+        if not connection:
+            return False
+        try:
+            cursor = run_transaction(connection,[("INSERT OR IGNORE INTO revocations (cert_serial, revoked_at, reason) SELECT cert_serial, ?, ? FROM certificates WHERE cert_serial = ?",(revoked_at,given_reason,given_cert_serial)),
+                                                 ("UPDATE certificates SET revoked_at = ?, revocation_reason = ? WHERE cert_serial = ? AND revoked_at IS NULL",(revoked_at,given_reason,given_cert_serial))])
+        except sqlite3.Error as e:
+            common.logging_error("Could not revoke certificate %(serial)s: %(error)s" % {'serial':given_cert_serial,'error':str(e)})
+            return False
+    if cursor.rowcount != 1:
+        return False
+    common.logging_info("Revoked certificate %(serial)s (%(reason)s)." % {'serial':given_cert_serial,'reason':given_reason or 'unspecified'})
+    return True
+
+def revocation_version():
+    '''Returns the sequence number of the latest revocation (0 if none),
+        or None if the ledger is unavailable.'''
+    with LOCK:
+        connection = get_connection()
+        if not connection:
+            return None
+        try:
+            return connection.execute("SELECT COALESCE(MAX(seq), 0) FROM revocations").fetchone()[0]
+        except sqlite3.Error as e:
+            common.logging_error("Could not read revocations: %s" % str(e))
+            return None
+
+def revocations_since(given_seq):
+    '''Returns revocations made after the given sequence number, oldest
+        first, as an array of dicts with seq, cert_serial, revoked_at, reason
+        and not_after.  Returns None if the ledger is unavailable.'''
+    with LOCK:
+        connection = get_connection()
+        if not connection:
+            return None
+        try:
+            cursor = connection.execute("SELECT r.seq, r.cert_serial, r.revoked_at, r.reason, c.not_after FROM revocations r LEFT JOIN certificates c ON c.cert_serial = r.cert_serial WHERE r.seq > ? ORDER BY r.seq",(given_seq,))
+            return [dict(zip(['seq','cert_serial','revoked_at','reason','not_after'],row)) for row in cursor.fetchall()]
+        except sqlite3.Error as e:
+            common.logging_error("Could not read revocations: %s" % str(e))
+            return None
+
+def stats():
+    '''Returns a dict with counters for this process.'''
+    stats_dict = {}
+    stats_dict['enabled'] = is_enabled()
+    stats_dict['pending'] = len(PENDING_ROWS)
+    stats_dict['rows_written'] = ROWS_WRITTEN
+    stats_dict['batches_written'] = BATCHES_WRITTEN
+    stats_dict['serials_left_in_block'] = max(0,SERIAL_BLOCK_END - NEXT_SERIAL)
+    return stats_dict
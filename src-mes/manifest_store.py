@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+
+# manifest_store.py
+# Munki Enrollment Server
+# Cached reads and atomic, locked writes for manifests in the Munki repository.
+
+# Written by Gerrit DeWitt (gdewitt@gsu.edu)
+# Project started 2015-06-15.  This file created 2026-10-18.
+# Copyright Georgia State University.
+# This script uses publicly-documented methods known to those skilled in the art.
+# References: See top level Read Me.
+
+import os, stat, copy, fcntl, hashlib, plistlib, threading, collections, xml
+# Load our modules:
+import common
+import metrics
+# Import configuration:
+import configuration_classes as config
+config_app = config.ServerApp()
+munki_repo = config.MunkiManifests()
+
+# Lock files live on the local filesystem rather than in the repository,
+# so they serialize the MES processes on this server:
+LOCK_DIR_NAME = "mes-manifest-locks"
+
+# LRU cache of path -> (signature, manifest dict), least recently used first.
+# The signature is (mtime, size, inode) of the file the dict was read from.
+CACHE = collections.OrderedDict()
+CACHE_HITS = 0
+CACHE_MISSES = 0
+LOCK = threading.Lock()
+# Directories with renames not yet synced, while directory syncs are
+# deferred (see defer_directory_syncs); None when each write syncs its own:
+DEFERRED_SYNC_DIRS = None
+
+def manifest_signature(given_manifest_path):
+    '''Returns (mtime, size, inode) for the given path or None if it does not exist.'''
+    try:
+        s = os.stat(given_manifest_path)
+    except OSError:
+        return None
+    return (s.st_mtime,s.st_size,s.st_ino)
+
+def cache_store(given_manifest_path,given_signature,given_manifest_dict):
+    '''Adds or refreshes a cache entry, evicting the least recently used
+        entries beyond the configured size.'''
+    with LOCK:
+        CACHE.pop(given_manifest_path,None)
+        if munki_repo.MANIFEST_CACHE_SIZE <= 0 or not given_signature:
+            return
+        CACHE[given_manifest_path] = (given_signature,given_manifest_dict)
+        while len(CACHE) > munki_repo.MANIFEST_CACHE_SIZE:
+            CACHE.popitem(last=False)
+
+def read_manifest(given_manifest_path):
+    '''Returns a copy of the manifest dict stored at the given path, or None
+        if there is no file there.  Serves unchanged files from the cache.
+        Raises xml.parsers.expat.ExpatError if the file is not a valid plist.'''
+    global CACHE_HITS, CACHE_MISSES
+    signature = manifest_signature(given_manifest_path)
+    if not signature:
+        with LOCK:
+            CACHE.pop(given_manifest_path,None)
+        return None
+    with LOCK:
+        entry = CACHE.pop(given_manifest_path,None)
+        if entry and entry[0] == signature:
+            CACHE[given_manifest_path] = entry
+            CACHE_HITS += 1
+            return copy.deepcopy(entry[1])
+        CACHE_MISSES += 1
+    with metrics.timer('mes_manifest_io_seconds',(('operation','read'),)):
+        manifest_dict = plistlib.readPlist(given_manifest_path)
+    cache_store(given_manifest_path,signature,manifest_dict)
+    return copy.deepcopy(manifest_dict)
+
+def write_manifest(given_manifest_dict,given_manifest_path):
+    '''Atomically replaces the manifest at the given path and updates the
+        cache to match.  The plist is written to a temporary file in the same
+        directory, synced, and renamed over the manifest, so readers never see
+        a partial file.  Raises TypeError if the dict cannot be written as a
+        plist or IOError/OSError if the file cannot be written.'''
+    manifest_dir = os.path.dirname(given_manifest_path)
+    temp_path = os.path.join(manifest_dir,".%(name)s.mes-%(pid)s-%(thread)s" % {'name':os.path.basename(given_manifest_path),'pid':os.getpid(),'thread':threading.current_thread().ident})
+    with LOCK:
+        CACHE.pop(given_manifest_path,None)
+    try:
+        file_object = open(temp_path,'w')
+        try:
+            plistlib.writePlist(given_manifest_dict,file_object)
+            file_object.flush()
+            os.fsync(file_object.fileno())
+        finally:
+            file_object.close()
+        # Keep the permissions of the manifest being replaced:
+        try:
+            os.chmod(temp_path,stat.S_IMODE(os.stat(given_manifest_path).st_mode))
+        except OSError:
+            pass
+        os.rename(temp_path,given_manifest_path)
+    except:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+    directory_changed(manifest_dir)
+    cache_store(given_manifest_path,manifest_signature(given_manifest_path),copy.deepcopy(given_manifest_dict))
+
+def sync_directory(given_dir_path):
+    '''Flushes a directory entry change (such as a rename) to disk.'''
+    try:
+        fd = os.open(given_dir_path,os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
+
+def directory_changed(given_dir_path):
+    '''Syncs a directory after a rename in it, or notes it for
+        flush_directory_syncs while directory syncs are deferred.'''
+    with LOCK:
+        deferred = DEFERRED_SYNC_DIRS is not None
+        if deferred:
+            DEFERRED_SYNC_DIRS.add(given_dir_path)
+    if not deferred:
+        sync_directory(given_dir_path)
+
+def defer_directory_syncs():
+    '''Makes write_manifest leave the directory sync after each rename to
+        flush_directory_syncs, for tools writing many manifests at once.
+        A manifest written since the last flush may be lost in a crash.'''
+    global DEFERRED_SYNC_DIRS
+    with LOCK:
+        if DEFERRED_SYNC_DIRS is None:
+            DEFERRED_SYNC_DIRS = set()
+
+def flush_directory_syncs():
+    '''Syncs each directory written to since the last flush once.
+        Returns the number of directories synced.'''
+    global DEFERRED_SYNC_DIRS
+    with LOCK:
+        if not DEFERRED_SYNC_DIRS:
+            return 0
+        dir_paths = DEFERRED_SYNC_DIRS
+        DEFERRED_SYNC_DIRS = set()
+    for dir_path in dir_paths:
+        sync_directory(dir_path)
+    return len(dir_paths)
+
+#PRAGMA MARK: TRANSACTIONS
+
+def acquire_manifest_lock(given_manifest_path):
+    '''Takes an exclusive lock for the given manifest, waiting if another
+        process or thread holds it.  Returns the open lock file.'''
+    lock_dir = os.path.join(config_app.TEMP_DIR,LOCK_DIR_NAME)
+    if not os.path.isdir(lock_dir):
+        try:
+            os.makedirs(lock_dir,0700)
+        except OSError:
+            pass # created by another process
+    lock_path = os.path.join(lock_dir,"%s.lock" % hashlib.sha1(given_manifest_path).hexdigest())
+    lock_file = open(lock_path,'a')
+    fcntl.flock(lock_file.fileno(),fcntl.LOCK_EX)
+    return lock_file
+
+def release_manifest_lock(given_lock_file):
+    '''Releases a lock taken with acquire_manifest_lock.'''
+    try:
+        fcntl.flock(given_lock_file.fileno(),fcntl.LOCK_UN)
+    finally:
+        given_lock_file.close()
+
+class ManifestTransaction(object):
+    '''A locked read/modify/write of one manifest, used as a context manager:
+        with ManifestTransaction(path) as transaction:
+            transaction.manifest['key'] = value
+        On entry, manifest is a copy of the manifest dict, or None if the file is
+        missing (exists is False) or invalid (invalid is True).  On a normal exit
+        the manifest is written once, atomically, and only if it changed.
+        If the path is a symlink (left when a manifest is moved; see
+        manifests.move_computer_manifest), the file it points to is locked
+        and written, so the symlink stays in place.'''
+    def __init__(self,given_manifest_path):
+        self.path = given_manifest_path
+        self.manifest = None
+        self.exists = False
+        self.invalid = False
+        self.written = False
+        self.original_manifest = None
+        self.lock_file = None
+
+    def __enter__(self):
+        with metrics.timer('mes_manifest_io_seconds',(('operation','lock'),)):
+            while True:
+                real_path = os.path.realpath(self.path)
+                self.lock_file = acquire_manifest_lock(real_path)
+                # Moved while we waited for the lock; lock where it is now:
+                if os.path.realpath(self.path) == real_path:
+                    break
+                release_manifest_lock(self.lock_file)
+        self.path = real_path
+        try:
+            self.manifest = read_manifest(self.path)
+            self.exists = self.manifest is not None
+        except xml.parsers.expat.ExpatError:
+            self.exists = True
+            self.invalid = True
+        except:
+            release_manifest_lock(self.lock_file)
+            raise
+        self.original_manifest = copy.deepcopy(self.manifest)
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        try:
+            if exc_type is None and self.manifest is not None and (self.invalid or self.manifest != self.original_manifest):
+                with metrics.timer('mes_manifest_io_seconds',(('operation','write'),)):
+                    write_manifest(self.manifest,self.path)
+                self.written = True
+            elif exc_type is None:
+                common.logging_info_sampled("Manifest at %s unchanged; not rewriting it.",self.path)
+        finally:
+            release_manifest_lock(self.lock_file)
+        return False
+
+def stats():
+    '''Returns a dict with cache hit and miss counters and the current size.'''
+    stats_dict = {}
+    stats_dict['hits'] = CACHE_HITS
+    stats_dict['misses'] = CACHE_MISSES
+    stats_dict['entries'] = len(CACHE)
+    stats_dict['capacity'] = munki_repo.MANIFEST_CACHE_SIZE
+    return stats_dict
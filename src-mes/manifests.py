@@ -6,18 +6,128 @@
 
 # Written by Gerrit DeWitt (gdewitt@gsu.edu)
 # Project started 2015-06-15.  This file created 2015-07-24.
-# 2016-09-19, 2016-10-11.
+# 2016-09-19, 2016-10-11, 2026-10-18.
 # Copyright Georgia State University.
 # This script uses publicly-documented methods known to those skilled in the art.
 # References: See top level Read Me.
 
-import os, plistlib, xml, glob
+import os, errno, shutil, filecmp, xml
 # Load our modules:
 import common
+import group_index
+import manifest_store
 # Import configuration:
 import configuration_classes as config
 munki_repo = config.MunkiManifests()
 
+#PRAGMA MARK: COMPUTER MANIFEST LAYOUT
+
+def computer_manifest_relative_path(given_serial,given_shard_levels=None,given_shard_width=None):
+    '''Returns the path of a computer manifest relative to the computer manifests
+        directory: the serial, under computer_shard_levels directories named for
+        its leading characters (C0/2X/C02XXXXXXXXX with two levels of width two).
+        Serials too short to fill the levels are padded with underscores.'''
+    shard_levels = given_shard_levels
+    if shard_levels is None:
+        shard_levels = munki_repo.COMPUTER_SHARD_LEVELS
+    shard_width = given_shard_width or munki_repo.COMPUTER_SHARD_WIDTH
+    computer_manifest_name = given_serial.upper()
+    padded_name = computer_manifest_name.ljust(shard_levels*shard_width,'_')
+    path_parts = [padded_name[i*shard_width:(i+1)*shard_width] for i in range(shard_levels)]
+    path_parts.append(computer_manifest_name)
+    return os.path.join(*path_parts)
+
+def get_computer_manifest_path(given_serial):
+    '''Returns where the manifest for the given serial belongs in the configured layout.'''
+    return os.path.join(munki_repo.COMPUTER_MANIFESTS_PATH,computer_manifest_relative_path(given_serial))
+
+def find_computer_manifest_path(given_serial):
+    '''Returns the path of the existing manifest for the given serial: where it
+        belongs in the configured layout or, in a repository not yet resharded,
+        directly in the computer manifests directory.  Returns where it belongs
+        if there is no manifest.'''
+    computer_manifest_path = get_computer_manifest_path(given_serial)
+    if munki_repo.COMPUTER_SHARD_LEVELS and not os.path.lexists(computer_manifest_path):
+        flat_path = os.path.join(munki_repo.COMPUTER_MANIFESTS_PATH,given_serial.upper())
+        if os.path.exists(flat_path):
+            return flat_path
+    return computer_manifest_path
+
+def client_identifier(given_serial):
+    '''Returns the Munki ClientIdentifier for the given serial: the path of its
+        manifest relative to the manifests directory, e.g. computers/C0/2X/C02XXXXXXXXX.'''
+    path_parts = [munki_repo.COMPUTER_MANIFESTS_DIRNAME]
+    path_parts.extend(computer_manifest_relative_path(given_serial).split(os.sep))
+    return '/'.join(path_parts)
+
+def move_computer_manifest(given_source_path,given_target_path):
+    '''Moves a computer manifest while the MES and the web server use it,
+        leaving a relative symlink at the old path for clients whose
+        ClientIdentifier names it.  The manifest is hard-linked (or copied)
+        to the new path before the old path is atomically replaced by the
+        symlink, so it can be read at both paths throughout; both manifest
+        locks are held meanwhile.  Returns "moved", "linked" (the same
+        manifest was already at the new path), "conflict" (a different
+        manifest is at the new path; nothing changed), or None if there is
+        no manifest file at the old path or it could not be moved.'''
+    source_path = os.path.realpath(given_source_path)
+    # The target may be a symlink to the source, left by an earlier move the other way:
+    target_path = os.path.join(os.path.realpath(os.path.dirname(given_target_path)),os.path.basename(given_target_path))
+    if source_path == target_path:
+        return None
+    source_lock_file = manifest_store.acquire_manifest_lock(source_path)
+    try:
+        target_lock_file = manifest_store.acquire_manifest_lock(target_path)
+        try:
+            # Already moved (or never a file) while we waited:
+            if os.path.islink(source_path) or not os.path.isfile(source_path):
+                return None
+            result = "moved"
+            if os.path.lexists(target_path) and os.path.realpath(target_path) != source_path:
+                if not filecmp.cmp(source_path,target_path,shallow=False):
+                    common.logging_error("Not moving %(source)s: a different manifest is at %(target)s." % {'source':source_path,'target':target_path})
+                    return "conflict"
+                result = "linked"
+            else:
+                target_dir = os.path.dirname(target_path)
+                if not os.path.isdir(target_dir):
+                    try:
+                        os.makedirs(target_dir)
+                    except OSError as e:
+                        if e.errno != errno.EEXIST:
+                            raise
+                temp_path = os.path.join(target_dir,".%(name)s.mes-%(pid)s" % {'name':os.path.basename(target_path),'pid':os.getpid()})
+                try:
+                    os.link(source_path,temp_path)
+                except OSError:
+                    # No hard links on this filesystem; copy instead:
+                    shutil.copy2(source_path,temp_path)
+                os.rename(temp_path,target_path)
+                manifest_store.directory_changed(target_dir)
+            # Replace the old path with a symlink in one rename:
+            source_dir = os.path.dirname(source_path)
+            link_path = os.path.join(source_dir,".%(name)s.mes-link-%(pid)s" % {'name':os.path.basename(source_path),'pid':os.getpid()})
+            try:
+                os.symlink(os.path.relpath(target_path,source_dir),link_path)
+                os.rename(link_path,source_path)
+            except OSError:
+                try:
+                    os.remove(link_path)
+                except OSError:
+                    pass
+                raise
+            manifest_store.directory_changed(source_dir)
+            return result
+        finally:
+            manifest_store.release_manifest_lock(target_lock_file)
+    except (IOError,OSError) as e:
+        common.logging_error("Could not move %(source)s to %(target)s: %(error)s" % {'source':source_path,'target':target_path,'error':e})
+        return None
+    finally:
+        manifest_store.release_manifest_lock(source_lock_file)
+
+#PRAGMA MARK: COMPUTER MANIFESTS
+
 def get_computer_manifest_details(given_computer_manifest_name):
     '''Checks for the presence and validity of an existing manifest for this client in the repository.
         Reads name from the metadata and group from the included_manifest key.'''
@@ -28,15 +138,14 @@ def get_computer_manifest_details(given_computer_manifest_name):
     included_manifests = []
     computer_manifest_details_dict['group'] = ''
     associated_group_valid = False
-    # Check for this computer's manifest:
-    computer_manifest_path = os.path.join(munki_repo.COMPUTER_MANIFESTS_PATH,given_computer_manifest_name)
-    if os.path.exists(computer_manifest_path):
-    # Read the manifest:
-        try:
-            computer_manifest_dict = plistlib.readPlist(computer_manifest_path)
+    # Check for and read this computer's manifest:
+    computer_manifest_path = find_computer_manifest_path(given_computer_manifest_name)
+    try:
+        computer_manifest_dict = manifest_store.read_manifest(computer_manifest_path)
+        if computer_manifest_dict is not None:
             computer_manifest_details_dict['exists'] = True
-        except xml.parsers.expat.ExpatError:
-            pass
+    except xml.parsers.expat.ExpatError:
+        pass
     # Read name and included_manifests key:
     if computer_manifest_details_dict['exists']:
         try:
@@ -58,13 +167,12 @@ def get_computer_manifest_details(given_computer_manifest_name):
     # Validate associated group:
     if computer_manifest_details_dict['group']:
         group_manifest_path = os.path.join(munki_repo.GROUP_MANIFESTS_PATH, computer_manifest_details_dict['group'])
-        if os.path.exists(group_manifest_path):
-            try:
-                group_manifest_dict = plistlib.readPlist(group_manifest_path)
-                if group_manifest_dict:
-                    associated_group_valid = True
-            except xml.parsers.expat.ExpatError:
-                pass
+        try:
+            group_manifest_dict = manifest_store.read_manifest(group_manifest_path)
+            if group_manifest_dict:
+                associated_group_valid = True
+        except xml.parsers.expat.ExpatError:
+            pass
     if not associated_group_valid:
         computer_manifest_details_dict['group'] = ''
     # Return:
@@ -75,183 +183,132 @@ def make_computer_manifest(given_serial):
         Creates a new manifest if an existing one is not found or is invalid.'''
     # Filesystem path for this computer's manifest:
     computer_manifest_name = given_serial.upper() # if not already
-    computer_manifest_path = os.path.join(munki_repo.COMPUTER_MANIFESTS_PATH,computer_manifest_name)
-    # Control variable: should a new manifest be created?
-    # Assume yes, unless an existing manifest is found and is valid.
-    should_create_new_client_manifest = True
-
+    computer_manifest_path = get_computer_manifest_path(computer_manifest_name)
     # Catch missing computer manifests directory:
     if not os.path.exists(munki_repo.COMPUTER_MANIFESTS_PATH):
         common.logging_error("Computers manifests directory not found at %s." % munki_repo.COMPUTER_MANIFESTS_PATH)
         raise
-    
-    # Check existing manifest for this client:
-    if os.path.exists(computer_manifest_path):
-        common.logging_info("Manifest for %s already in repository. Checking it." % computer_manifest_name)
-        try:
-            computer_manifest_dict = plistlib.readPlist(computer_manifest_path)
-            # Manifest already exists; do not overwrite if it's a valid dict!
-            if computer_manifest_dict:
-                should_create_new_client_manifest = False
-                common.logging_info("Manifest for %s should be left alone." % computer_manifest_name)
-        except xml.parsers.expat.ExpatError:
-            common.logging_error("Manifest for %s is invalid. Will recreate." % computer_manifest_name)
+    if munki_repo.COMPUTER_SHARD_LEVELS:
+        # Manifest not resharded yet: move it now, since the ClientIdentifier
+        # in the new profile names the sharded path:
+        existing_path = find_computer_manifest_path(computer_manifest_name)
+        if existing_path != computer_manifest_path:
+            move_computer_manifest(existing_path,computer_manifest_path)
+        computer_manifest_dir = os.path.dirname(computer_manifest_path)
+        if not os.path.isdir(computer_manifest_dir):
+            try:
+                os.makedirs(computer_manifest_dir)
+            except OSError:
+                pass # created by another process
 
-    # Build a new client manifest if required:
-    if should_create_new_client_manifest:
-        common.logging_info("Creating new manifest for %s." % computer_manifest_name)
-        computer_manifest_dict = {}
-        computer_manifest_dict['managed_installs'] = []
-        computer_manifest_dict['managed_uninstalls'] = []
-        computer_manifest_dict['catalogs'] = munki_repo.CATALOG_ARRAY
-        computer_manifest_dict['included_manifests'] = ['groups/%s' % munki_repo.DEFAULT_GROUP]
-        try:
-            plistlib.writePlist(computer_manifest_dict,computer_manifest_path)
-        except TypeError:
-            common.logging_error("Failed to write manifest for %s." % computer_manifest_name)
+    # Check existing manifest for this client and build a new one if required.
+    # The transaction holds the manifest lock, so simultaneous enrollments
+    # for the same serial cannot both create it:
+    try:
+        with manifest_store.ManifestTransaction(computer_manifest_path) as transaction:
+            # Manifest already exists; do not overwrite if it's a valid dict!
+            if transaction.manifest:
+                common.logging_info("Manifest for %s already in repository and should be left alone.",computer_manifest_name)
+            else:
+                if transaction.invalid:
+                    common.logging_error("Manifest for %s is invalid. Will recreate." % computer_manifest_name)
+                common.logging_info("Creating new manifest for %s.",computer_manifest_name)
+                computer_manifest_dict = {}
+                computer_manifest_dict['managed_installs'] = []
+                computer_manifest_dict['managed_uninstalls'] = []
+                computer_manifest_dict['catalogs'] = list(munki_repo.CATALOG_ARRAY)
+                computer_manifest_dict['included_manifests'] = ['groups/%s' % munki_repo.DEFAULT_GROUP]
+                transaction.manifest = computer_manifest_dict
+    except (TypeError,IOError,OSError):
+        common.logging_error("Failed to write manifest for %s." % computer_manifest_name)
 
 def list_group_manifests():
-    '''Scans the munki repository for manifests that we designate as computer groups.
+    '''Lists the manifests in the munki repository that we designate as computer groups.
+        Details come from the group index, which only re-reads manifests that changed.
         Returns an array of dictionaries, each dict representing a group.'''
-    # Catch missing manifests path:
-    if not os.path.exists(munki_repo.GROUP_MANIFESTS_PATH):
-        common.logging_error("Missing group manifests directory.")
-        return False, [] # empty list
-    path_glob = '%s/*' % str(munki_repo.GROUP_MANIFESTS_PATH)
-    common.logging_info("Listing group manifests: %s" % path_glob)
-    try:
-        search_results_path_array = glob.glob(path_glob)
-    except:
-        common.logging_error("Glob error while listing group manifests directory.")
-        return False, [] # empty list
-    # Go through the returned group manifests, validating them and reading metadata:
-    groups_array = []
-    for manifest_path in search_results_path_array:
-        try:
-            manifest_dict = plistlib.readPlist(manifest_path)
-            have_valid_manifest = True
-        except xml.parsers.expat.ExpatError:
-            # Skip manifests that cannot be parsed as plists:
-            common.logging_error("Skipping invalid group manifest: %s" % manifest_path)
-            have_valid_manifest = False
-            pass
-        if have_valid_manifest:
-            # Build dictionary representing this group:
-            group_details_dict = {}
-            # At least the name is present:
-            group_details_dict['name'] = os.path.basename(manifest_path)
-            # Assign defaults unless we can override them with metadata:
-            group_details_dict['display_name'] = group_details_dict['name']
-            group_details_dict['description'] = group_details_dict['name']
-            group_details_dict['computer_name_prefix'] = munki_repo.DEFAULT_COMPUTER_NAME_PREFIX
-            # Check for metadata in the manifest:
-            try:
-                manifest_metadata_dict = manifest_dict['_metadata']
-                have_manifest_metadata = True
-            except KeyError:
-                have_manifest_metadata = False
-                pass
-            # Attempt to read various metadata keys:
-            if have_manifest_metadata:
-                try:
-                    group_details_dict['display_name'] = manifest_metadata_dict['display_name']
-                except KeyError:
-                    pass
-                try:
-                    group_details_dict['description'] = manifest_metadata_dict['description']
-                except KeyError:
-                    pass
-                try:
-                    group_details_dict['computer_name_prefix'] = manifest_metadata_dict['computer_name_prefix']
-                except KeyError:
-                    pass
-            # Append group details dict to ths groups array:
-            groups_array.append(group_details_dict)
+    groups_array = group_index.list_groups()
     # Catch empty groups_array:
     if len(groups_array) == 0:
         return False, [] # empty list
     # Return group list:
     return True, groups_array
 
-def join_group_manifest(given_computer_manifest_name,given_group_manifest_name):
-    '''Modifes a computer manifest's included_manifests key to include the name of a group manifest,
-        effectively making the computer a member of the group and its parent groups.
-        Both manifests must be present and valid plists.  Returns true if successful, false otherwise.'''
+def update_computer_manifest(given_computer_manifest_name,given_group_manifest_name=None,given_metadata_dict=None):
+    '''Applies a group change and/or metadata changes to a computer manifest in a single
+        locked read/modify/write.  Joining a group sets the manifest's included_manifests
+        key to the group, effectively making the computer a member of the group and its
+        parent groups; metadata keys and values are added to (overwrite) its _metadata dict.
+        The computer manifest and the group manifest must be present and valid plists.
+        The manifest is written atomically and only if something changed.
+        Returns a tuple of booleans (joined_group, wrote_metadata).'''
+    joined_group = False
+    wrote_metadata = False
     # Filesystem paths for manifests:
     given_computer_manifest_name = given_computer_manifest_name.upper() # if not already
-    computer_manifest_path = os.path.join(munki_repo.COMPUTER_MANIFESTS_PATH,given_computer_manifest_name)
-    group_manifest_path = os.path.join(munki_repo.GROUP_MANIFESTS_PATH,given_group_manifest_name)
-    
-    # Catch missing manifests:
-    if not os.path.exists(computer_manifest_path):
-        common.logging_error("Computer manifest not found at %s." % computer_manifest_path)
-        return False
-    if not os.path.exists(group_manifest_path):
-        common.logging_error("Group manifest not found at %s." % group_manifest_path)
-        return False
+    computer_manifest_path = find_computer_manifest_path(given_computer_manifest_name)
 
-    # Load manifests:
-    try:
-        computer_manifest_dict = plistlib.readPlist(computer_manifest_path)
-    except xml.parsers.expat.ExpatError:
-        common.logging_error("Computer manifest %s is invalid." % given_computer_manifest_name)
-        return False
-    try:
-        group_manifest_dict = plistlib.readPlist(group_manifest_path)
-    except xml.parsers.expat.ExpatError:
-        common.logging_error("Group manifest %s is invalid." % given_group_manifest_name)
-        return False
+    # Validate the group manifest before touching the computer manifest:
+    group_manifest_valid = False
+    if given_group_manifest_name:
+        group_manifest_path = os.path.join(munki_repo.GROUP_MANIFESTS_PATH,given_group_manifest_name)
+        try:
+            group_manifest_dict = manifest_store.read_manifest(group_manifest_path)
+            if group_manifest_dict is None:
+                common.logging_error("Group manifest not found at %s." % group_manifest_path)
+            else:
+                group_manifest_valid = True
+        except xml.parsers.expat.ExpatError:
+            common.logging_error("Group manifest %s is invalid." % given_group_manifest_name)
+    if not group_manifest_valid and not given_metadata_dict:
+        return joined_group,wrote_metadata
 
-    # Modify computer manifest and save it:
-    common.logging_info("Adding %(computer)s to %(group)s." % {'computer':given_computer_manifest_name,'group':given_group_manifest_name})
-    # Make sure these stay empty; data should come from included (group) manifest only:
-    computer_manifest_dict['managed_installs'] = []
-    computer_manifest_dict['managed_uninstalls'] = []
-    computer_manifest_dict['catalogs'] = munki_repo.CATALOG_ARRAY
-    # Add to group:
-    computer_manifest_dict['included_manifests'] = []
-    computer_manifest_dict['included_manifests'].append('groups/%s' % given_group_manifest_name)
     try:
-        plistlib.writePlist(computer_manifest_dict,computer_manifest_path)
-        return True
-    except TypeError:
+        with manifest_store.ManifestTransaction(computer_manifest_path) as transaction:
+            # Catch missing or invalid manifest:
+            if transaction.invalid:
+                common.logging_error("Computer manifest %s is invalid." % given_computer_manifest_name)
+                return joined_group,wrote_metadata
+            if not transaction.exists:
+                common.logging_error("Computer manifest not found at %s." % computer_manifest_path)
+                return joined_group,wrote_metadata
+            computer_manifest_dict = transaction.manifest
+
+            # Modify group membership:
+            if group_manifest_valid:
+                common.logging_info("Adding %(computer)s to %(group)s.",{'computer':given_computer_manifest_name,'group':given_group_manifest_name})
+                # Make sure these stay empty; data should come from included (group) manifest only:
+                computer_manifest_dict['managed_installs'] = []
+                computer_manifest_dict['managed_uninstalls'] = []
+                computer_manifest_dict['catalogs'] = list(munki_repo.CATALOG_ARRAY)
+                # Add to group:
+                computer_manifest_dict['included_manifests'] = ['groups/%s' % given_group_manifest_name]
+
+            # Modify metadata, starting with blank metadata if there is none:
+            if given_metadata_dict:
+                try:
+                    manifest_metadata_dict = computer_manifest_dict['_metadata']
+                except KeyError:
+                    manifest_metadata_dict = {}
+                for key in given_metadata_dict:
+                    common.logging_info("Adding %(key)s to %(manifest)s.",{'key':key,'manifest':given_computer_manifest_name})
+                    manifest_metadata_dict[key] = given_metadata_dict[key]
+                computer_manifest_dict['_metadata'] = manifest_metadata_dict
+        # Saved (if changed) when the transaction ended:
+        joined_group = group_manifest_valid
+        wrote_metadata = bool(given_metadata_dict)
+    except (TypeError,IOError,OSError):
         common.logging_error("Failed to write manifest for %s." % given_computer_manifest_name)
-        return False
+    return joined_group,wrote_metadata
+
+def join_group_manifest(given_computer_manifest_name,given_group_manifest_name):
+    '''Modifes a computer manifest's included_manifests key to include the name of a group manifest,
+        effectively making the computer a member of the group and its parent groups.
+        Both manifests must be present and valid plists.  Returns true if successful, false otherwise.'''
+    joined_group,ignored = update_computer_manifest(given_computer_manifest_name,given_group_manifest_name=given_group_manifest_name)
+    return joined_group
 
 def write_metadata_to_manifest(given_computer_manifest_name,given_metadata_key,given_metadata_value):
     '''Modifes the given computer manifest's _metadata dict, adding (overwriting) the given key and value.
         Given manifest must be present and a valid plist.  Returns true if successful, false otherwise.'''
-    # Filesystem paths for the manifest:
-    given_computer_manifest_name = given_computer_manifest_name.upper() # if not already
-    computer_manifest_path = os.path.join(munki_repo.COMPUTER_MANIFESTS_PATH,given_computer_manifest_name)
-    
-    # Catch missing manifest:
-    if not os.path.exists(computer_manifest_path):
-        common.logging_error("Computer manifest not found at %s." % computer_manifest_path)
-        return False
-    
-    # Load manifest:
-    try:
-        computer_manifest_dict = plistlib.readPlist(computer_manifest_path)
-    except xml.parsers.expat.ExpatError:
-        common.logging_error("Computer manifest %s is invalid." % given_computer_manifest_name)
-        return False
-
-    # Load manifest metadata or start with blank:
-    try:
-        manifest_metadata_dict = computer_manifest_dict['_metadata']
-    except KeyError:
-        manifest_metadata_dict = {}
-
-    # Modify metadata dict:
-    common.logging_info("Adding %(key)s to %(manifest)s." % {'key':given_metadata_key,'manifest':given_computer_manifest_name})
-    manifest_metadata_dict[given_metadata_key] = given_metadata_value
-    computer_manifest_dict['_metadata'] = manifest_metadata_dict
-
-    # Save manifest:
-    try:
-        plistlib.writePlist(computer_manifest_dict,computer_manifest_path)
-        return True
-    except TypeError:
-        common.logging_error("Failed to write manifest for %s." % given_computer_manifest_name)
-        return False
+    ignored,wrote_metadata = update_computer_manifest(given_computer_manifest_name,given_metadata_dict={given_metadata_key:given_metadata_value})
+    return wrote_metadata
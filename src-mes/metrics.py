@@ -0,0 +1,401 @@
+#!/usr/bin/env python
+
+# metrics.py
+# Munki Enrollment Server
+# Latency histograms and counters for each MES process, merged across
+# processes and served in the Prometheus text format at /metrics.
+
+# Written by Gerrit DeWitt (gdewitt@gsu.edu)
+# Project started 2015-06-15.  This file created 2026-10-18.
+# Copyright Georgia State University.
+# This script uses publicly-documented methods known to those skilled in the art.
+# References: See top level Read Me.
+
+# Each process keeps its own histograms in memory (a bucket lookup and a few
+# additions per observation) and writes them to a snapshot file under
+# temp_dir at most every SNAPSHOT_INTERVAL seconds.  /metrics adds up the
+# snapshots of every MES process, so a scrape sees the whole server whichever
+# worker answers it.  Snapshots of processes that have exited are folded
+# into a "retired" file so that counters never go backwards.
+#
+# With metrics_enabled off, timer() returns a shared object that does nothing
+# and observe() returns at once, so instrumented code costs one attribute
+# lookup per call.
+
+import os, json, time, errno, fcntl, atexit, bisect, threading
+# Load our modules:
+import common
+# Import configuration:
+import configuration_classes as config
+config_app = config.ServerApp()
+
+SNAPSHOT_DIR_NAME = "mes-metrics"
+RETIRED_FILE_NAME = "retired.json"
+# Seconds between snapshot writes for each process:
+SNAPSHOT_INTERVAL = 1.0
+# Upper bounds of the histogram buckets, in seconds (+Inf is implied):
+BUCKETS = [0.0005,0.001,0.0025,0.005,0.01,0.025,0.05,0.1,0.25,0.5,1.0,2.5,5.0,10.0]
+
+# Help text for each metric name:
+HELP = {}
+HELP['mes_enrollment_stage_seconds'] = "Seconds spent in each stage of request-enrollment."
+HELP['mes_auth_stage_seconds'] = "Seconds spent in each step of client authentication."
+HELP['mes_manifest_io_seconds'] = "Seconds spent reading and writing computer manifests."
+HELP['mes_request_seconds'] = "Seconds spent handling each request, by command."
+HELP['mes_requests_total'] = "Requests handled, by command and HTTP status."
+
+# Observations for this process.  Keys are (name, labels) where labels is a
+# tuple of (label, value) tuples; values are [bucket counts, sum, count]
+# for histograms and a number for counters:
+HISTOGRAMS = {}
+COUNTERS = {}
+# Stats functions of other modules (see register_stats), by source name:
+STATS_SOURCES = {}
+LOCK = threading.Lock()
+# Time this process last wrote its snapshot, and the timer that writes the
+# next one when requests stop arriving:
+LAST_SNAPSHOT_TIME = 0
+SNAPSHOT_TIMER = None
+SNAPSHOT_LOCK = threading.Lock()
+# Whether this process has checked for a stale snapshot left under its pid,
+# and whether it has retired its snapshot (and must not write another):
+SNAPSHOT_CLAIMED = False
+SNAPSHOT_RETIRED = False
+
+def is_enabled():
+    '''Returns true if metrics_enabled is set.'''
+    return config_app.METRICS_ENABLED
+
+#PRAGMA MARK: RECORDING
+
+def observe(given_name,given_labels,given_seconds):
+    '''Adds an observation to a histogram.  given_labels is a tuple of
+        (label, value) tuples.'''
+    if not config_app.METRICS_ENABLED:
+        return
+    index = bisect.bisect_left(BUCKETS,given_seconds)
+    key = (given_name,given_labels)
+    with LOCK:
+        histogram = HISTOGRAMS.get(key)
+        if histogram is None:
+            histogram = [[0]*(len(BUCKETS) + 1),0.0,0]
+            HISTOGRAMS[key] = histogram
+        histogram[0][index] += 1
+        histogram[1] += given_seconds
+        histogram[2] += 1
+
+def increment(given_name,given_labels,given_amount=1):
+    '''Adds to a counter.  given_labels is a tuple of (label, value) tuples.'''
+    if not config_app.METRICS_ENABLED:
+        return
+    key = (given_name,given_labels)
+    with LOCK:
+        COUNTERS[key] = COUNTERS.get(key,0) + given_amount
+
+class Timer(object):
+    '''Context manager observing the seconds spent in its block.'''
+    def __init__(self,given_name,given_labels):
+        self.name = given_name
+        self.labels = given_labels
+        self.start_time = None
+
+    def __enter__(self):
+        self.start_time = time.time()
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        observe(self.name,self.labels,time.time() - self.start_time)
+        return False
+
+class NullTimer(object):
+    '''Context manager that does nothing; used when metrics are disabled.'''
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        return False
+
+NULL_TIMER = NullTimer()
+
+def timer(given_name,given_labels):
+    '''Returns a context manager timing its block into the given histogram.'''
+    if not config_app.METRICS_ENABLED:
+        return NULL_TIMER
+    return Timer(given_name,given_labels)
+
+def register_stats(given_source,given_stats_function,given_counter_keys,given_gauge_keys=[]):
+    '''Exports values of another module's stats() dict as mes_<source>_<key>.
+        Keys in given_counter_keys only ever increase and are exported as
+        counters, summed over every process that has run; keys in
+        given_gauge_keys are gauges, summed over running processes.'''
+    STATS_SOURCES[given_source] = (given_stats_function,given_counter_keys,given_gauge_keys)
+    for key in given_counter_keys:
+        HELP["mes_%(source)s_%(key)s_total" % {'source':given_source,'key':key}] = "Value of %(key)s in %(source)s.stats()." % {'source':given_source,'key':key}
+    for key in given_gauge_keys:
+        HELP["mes_%(source)s_%(key)s" % {'source':given_source,'key':key}] = "Value of %(key)s in %(source)s.stats()." % {'source':given_source,'key':key}
+
+#PRAGMA MARK: SNAPSHOTS
+
+def get_snapshot_dir():
+    '''Returns the path to the snapshot directory, creating it if needed,
+        or None if it cannot be created.'''
+    snapshot_dir = os.path.join(config_app.TEMP_DIR,SNAPSHOT_DIR_NAME)
+    if not os.path.isdir(snapshot_dir):
+        try:
+            os.makedirs(snapshot_dir,0700)
+        except OSError:
+            if not os.path.isdir(snapshot_dir):
+                common.logging_error("Could not create metrics directory at %s." % snapshot_dir)
+                return None
+    return snapshot_dir
+
+def make_snapshot():
+    '''Returns a dict with this process's histograms, counters and gauges.'''
+    snapshot_dict = {'histograms':[],'counters':[],'gauges':[]}
+    with LOCK:
+        for (name,labels),histogram in HISTOGRAMS.items():
+            snapshot_dict['histograms'].append([name,labels,list(histogram[0]),histogram[1],histogram[2]])
+        for (name,labels),value in COUNTERS.items():
+            snapshot_dict['counters'].append([name,labels,value])
+    for source,(stats_function,counter_keys,gauge_keys) in STATS_SOURCES.items():
+        try:
+            stats_dict = stats_function()
+        except Exception:
+            common.logging_error("Could not read %s stats for metrics." % source)
+            continue
+        for key in counter_keys:
+            if key in stats_dict:
+                snapshot_dict['counters'].append(["mes_%(source)s_%(key)s_total" % {'source':source,'key':key},[],stats_dict[key]])
+        for key in gauge_keys:
+            if key in stats_dict:
+                snapshot_dict['gauges'].append(["mes_%(source)s_%(key)s" % {'source':source,'key':key},[],stats_dict[key]])
+    return snapshot_dict
+
+def write_json_atomically(given_path,given_dict):
+    '''Writes a dict as JSON to a temporary file and renames it into place.
+        Returns true on success.'''
+    temp_path = "%(path)s.%(pid)s.tmp" % {'path':given_path,'pid':os.getpid()}
+    try:
+        file_object = open(temp_path,'w')
+        json.dump(given_dict,file_object)
+        file_object.close()
+        os.rename(temp_path,given_path)
+    except (IOError,OSError):
+        common.logging_error("Could not write metrics snapshot %s." % given_path)
+        return False
+    return True
+
+def read_json(given_path):
+    '''Returns the dict stored as JSON at the given path, or None.'''
+    try:
+        file_object = open(given_path,'r')
+        try:
+            return json.load(file_object)
+        finally:
+            file_object.close()
+    except (IOError,ValueError):
+        return None
+
+def write_snapshot(given_force=False):
+    '''Writes this process's snapshot, at most every SNAPSHOT_INTERVAL
+        seconds unless forced.  A write that is too soon is put off until
+        the interval has passed, so an idle process still reports its last
+        requests.'''
+    global LAST_SNAPSHOT_TIME, SNAPSHOT_CLAIMED
+    if not config_app.METRICS_ENABLED:
+        return
+    with SNAPSHOT_LOCK:
+        if SNAPSHOT_RETIRED:
+            return
+        now = time.time()
+        if not given_force and now - LAST_SNAPSHOT_TIME < SNAPSHOT_INTERVAL:
+            schedule_snapshot(LAST_SNAPSHOT_TIME + SNAPSHOT_INTERVAL - now)
+            return
+        LAST_SNAPSHOT_TIME = now
+        snapshot_dir = get_snapshot_dir()
+        if not snapshot_dir:
+            return
+        snapshot_path = os.path.join(snapshot_dir,"%s.json" % os.getpid())
+        if not SNAPSHOT_CLAIMED:
+            # A snapshot under our pid was left by an earlier process that
+            # exited without its snapshot being retired:
+            SNAPSHOT_CLAIMED = True
+            if os.path.exists(snapshot_path):
+                retire_snapshots(snapshot_dir,[snapshot_path])
+        snapshot_dict = make_snapshot()
+        snapshot_dict['pid'] = os.getpid()
+        write_json_atomically(snapshot_path,snapshot_dict)
+
+def schedule_snapshot(given_delay):
+    '''Starts a timer thread to write the snapshot after the given delay,
+        unless one is already waiting.  Called with SNAPSHOT_LOCK held.'''
+    global SNAPSHOT_TIMER
+    if SNAPSHOT_TIMER and SNAPSHOT_TIMER.is_alive():
+        return
+    SNAPSHOT_TIMER = threading.Timer(given_delay,write_snapshot,[True])
+    SNAPSHOT_TIMER.daemon = True
+    SNAPSHOT_TIMER.start()
+
+def is_process_running(given_pid):
+    '''Returns true if a process with the given pid exists.'''
+    try:
+        os.kill(given_pid,0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
+
+def merge_snapshot(given_total_dict,given_snapshot_dict,given_include_gauges=True):
+    '''Adds a snapshot's values into given_total_dict, which is keyed like
+        HISTOGRAMS and COUNTERS, with a third dict for gauges.'''
+    histograms,counters,gauges = given_total_dict
+    for name,labels,bucket_counts,total,count in given_snapshot_dict.get('histograms',[]):
+        key = (name,tuple([tuple(label) for label in labels]))
+        histogram = histograms.setdefault(key,[[0]*(len(BUCKETS) + 1),0.0,0])
+        for index in range(min(len(bucket_counts),len(histogram[0]))):
+            histogram[0][index] += bucket_counts[index]
+        histogram[1] += total
+        histogram[2] += count
+    for name,labels,value in given_snapshot_dict.get('counters',[]):
+        key = (name,tuple([tuple(label) for label in labels]))
+        counters[key] = counters.get(key,0) + value
+    if given_include_gauges:
+        for name,labels,value in given_snapshot_dict.get('gauges',[]):
+            key = (name,tuple([tuple(label) for label in labels]))
+            gauges[key] = gauges.get(key,0) + value
+
+def totals_to_snapshot(given_total_dict):
+    '''Returns merged histograms and counters in the snapshot form.'''
+    histograms,counters,gauges = given_total_dict
+    snapshot_dict = {'histograms':[],'counters':[]}
+    for (name,labels),histogram in histograms.items():
+        snapshot_dict['histograms'].append([name,labels,histogram[0],histogram[1],histogram[2]])
+    for (name,labels),value in counters.items():
+        snapshot_dict['counters'].append([name,labels,value])
+    return snapshot_dict
+
+def retire_snapshots(given_snapshot_dir,given_snapshot_paths):
+    '''Adds the histograms and counters of the given snapshots into the
+        retired file and removes them.  Holds a lock on the retired file so
+        that each snapshot is counted once.'''
+    retired_path = os.path.join(given_snapshot_dir,RETIRED_FILE_NAME)
+    try:
+        lock_file = open("%s.lock" % retired_path,'a')
+    except IOError:
+        common.logging_error("Could not lock retired metrics in %s." % given_snapshot_dir)
+        return
+    try:
+        fcntl.flock(lock_file.fileno(),fcntl.LOCK_EX)
+        totals = ({},{},{})
+        merge_snapshot(totals,read_json(retired_path) or {})
+        retired_count = 0
+        for snapshot_path in given_snapshot_paths:
+            # Another process may have retired it while we waited for the lock:
+            snapshot_dict = read_json(snapshot_path)
+            if snapshot_dict is None:
+                continue
+            merge_snapshot(totals,snapshot_dict,False)
+            retired_count += 1
+        if retired_count and write_json_atomically(retired_path,totals_to_snapshot(totals)):
+            for snapshot_path in given_snapshot_paths:
+                try:
+                    os.remove(snapshot_path)
+                except OSError:
+                    pass
+    finally:
+        lock_file.close()
+
+def retire():
+    '''Writes this process's final snapshot and retires it; called when an
+        MES process that has written snapshots exits.'''
+    global SNAPSHOT_RETIRED
+    if not config_app.METRICS_ENABLED or not LAST_SNAPSHOT_TIME or SNAPSHOT_RETIRED:
+        return
+    write_snapshot(True)
+    with SNAPSHOT_LOCK:
+        SNAPSHOT_RETIRED = True
+        if SNAPSHOT_TIMER:
+            SNAPSHOT_TIMER.cancel()
+        snapshot_dir = get_snapshot_dir()
+        if snapshot_dir:
+            retire_snapshots(snapshot_dir,[os.path.join(snapshot_dir,"%s.json" % os.getpid())])
+
+# wsgi_server.py retires worker snapshots in its worker_exit hook; this
+# covers the other servers:
+atexit.register(retire)
+
+def merged_totals():
+    '''Returns the values of every MES process added together, with this
+        process's values current.  Retires snapshots of exited processes.'''
+    write_snapshot(True)
+    totals = ({},{},{})
+    snapshot_dir = get_snapshot_dir()
+    if not snapshot_dir:
+        merge_snapshot(totals,make_snapshot())
+        return totals
+    dead_snapshot_paths = []
+    for file_name in os.listdir(snapshot_dir):
+        if not file_name.endswith('.json') or file_name == RETIRED_FILE_NAME:
+            continue
+        snapshot_path = os.path.join(snapshot_dir,file_name)
+        try:
+            pid = int(file_name[:-len('.json')])
+        except ValueError:
+            continue
+        if pid != os.getpid() and not is_process_running(pid):
+            dead_snapshot_paths.append(snapshot_path)
+            continue
+        snapshot_dict = read_json(snapshot_path)
+        if snapshot_dict:
+            merge_snapshot(totals,snapshot_dict)
+    if dead_snapshot_paths:
+        retire_snapshots(snapshot_dir,dead_snapshot_paths)
+    merge_snapshot(totals,read_json(os.path.join(snapshot_dir,RETIRED_FILE_NAME)) or {},False)
+    return totals
+
+#PRAGMA MARK: EXPOSITION
+
+def format_labels(given_labels,given_extra_label=None):
+    '''Returns labels as {name="value",...}, or an empty string.'''
+    labels = list(given_labels)
+    if given_extra_label:
+        labels.append(given_extra_label)
+    if not labels:
+        return ""
+    return "{%s}" % ",".join(['%(name)s="%(value)s"' % {'name':name,'value':str(value).replace('\\','\\\\').replace('"','\\"').replace('\n','\\n')} for name,value in labels])
+
+def format_value(given_value):
+    '''Returns a number as Prometheus writes it.'''
+    if isinstance(given_value,float):
+        return repr(given_value)
+    return str(given_value)
+
+def write_metric_header(given_lines,given_name,given_type,given_written_names):
+    '''Adds the HELP and TYPE lines for a metric the first time it appears.'''
+    if given_name in given_written_names:
+        return
+    given_written_names.add(given_name)
+    given_lines.append("# HELP %(name)s %(help)s" % {'name':given_name,'help':HELP.get(given_name,given_name)})
+    given_lines.append("# TYPE %(name)s %(type)s" % {'name':given_name,'type':given_type})
+
+def render():
+    '''Returns the merged metrics of every MES process in the Prometheus
+        text exposition format (version 0.0.4).'''
+    histograms,counters,gauges = merged_totals()
+    lines = []
+    written_names = set()
+    for name,labels in sorted(histograms):
+        bucket_counts,total,count = histograms[(name,labels)]
+        write_metric_header(lines,name,"histogram",written_names)
+        cumulative_count = 0
+        for index,upper_bound in enumerate(BUCKETS):
+            cumulative_count += bucket_counts[index]
+            lines.append("%(name)s_bucket%(labels)s %(value)s" % {'name':name,'labels':format_labels(labels,('le',repr(upper_bound))),'value':cumulative_count})
+        lines.append("%(name)s_bucket%(labels)s %(value)s" % {'name':name,'labels':format_labels(labels,('le','+Inf')),'value':count})
+        lines.append("%(name)s_sum%(labels)s %(value)s" % {'name':name,'labels':format_labels(labels),'value':format_value(total)})
+        lines.append("%(name)s_count%(labels)s %(value)s" % {'name':name,'labels':format_labels(labels),'value':count})
+    for metric_type,values in [("counter",counters),("gauge",gauges)]:
+        for name,labels in sorted(values):
+            write_metric_header(lines,name,metric_type,written_names)
+            lines.append("%(name)s%(labels)s %(value)s" % {'name':name,'labels':format_labels(labels),'value':format_value(values[(name,labels)])})
+    lines.append("")
+    return "\n".join(lines)
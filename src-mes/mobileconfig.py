@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+
+# mobileconfig.py
+# Munki Enrollment Server
+# Configuration profile given to each client, rendered from a template
+# compiled once per process.
+
+# Written by Gerrit DeWitt (gdewitt@gsu.edu)
+# Project started 2015-06-15.  This file created 2026-10-18.
+# Copyright Georgia State University.
+# This script uses publicly-documented methods known to those skilled in the art.
+# References: See top level Read Me.
+
+# Nearly all of the profile, including the Munki client prefs, is the same
+# for every client.  The template is the XML plistlib writes for a profile
+# whose per-client values are placeholders, split at those placeholders.
+# Rendering joins the fixed parts with the client's values, escaped and
+# formatted as plistlib would write them, so the output is the same as
+# writing the whole profile with plistlib.
+
+import re, uuid, base64, plistlib, xml, threading
+# Load our modules:
+import common
+import manifests
+# Import configuration:
+import configuration_classes as config
+config_site = config.Site()
+config_munki_client = config.ClientMunkiPrefs()
+
+# Placeholders for per-client values.  String slots may sit inside a longer
+# string; a data slot is written as a string and replaced by a data element:
+STRING_SLOT_FORMAT = "@@MES-SLOT-%s@@"
+DATA_SLOT_FORMAT = "@@MES-DATA-%s@@"
+SLOT_PATTERN = re.compile(r'^(\t*)<string>@@MES-DATA-(\w+)@@</string>\n|@@MES-SLOT-(\w+)@@',re.MULTILINE)
+# Per-client values, by slot name:
+STRING_SLOTS = ['profile_uuid','ca_payload_uuid','ca_cert_cn','ca_payload_password','mcx_payload_uuid','client_identifier','keychain_password']
+DATA_SLOTS = ['ca_payload_data']
+# Characters plistlib refuses to write in a string (its _controlCharPat):
+CONTROL_CHARACTER_PATTERN = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+# Compiled templates for this process, keyed by whether the CA payload has
+# a password.  Each is an array of parts: strings copied as they are, and
+# (slot name, indent) tuples; indent is None for string slots.
+TEMPLATES = {}
+# Configuration generation the templates were compiled from:
+TEMPLATES_GENERATION = None
+LOCK = threading.Lock()
+
+def make_mobileconfig_dict(given_values_dict):
+    '''Returns the configuration profile as a dict, with the per-client values
+        taken from given_values_dict (keys as in STRING_SLOTS and DATA_SLOTS;
+        ca_payload_password may be None, and ca_payload_data is a
+        plistlib.Data object or a placeholder).  Returns None if the Munki
+        client prefs lack a mandatory key.'''
+    # New profile main dict:
+    mobileconfig_top_dict = {}
+    mobileconfig_top_dict['PayloadVersion'] = int(1)
+    mobileconfig_top_dict['PayloadType'] = "Configuration"
+    mobileconfig_top_dict['PayloadScope'] = "System"
+    mobileconfig_top_dict['PayloadIdentifier'] = "%s.config.profile.munki-enrollment" % config_site.ORGANIZATION_ID_PREFIX
+    mobileconfig_top_dict['PayloadUUID'] = given_values_dict['profile_uuid']
+    mobileconfig_top_dict['PayloadOrganization'] = config_munki_client.CONFIG_PROFILE_ORG
+    mobileconfig_top_dict['PayloadDisplayName'] = config_munki_client.CONFIG_PROFILE_DISPLAY_NAME
+    mobileconfig_top_dict['PayloadDescription'] = config_munki_client.CONFIG_PROFILE_DESCRIPTION
+    mobileconfig_top_dict['PayloadContent'] = [] # This is an array of other dicts.
+
+    # CA Payload:
+    if config_munki_client.CA_PAYLOAD_MODE == 'cert':
+        payload_type = "com.apple.security.root"
+    else:
+        payload_type = "com.apple.security.pkcs12"
+    payload_ca_dict = {}
+    payload_ca_dict['PayloadVersion'] = int(1)
+    payload_ca_dict['PayloadType'] = payload_type
+    payload_ca_dict['PayloadUUID'] = given_values_dict['ca_payload_uuid']
+    payload_ca_dict['PayloadIdentifier'] = "%(prefix)s.config.payload.%(type)s.ca-cert" % {'prefix':config_site.ORGANIZATION_ID_PREFIX,'type':payload_type}
+    payload_ca_dict['PayloadDisplayName'] = config_munki_client.P12_CA_DISPLAY_NAME
+    payload_ca_dict['PayloadDescription'] = "CA: %s" % given_values_dict['ca_cert_cn']
+    payload_ca_dict['PayloadContent'] = given_values_dict['ca_payload_data']
+    if given_values_dict['ca_payload_password']:
+        payload_ca_dict['Password'] = given_values_dict['ca_payload_password']
+    mobileconfig_top_dict['PayloadContent'].append(payload_ca_dict)
+
+    # Munki client prefs start with template file read by our configuration:
+    # Test for mandatory keys:
+    for key in config_munki_client.MUNKI_CLIENT_MANDATORY_KEYS:
+        if key not in config_munki_client.MUNKI_CLIENT_PREFS_DICT:
+            common.logging_error("Munki client prefs lack mandatory key %s." % key)
+            return None
+    # Key overrides, in an overlay so that the shared (frozen) prefs are not changed:
+    mcx_overrides_dict = {}
+    mcx_overrides_dict['UseClientCertificate'] = True
+    mcx_overrides_dict['UseClientCertificateCNAsClientIdentifier'] = False
+    mcx_overrides_dict['ClientIdentifier'] = given_values_dict['client_identifier']
+    # Random password for the Munki keychain:
+    mcx_overrides_dict['KeychainPassword'] = given_values_dict['keychain_password']
+    # Set the keychain name so that it's clear it can be removed as long as the
+    # client's identity PEM file is present.
+    mcx_overrides_dict['KeychainName'] = "munki-temp.keychain"
+    mcx_preference_settings = config_munki_client.MUNKI_CLIENT_PREFS_DICT.overlay(mcx_overrides_dict)
+
+    # Munki config profile payload:
+    payload_mcx_munki_client_dict = {}
+    payload_mcx_munki_client_dict['PayloadVersion'] = int(1)
+    payload_mcx_munki_client_dict['PayloadType'] = "com.apple.ManagedClient.preferences"
+    payload_mcx_munki_client_dict['PayloadUUID'] = given_values_dict['mcx_payload_uuid']
+    payload_mcx_munki_client_dict['PayloadIdentifier'] = "%s.config.payload.com.apple.ManagedClient.preferences.munki" % config_site.ORGANIZATION_ID_PREFIX
+    payload_mcx_munki_client_dict['PayloadDisplayName'] = config_munki_client.MUNKI_MCX_PAYLOAD_DISPLAY_NAME
+    payload_mcx_munki_client_dict['PayloadDescription'] = "Server: %s" % mcx_preference_settings['SoftwareRepoURL'].replace('https://','').replace('/','')
+    payload_mcx_munki_client_dict['PayloadContent'] = {}
+    payload_mcx_munki_client_dict['PayloadContent'][config_munki_client.MUNKI_MCX_DEFAULTS_DOMAIN] = {}
+    payload_mcx_munki_client_dict['PayloadContent'][config_munki_client.MUNKI_MCX_DEFAULTS_DOMAIN]['Forced'] = [{}]
+    payload_mcx_munki_client_dict['PayloadContent'][config_munki_client.MUNKI_MCX_DEFAULTS_DOMAIN]['Forced'][0]['mcx_preference_settings'] = mcx_preference_settings
+    mobileconfig_top_dict['PayloadContent'].append(payload_mcx_munki_client_dict)
+    return mobileconfig_top_dict
+
+def make_values_dict(given_serial,given_ca_payload_data,given_ca_cert_cn,given_ca_payload_password=None):
+    '''Returns the per-client values for a profile, with new UUIDs and a new
+        Munki keychain password.'''
+    values_dict = {}
+    values_dict['profile_uuid'] = str(uuid.uuid4())
+    values_dict['ca_payload_uuid'] = str(uuid.uuid4())
+    values_dict['mcx_payload_uuid'] = str(uuid.uuid4())
+    values_dict['ca_cert_cn'] = given_ca_cert_cn
+    values_dict['ca_payload_data'] = given_ca_payload_data
+    values_dict['ca_payload_password'] = given_ca_payload_password
+    # Path of its manifest, which depends on the serial with a sharded layout:
+    values_dict['client_identifier'] = manifests.client_identifier(given_serial)
+    values_dict['keychain_password'] = str(uuid.uuid4()).replace('-','')
+    return values_dict
+
+def write_plist(given_values_dict):
+    '''Returns the XML contents of the profile for the given per-client values
+        written in full by plistlib, or None.  render() gives the same output
+        faster; this is the reference it is checked against.'''
+    values_dict = dict(given_values_dict)
+    values_dict['ca_payload_data'] = plistlib.Data(given_values_dict['ca_payload_data'])
+    mobileconfig_dict = make_mobileconfig_dict(values_dict)
+    if not mobileconfig_dict:
+        return None
+    try:
+        return plistlib.writePlistToString(mobileconfig_dict)
+    except xml.parsers.expat.ExpatError:
+        return None
+    except TypeError:
+        return None
+    except ValueError:
+        # A string containing control characters:
+        return None
+
+#PRAGMA MARK: TEMPLATE
+
+def compile_template(given_has_password):
+    '''Writes the profile with placeholders and splits it into template
+        parts (see TEMPLATES).  Returns the parts or None.'''
+    placeholders_dict = {}
+    for slot_name in STRING_SLOTS:
+        placeholders_dict[slot_name] = STRING_SLOT_FORMAT % slot_name
+    for slot_name in DATA_SLOTS:
+        placeholders_dict[slot_name] = DATA_SLOT_FORMAT % slot_name
+    if not given_has_password:
+        placeholders_dict['ca_payload_password'] = None
+    mobileconfig_dict = make_mobileconfig_dict(placeholders_dict)
+    if not mobileconfig_dict:
+        return None
+    try:
+        template_str = plistlib.writePlistToString(mobileconfig_dict)
+    except xml.parsers.expat.ExpatError:
+        return None
+    except TypeError:
+        return None
+    parts = []
+    position = 0
+    for match in SLOT_PATTERN.finditer(template_str):
+        parts.append(template_str[position:match.start()])
+        if match.group(2):
+            parts.append((match.group(2),match.group(1)))
+        else:
+            parts.append((match.group(3),None))
+        position = match.end()
+    parts.append(template_str[position:])
+    return parts
+
+def get_template(given_has_password):
+    '''Returns the compiled template, compiling it on first use and again
+        after the configuration is reloaded.'''
+    global TEMPLATES_GENERATION
+    has_password = bool(given_has_password)
+    template = TEMPLATES.get(has_password)
+    if template and TEMPLATES_GENERATION == config.GENERATION:
+        return template
+    with LOCK:
+        if TEMPLATES_GENERATION != config.GENERATION:
+            TEMPLATES.clear()
+            TEMPLATES_GENERATION = config.GENERATION
+        if has_password not in TEMPLATES:
+            template = compile_template(has_password)
+            if not template:
+                common.logging_error("Could not compile configuration profile template.")
+                return None
+            TEMPLATES[has_password] = template
+        return TEMPLATES[has_password]
+
+def preload():
+    '''Compiles the templates ahead of the first enrollment.'''
+    get_template(True)
+    get_template(False)
+
+def escape_string(given_value):
+    '''Returns a string escaped as plistlib writes it, or None if it contains
+        control characters, which plistlib refuses to write.'''
+    if CONTROL_CHARACTER_PATTERN.search(given_value):
+        return None
+    value = given_value.replace("\r\n","\n").replace("\r","\n")
+    value = value.replace("&","&amp;").replace("<","&lt;").replace(">","&gt;")
+    if isinstance(value,unicode):
+        value = value.encode("utf-8")
+    return value
+
+def format_data(given_data,given_indent):
+    '''Returns a data element as plistlib writes it at the given indent.'''
+    # Line length as in plistlib, which counts each tab as 8 columns:
+    max_line_length = max(16,76 - 8*len(given_indent))
+    chunk_size = (max_line_length//4)*3
+    lines = ["%s<data>\n" % given_indent]
+    for offset in xrange(0,len(given_data),chunk_size):
+        lines.append("%(indent)s%(line)s\n" % {'indent':given_indent,'line':base64.b64encode(given_data[offset:offset+chunk_size])})
+    lines.append("%s</data>\n" % given_indent)
+    return "".join(lines)
+
+def render(given_values_dict):
+    '''Returns the XML contents of the profile for the given per-client
+        values (see make_values_dict), or None.'''
+    template = get_template(given_values_dict['ca_payload_password'])
+    if not template:
+        return None
+    pieces = []
+    for part in template:
+        if isinstance(part,str):
+            pieces.append(part)
+            continue
+        slot_name,indent = part
+        value = given_values_dict[slot_name]
+        if indent is None:
+            escaped_value = escape_string(value)
+            if escaped_value is None:
+                common.logging_error("Profile value %s contains control characters.",slot_name)
+                return None
+            pieces.append(escaped_value)
+        else:
+            pieces.append(format_data(value,indent))
+    return "".join(pieces)
@@ -6,49 +6,160 @@
 
 # Written by Gerrit DeWitt (gdewitt@gsu.edu)
 # Project started 2015-06-15.
-# 2016-10-11, 2016-10-18.
+# 2016-10-11, 2016-10-18, 2026-10-18.
 # Copyright Georgia State University.
 # This script uses publicly-documented methods known to those skilled in the art.
 # References: See top level Read Me.
 
 import os, plistlib, xml, sys, logging
 
+# Configuration read from the files is frozen: each dict becomes a FrozenDict
+# and each array a tuple, so that no request can change values that every
+# request in the process shares.  Code that needs a changed copy uses
+# FrozenDict.overlay() or list().
+
+class FrozenDict(dict):
+    '''Read-only dict.  Methods that would change it raise TypeError.
+        Copies of it are itself, since it cannot change.'''
+    def read_only(self,*args,**kwargs):
+        raise TypeError("Configuration is read-only; use overlay() for a changed copy.")
+    __setitem__ = read_only
+    __delitem__ = read_only
+    clear = read_only
+    pop = read_only
+    popitem = read_only
+    setdefault = read_only
+    update = read_only
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self,memo):
+        return self
+
+    def __reduce__(self):
+        return (FrozenDict,(dict(self),))
+
+    def overlay(self,given_overrides_dict=None):
+        '''Returns a new, ordinary dict with the keys of this one and the
+            given overrides.  The copy is shallow: nested values stay frozen
+            and are shared, so only the top level is copied.'''
+        overlay_dict = dict(self)
+        if given_overrides_dict:
+            overlay_dict.update(given_overrides_dict)
+        return overlay_dict
+
+def freeze(given_value):
+    '''Returns a frozen copy of a value read from a property list.'''
+    if isinstance(given_value,dict):
+        return FrozenDict([(key,freeze(given_value[key])) for key in given_value])
+    if isinstance(given_value,list):
+        return tuple([freeze(item) for item in given_value])
+    return given_value
+
+class ConfigurationError(Exception):
+    '''Raised instead of exiting when reloaded configuration is unusable.'''
+    pass
+
+# Current configuration; None until first loaded:
+CONFIG_FILE_ROOT_DICT = None
+MUNKI_CLIENT_PREFS_DICT = None
+# (inode, mtime, size) of each file when it was last read:
+FILES_SIGNATURE = None
+# True while configuration_classes.reload_config reads new files; errors
+# then raise ConfigurationError so that the running configuration is kept:
+RELOADING = False
+# Optional keys already reported missing, so each is logged once per load:
+MISSING_KEYS_LOGGED = set()
+
+def config_error(given_message):
+    '''Logs a configuration error, then raises ConfigurationError while
+        reloading or exits 1 otherwise.'''
+    logging.error(given_message)
+    if RELOADING:
+        raise ConfigurationError(given_message)
+    sys.exit(1)
+
 def read_config_key(given_parent_key,given_child_key):
     '''Returns value for key in CONFIG_FILE_ROOT_DICT or exits 1 on failure.'''
     try:
         return CONFIG_FILE_ROOT_DICT[given_parent_key][given_child_key]
     except KeyError:
-        logging.error("Missing key %(child_key)s in %(parent_key)s" % {"child_key":given_child_key,"parent_key":given_parent_key})
-        sys.exit(1)
+        config_error("Missing key %(child_key)s in %(parent_key)s" % {"child_key":given_child_key,"parent_key":given_parent_key})
+
+def is_type_of_default(given_value,given_default_value):
+    '''Returns true if a value read from the configuration has the type of
+        the given default value.  Integers are accepted for reals.'''
+    if isinstance(given_default_value,bool) or isinstance(given_value,bool):
+        return isinstance(given_value,bool) and isinstance(given_default_value,bool)
+    if isinstance(given_default_value,float):
+        return isinstance(given_value,(int,long,float))
+    if isinstance(given_default_value,(int,long)):
+        return isinstance(given_value,(int,long))
+    if isinstance(given_default_value,basestring):
+        return isinstance(given_value,basestring)
+    return True
 
 def read_optional_config_key(given_parent_key,given_child_key,given_default_value):
-    '''Returns value for key in CONFIG_FILE_ROOT_DICT or returns the given default value on failure.'''
+    '''Returns value for key in CONFIG_FILE_ROOT_DICT or returns the given default value
+        if it is missing or not of the default value's type.'''
     try:
-        return CONFIG_FILE_ROOT_DICT[given_parent_key][given_child_key]
+        value = CONFIG_FILE_ROOT_DICT[given_parent_key][given_child_key]
     except KeyError:
-        logging.error("Missing key %(child_key)s in %(parent_key)s; defaulting to \"%(default_value)s\"." % {"child_key":given_child_key,"parent_key":given_parent_key,"default_value":given_default_value})
+        if (given_parent_key,given_child_key) not in MISSING_KEYS_LOGGED:
+            MISSING_KEYS_LOGGED.add((given_parent_key,given_child_key))
+            logging.error("Missing key %(child_key)s in %(parent_key)s; defaulting to \"%(default_value)s\"." % {"child_key":given_child_key,"parent_key":given_parent_key,"default_value":given_default_value})
+        return given_default_value
+    if not is_type_of_default(value,given_default_value):
+        logging.error("Key %(child_key)s in %(parent_key)s should be of type %(type)s; defaulting to \"%(default_value)s\"." % {"child_key":given_child_key,"parent_key":given_parent_key,"type":type(given_default_value).__name__,"default_value":given_default_value})
         return given_default_value
+    if isinstance(given_default_value,float):
+        return float(value)
+    return value
 
-def read_config_files():
-    '''Loads config files.'''
-    global CONFIG_FILE_ROOT_DICT
-    global MUNKI_CLIENT_PREFS_DICT
+def config_file_paths():
+    '''Returns the paths of the configuration file and the Munki client prefs file.'''
     parent_dir = os.path.dirname(os.path.realpath(__file__))
-    config_file_path = os.path.join(parent_dir,'configuration.plist')
-    munki_client_prefs_path = os.path.join(parent_dir,'munki_client_prefs.plist')
+    return os.path.join(parent_dir,'configuration.plist'),os.path.join(parent_dir,'munki_client_prefs.plist')
+
+def files_signature():
+    '''Returns the (inode, mtime, size) of each config file, with None for a
+        file that cannot be read.'''
+    signature = []
+    for file_path in config_file_paths():
+        try:
+            s = os.stat(file_path)
+            signature.append((s.st_ino,s.st_mtime,s.st_size))
+        except OSError:
+            signature.append(None)
+    return tuple(signature)
+
+def parse_config_files():
+    '''Parses the config files.  Returns a tuple of the frozen configuration
+        dict and Munki client prefs dict.'''
+    config_file_path,munki_client_prefs_path = config_file_paths()
     if not os.path.exists(config_file_path):
-        logging.error("Missing config file: %s" % config_file_path)
-        sys.exit(1)
+        config_error("Missing config file: %s" % config_file_path)
     if not os.path.exists(munki_client_prefs_path):
-        logging.error("Missing config file: %s" % munki_client_prefs_path)
-        sys.exit(1)
+        config_error("Missing config file: %s" % munki_client_prefs_path)
     try:
-        CONFIG_FILE_ROOT_DICT = plistlib.readPlist(config_file_path)
+        config_file_root_dict = freeze(plistlib.readPlist(config_file_path))
     except xml.parsers.expat.ExpatError:
-        logging.error("Could not parse file: %s" % config_file_path)
-        sys.exit(1)
+        config_error("Could not parse file: %s" % config_file_path)
     try:
-        MUNKI_CLIENT_PREFS_DICT = plistlib.readPlist(munki_client_prefs_path)
+        munki_client_prefs_dict = freeze(plistlib.readPlist(munki_client_prefs_path))
     except xml.parsers.expat.ExpatError:
-        logging.error("Could not parse file: %s" % munki_client_prefs_path)
-        sys.exit(1)
\ No newline at end of file
+        config_error("Could not parse file: %s" % munki_client_prefs_path)
+    return config_file_root_dict,munki_client_prefs_dict
+
+def read_config_files():
+    '''Loads config files the first time it is called in a process; later
+        calls do nothing.  See configuration_classes.reload_config for
+        picking up changes.'''
+    global CONFIG_FILE_ROOT_DICT
+    global MUNKI_CLIENT_PREFS_DICT
+    global FILES_SIGNATURE
+    if CONFIG_FILE_ROOT_DICT is not None:
+        return
+    FILES_SIGNATURE = files_signature()
+    CONFIG_FILE_ROOT_DICT,MUNKI_CLIENT_PREFS_DICT = parse_config_files()
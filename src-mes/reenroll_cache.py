@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+
+# reenroll_cache.py
+# Munki Enrollment Server
+# Short-lived cache of enrollment archives, so that a repeated
+# request-enrollment for the same serial returns the same identity.
+
+# Written by Gerrit DeWitt (gdewitt@gsu.edu)
+# Project started 2015-06-15.  This file created 2026-10-18.
+# Copyright Georgia State University.
+# This script uses publicly-documented methods known to those skilled in the art.
+# References: See top level Read Me.
+
+# Imaging workflows may ask to enroll the same computer twice within minutes
+# (a retried request, or a reboot partway through a script).  Within
+# reenroll_cache_ttl seconds, the second request gets the archive issued for
+# the first instead of a new key, certificate and profile.
+#
+# Archives hold client private keys, so each is stored encrypted (Fernet,
+# with a key derived from the CA private key passphrase) in a directory under
+# temp_dir that only the MES account can read.  Storing them on disk lets
+# every MES process share the cache.
+
+import os, time, uuid, json, base64, hashlib, threading
+# Load our modules:
+import common
+import security
+import ca_cache
+import crl
+# Import configuration:
+import configuration_classes as config
+config_app = config.ServerApp()
+config_ca = config.CertificateAuthority()
+
+CACHE_DIR_NAME = "mes-reenroll-cache"
+# Salt for deriving the cache key from the CA passphrase:
+KEY_SALT = "mes-reenroll-cache"
+KEY_ITERATIONS = 100000
+
+# Fernet object for this process and the passphrase it was made from;
+# made on first use:
+FERNET = None
+FERNET_PASSPHRASE = None
+LOCK = threading.Lock()
+# Counters for this process:
+CACHE_HITS = 0
+CACHE_MISSES = 0
+CACHE_EXPIRED = 0
+CACHE_STORED = 0
+
+def is_enabled():
+    '''Returns true if the re-enrollment window is configured.'''
+    return config_app.REENROLL_CACHE_TTL > 0 and config_app.REENROLL_CACHE_SIZE > 0
+
+def get_cache_dir():
+    '''Returns the path to the cache directory, creating it if needed,
+        or None if it cannot be created.'''
+    cache_dir = os.path.join(config_app.TEMP_DIR,CACHE_DIR_NAME)
+    if not os.path.isdir(cache_dir):
+        try:
+            os.makedirs(cache_dir,0700)
+        except OSError:
+            if not os.path.isdir(cache_dir):
+                common.logging_error("Could not create re-enrollment cache directory at %s." % cache_dir)
+                return None
+    return cache_dir
+
+def get_fernet():
+    '''Returns the Fernet object used to encrypt cached archives.'''
+    global FERNET, FERNET_PASSPHRASE
+    # Imported here so that sites without the re-enrollment window do not load it:
+    from cryptography.fernet import Fernet
+    with LOCK:
+        if not FERNET or FERNET_PASSPHRASE != config_ca.CA_PRIVATE_KEY_PASSPHRASE:
+            key = hashlib.pbkdf2_hmac('sha256',config_ca.CA_PRIVATE_KEY_PASSPHRASE,KEY_SALT,KEY_ITERATIONS)
+            FERNET = Fernet(base64.urlsafe_b64encode(key))
+            FERNET_PASSPHRASE = config_ca.CA_PRIVATE_KEY_PASSPHRASE
+        return FERNET
+
+def entry_path(given_cache_dir,given_serial):
+    '''Returns the path of the cache file for a serial.'''
+    return os.path.join(given_cache_dir,"%s.token" % hashlib.sha256(given_serial).hexdigest())
+
+def get_ca_fingerprint():
+    '''Returns the fingerprint of the current CA certificate or None.'''
+    ca_cert = ca_cache.get_ca_cert()
+    if not ca_cert:
+        return None
+    return security.cert_fingerprint(ca_cert)
+
+def hit_rate():
+    '''Returns the hit rate for this process as a string.'''
+    lookups = CACHE_HITS + CACHE_MISSES
+    if not lookups:
+        return "0/0"
+    return "%(hits)s/%(lookups)s (%(percent).0f%%)" % {'hits':CACHE_HITS,'lookups':lookups,'percent':CACHE_HITS*100.0/lookups}
+
+def remove_entry(given_path):
+    '''Removes a cache file, ignoring one already removed.'''
+    try:
+        os.remove(given_path)
+    except OSError:
+        pass
+
+def lookup(given_serial):
+    '''Returns the tar data cached for a validated serial, or None if there
+        is none, it is older than reenroll_cache_ttl, it was issued by a CA
+        other than the current one, or its certificate has been revoked.'''
+    global CACHE_HITS, CACHE_MISSES, CACHE_EXPIRED
+    if not is_enabled():
+        return None
+    cache_dir = get_cache_dir()
+    if not cache_dir:
+        return None
+    cache_path = entry_path(cache_dir,given_serial)
+    entry_dict = None
+    try:
+        file_object = open(cache_path,'r')
+        token = file_object.read()
+        file_object.close()
+    except IOError:
+        token = None
+    if token:
+        from cryptography.fernet import InvalidToken
+        try:
+            # Fernet tokens carry their creation time, so the TTL is checked here:
+            entry_dict = json.loads(get_fernet().decrypt(token,ttl=config_app.REENROLL_CACHE_TTL))
+        except InvalidToken:
+            CACHE_EXPIRED += 1
+            remove_entry(cache_path)
+        except ValueError:
+            common.logging_error("Discarding unreadable re-enrollment cache entry %s." % cache_path)
+            remove_entry(cache_path)
+    if entry_dict and (entry_dict.get('serial') != given_serial or entry_dict.get('ca_fingerprint') != get_ca_fingerprint() or crl.is_serial_revoked(entry_dict.get('cert_serial'))):
+        remove_entry(cache_path)
+        entry_dict = None
+    if not entry_dict:
+        CACHE_MISSES += 1
+        common.logging_info_sampled("Re-enrollment cache miss for %(serial)s; hit rate %(rate)s.",{'serial':given_serial,'rate':hit_rate()})
+        return None
+    CACHE_HITS += 1
+    common.logging_info_sampled("Re-enrollment cache hit for %(serial)s; hit rate %(rate)s.",{'serial':given_serial,'rate':hit_rate()})
+    return base64.b64decode(entry_dict['tar_data'])
+
+def store(given_serial,given_tar_data,given_cert_serial=None):
+    '''Caches the tar data issued for a validated serial, then evicts the
+        oldest entries beyond reenroll_cache_size.'''
+    global CACHE_STORED
+    if not is_enabled():
+        return
+    cache_dir = get_cache_dir()
+    if not cache_dir:
+        return
+    entry_dict = {}
+    entry_dict['serial'] = given_serial
+    entry_dict['cert_serial'] = given_cert_serial
+    entry_dict['ca_fingerprint'] = get_ca_fingerprint()
+    entry_dict['tar_data'] = base64.b64encode(given_tar_data)
+    token = get_fernet().encrypt(json.dumps(entry_dict))
+    cache_path = entry_path(cache_dir,given_serial)
+    temp_path = os.path.join(cache_dir,"%s.tmp" % uuid.uuid4())
+    try:
+        fd = os.open(temp_path,os.O_WRONLY|os.O_CREAT|os.O_EXCL,0600)
+        try:
+            os.write(fd,token)
+        finally:
+            os.close(fd)
+        os.rename(temp_path,cache_path)
+    except OSError:
+        common.logging_error("Could not write re-enrollment cache entry %s." % cache_path)
+        remove_entry(temp_path)
+        return
+    CACHE_STORED += 1
+    evict(cache_dir)
+
+def evict(given_cache_dir):
+    '''Removes the oldest cache files beyond reenroll_cache_size and any
+        older than reenroll_cache_ttl.'''
+    now = time.time()
+    entries = []
+    try:
+        file_names = os.listdir(given_cache_dir)
+    except OSError:
+        return
+    for file_name in file_names:
+        if not file_name.endswith('.token'):
+            continue
+        file_path = os.path.join(given_cache_dir,file_name)
+        try:
+            modified = os.stat(file_path).st_mtime
+        except OSError:
+            continue # removed by another process
+        if now - modified > config_app.REENROLL_CACHE_TTL:
+            remove_entry(file_path)
+        else:
+            entries.append((modified,file_path))
+    entries.sort()
+    for modified,file_path in entries[:max(0,len(entries) - config_app.REENROLL_CACHE_SIZE)]:
+        remove_entry(file_path)
+
+def stats():
+    '''Returns a dict with cache counters for this process.'''
+    stats_dict = {}
+    stats_dict['hits'] = CACHE_HITS
+    stats_dict['misses'] = CACHE_MISSES
+    stats_dict['expired'] = CACHE_EXPIRED
+    stats_dict['stored'] = CACHE_STORED
+    stats_dict['capacity'] = config_app.REENROLL_CACHE_SIZE
+    stats_dict['ttl'] = config_app.REENROLL_CACHE_TTL
+    return stats_dict
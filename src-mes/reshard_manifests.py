@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+
+# reshard_manifests.py
+# Munki Enrollment Server
+# Moves computer manifests into the directory layout set by
+# computer_shard_levels, while the MES and the web server are running.
+
+# Written by Gerrit DeWitt (gdewitt@gsu.edu)
+# Project started 2015-06-15.  This file created 2026-10-18.
+# Copyright Georgia State University.
+# This script uses publicly-documented methods known to those skilled in the art.
+# References: See top level Read Me.
+
+# Usage: reshard_manifests.py [--levels N] [--width N] [--dry-run] [--remove-links]
+#
+# Every computer manifest not where the layout puts it is moved there, and a
+# symlink to its new path is left at the old one, so clients whose
+# ClientIdentifier names the old path keep finding it (see
+# manifests.move_computer_manifest).  The layout is the configured one unless
+# --levels and --width are given; --levels 0 moves manifests back into the
+# computer manifests directory itself.  Running it again only moves the
+# manifests created since.
+#
+# --remove-links removes those symlinks instead.  Only do so once every
+# client has been enrolled again (and has the new ClientIdentifier), or
+# once the web server maps the old paths to the new ones.
+#
+# Run as the MES account, with the same configuration as the MES.
+
+import os, sys, argparse
+# Load our modules:
+import common
+import manifests
+import manifest_store
+# Import configuration:
+import configuration_classes as config
+munki_repo = config.MunkiManifests()
+
+# Directories are synced after every SYNC_INTERVAL manifests moved, and at the end:
+SYNC_INTERVAL = 500
+# Progress is printed after every PROGRESS_INTERVAL manifests examined:
+PROGRESS_INTERVAL = 5000
+
+def list_manifest_entries():
+    '''Yields (path, is symlink) for each entry in the computer manifests
+        directory and its subdirectories, skipping temporary files.'''
+    for dir_path,dir_names,file_names in os.walk(munki_repo.COMPUTER_MANIFESTS_PATH):
+        dir_names[:] = [dir_name for dir_name in dir_names if not dir_name.startswith('.')]
+        for name in file_names + [dir_name for dir_name in dir_names if os.path.islink(os.path.join(dir_path,dir_name))]:
+            if name.startswith('.'):
+                continue
+            path = os.path.join(dir_path,name)
+            yield path,os.path.islink(path)
+
+def target_path(given_manifest_name,given_arguments):
+    '''Returns where the layout being applied puts the named manifest.'''
+    return os.path.join(munki_repo.COMPUTER_MANIFESTS_PATH,manifests.computer_manifest_relative_path(given_manifest_name,given_arguments.levels,given_arguments.width))
+
+def is_compatibility_link(given_path,given_arguments):
+    '''Returns true if the path is a symlink, at another path than the layout
+        being applied gives, to the manifest of the same name where that
+        layout puts it.'''
+    real_path = os.path.realpath(given_path)
+    name = os.path.basename(given_path)
+    new_path = target_path(name,given_arguments)
+    if os.path.abspath(given_path) == os.path.abspath(new_path):
+        return False
+    return os.path.basename(real_path) == name and os.path.isfile(real_path) and real_path == os.path.realpath(new_path)
+
+def parse_arguments(given_arguments):
+    parser = argparse.ArgumentParser(description="Move computer manifests into the configured (or given) directory layout, leaving symlinks at their old paths.")
+    parser.add_argument('--levels',type=int,default=munki_repo.COMPUTER_SHARD_LEVELS,help="directory levels (default: computer_shard_levels, now %s)" % munki_repo.COMPUTER_SHARD_LEVELS)
+    parser.add_argument('--width',type=int,default=munki_repo.COMPUTER_SHARD_WIDTH,help="characters of the serial per level (default: computer_shard_width, now %s)" % munki_repo.COMPUTER_SHARD_WIDTH)
+    parser.add_argument('--dry-run',action='store_true',help="report what would change without changing anything")
+    parser.add_argument('--remove-links',action='store_true',help="remove the symlinks left at old paths instead of moving manifests")
+    return parser.parse_args(given_arguments)
+
+def main(given_arguments):
+    '''Handles the command line; returns the exit status.'''
+    arguments = parse_arguments(given_arguments)
+    if arguments.levels < 0 or arguments.width < 1:
+        print "--levels must be at least 0 and --width at least 1."
+        return 1
+    if not os.path.isdir(munki_repo.COMPUTER_MANIFESTS_PATH):
+        print "Computer manifests directory not found at %s." % munki_repo.COMPUTER_MANIFESTS_PATH
+        return 1
+    common.configure_logging()
+    manifest_store.defer_directory_syncs()
+    counts_dict = dict([(key,0) for key in ['examined','in_place','moved','linked','conflict','failed','links_removed']])
+    changed_since_sync = 0
+    for path,is_link in list_manifest_entries():
+        counts_dict['examined'] += 1
+        if counts_dict['examined'] % PROGRESS_INTERVAL == 0:
+            print "%(examined)s examined, %(moved)s moved, %(links_removed)s links removed." % counts_dict
+        if is_link:
+            if arguments.remove_links and is_compatibility_link(path,arguments):
+                if not arguments.dry_run:
+                    try:
+                        os.remove(path)
+                    except OSError as e:
+                        common.logging_error("Could not remove %(path)s: %(error)s" % {'path':path,'error':e})
+                        counts_dict['failed'] += 1
+                        continue
+                    manifest_store.directory_changed(os.path.dirname(path))
+                    changed_since_sync += 1
+                counts_dict['links_removed'] += 1
+            continue
+        if arguments.remove_links:
+            continue
+        new_path = target_path(os.path.basename(path),arguments)
+        if os.path.abspath(path) == os.path.abspath(new_path):
+            counts_dict['in_place'] += 1
+            continue
+        if arguments.dry_run:
+            counts_dict['moved'] += 1
+            continue
+        result = manifests.move_computer_manifest(path,new_path)
+        if result:
+            counts_dict[result] += 1
+            if result == "conflict":
+                print "%(path)s: a different manifest is already at %(new_path)s; left in place." % {'path':path,'new_path':new_path}
+            else:
+                changed_since_sync += 1
+        else:
+            counts_dict['failed'] += 1
+            print "%s: could not be moved; see the log." % path
+        if changed_since_sync >= SYNC_INTERVAL:
+            manifest_store.flush_directory_syncs()
+            changed_since_sync = 0
+    manifest_store.flush_directory_syncs()
+    if arguments.dry_run:
+        print "Dry run; nothing was changed."
+    summary = "%(examined)s entries examined: %(moved)s manifests moved, %(linked)s already moved (linked), %(in_place)s in place, %(conflict)s conflicts, %(failed)s failures, %(links_removed)s links removed." % counts_dict
+    if not arguments.dry_run:
+        common.logging_info(summary)
+    print summary
+    if counts_dict['conflict'] or counts_dict['failed']:
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
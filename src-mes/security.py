@@ -6,25 +6,34 @@
 
 # Written by Gerrit DeWitt (gdewitt@gsu.edu)
 # Project started 2015-06-15.  This file created 2015-07-23.
-# 2016-09-19, 2016-10-11.
+# 2016-09-19, 2016-10-11, 2026-10-18.
 # Copyright Georgia State University.
 # This script uses publicly-documented methods known to those skilled in the art.
 # References: See top level Read Me.
 
-import os, base64, sys
+import os, base64, sys, uuid, time, calendar, hashlib
 from OpenSSL import crypto
 # Load our modules:
 import common
+import ca_cache
 # Import configuration:
 import configuration_classes as config
 config_client_pki = config.ClientCertificate()
 config_ca = config.CertificateAuthority()
+config_munki_client = config.ClientMunkiPrefs()
+
+# CA PKCS12 container reused by the p12-cached payload mode.
+# Holds (ca_cache generation, passphrase, data) once built:
+CACHED_CA_P12 = None
+# Store holding the CA certificate, for checking client certificates.
+# Holds (ca_cache generation, store) once built:
+CA_STORE = None
 
 #PRAGMA MARK: GENERAL METHODS
 
 def read_cert_cn(given_cert):
     '''Given any cert object and passphrase, return its subject CN or None.'''
-    common.logging_info("Getting CN for given certificate.")
+    common.logging_info_sampled("Getting CN for given certificate.")
     try:
         return str(given_cert.get_subject().CN)
     except crypto.Error:
@@ -32,41 +41,25 @@ def read_cert_cn(given_cert):
         return None
 
 def read_ca_cert():
-    '''Loads CA certificate from the filesystem and returns it as an object.
+    '''Returns the CA certificate as an object, loaded once and cached by ca_cache.
         Returns None if something went wrong.'''
-    common.logging_info("Loading CA certificate.")
-    # Check for missing CA certificate:
-    if not os.path.exists(config_ca.CA_CERT_FILE_PATH):
-        common.logging_error("No CA certificate file found at %s." % config_ca.CA_CERT_FILE_PATH)
-        return None
-    # Read and load CA certificate:
-    try:
-        file_object = open(config_ca.CA_CERT_FILE_PATH,'r')
-        file_contents = file_object.read()
-        file_object.close()
-    except IOError:
-        return None
-    # Return CA cert:
-    try:
-        return crypto.load_certificate(crypto.FILETYPE_PEM,file_contents)
-    except crypto.Error:
-        common.logging_error("Could not read CA certificate from %s." % config_ca.CA_CERT_FILE_PATH)
-        return None
+    return ca_cache.get_ca_cert()
 
 def generate_private_key():
     '''Generates a private key (RSA).
         Returns the key or None if something went wrong.'''
-    common.logging_info("Generating a private key.")
+    common.logging_info_sampled("Generating a private key.")
     try:
         key = crypto.PKey()
-        return key.generate_key(crypto.TYPE_RSA,config_client_pki.PRIVATE_KEY_BITS)
+        key.generate_key(crypto.TYPE_RSA,config_client_pki.PRIVATE_KEY_BITS)
+        return key
     except crypto.Error:
         return None
 
 def generate_csr(given_key,given_cn):
     '''Generates a certificate signing request.
         Returns that request or None.'''
-    common.logging_info("Generating a certificate signing request for %s." % given_cn)
+    common.logging_info_sampled("Generating a certificate signing request for %s.",given_cn)
     # Create X509 object:  Technically this is not a CSR (X509Req) object
     # because we're signing it locally.  Or maybe that's not the reason.
     # Regardless, X509Req objects don't become X509 objects, and only X509
@@ -101,6 +94,22 @@ def generate_csr(given_key,given_cn):
     # Return:
     return csr
 
+def read_cert_time(given_asn1_time):
+    '''Converts a certificate time (YYYYMMDDhhmmssZ) to seconds since the epoch.
+        Returns None if it cannot be read.'''
+    try:
+        return calendar.timegm(time.strptime(given_asn1_time,'%Y%m%d%H%M%SZ'))
+    except (TypeError,ValueError):
+        return None
+
+def read_cert_not_after(given_cert):
+    '''Returns the end of the given certificate's validity window
+        as seconds since the epoch, or None.'''
+    not_after = read_cert_time(given_cert.get_notAfter())
+    if not not_after:
+        common.logging_error("Could not read the certificate's expiration date.")
+    return not_after
+
 #PRAGMA MARK: CONVERSION METHODS
 
 def pem_to_cert(given_pem):
@@ -109,14 +118,14 @@ def pem_to_cert(given_pem):
     try:
         return crypto.load_certificate(crypto.FILETYPE_PEM,given_pem)
     except crypto.Error:
-        logging_error("Could load a certificate from the given PEM string.")
+        common.logging_error("Could not load a certificate from the given PEM string.")
         return None
 
 def make_identity_pem_string(given_key,given_cert,given_ca_cert):
     '''Given objects for client key, client cert, and CA cert,
         extract their contents in PEM format and combine them
         into a single text string.  Return that string or None.'''
-    common.logging_info("Generating client identity PEM.")
+    common.logging_info_sampled("Generating client identity PEM.")
     try:
         key_pem = crypto.dump_privatekey(crypto.FILETYPE_PEM,given_key)
     except crypto.Error:
@@ -138,7 +147,7 @@ def make_identity_pem_string(given_key,given_cert,given_ca_cert):
 def make_p12_with_ca_cert(given_ca_cert,given_passphrase):
     '''Given CA cert object and passphrase, create a PKCS container
         and return it as data.  Return None if something went wrong.'''
-    common.logging_info("Generating PKCS12 store for given CA certificate.")
+    common.logging_info_sampled("Generating PKCS12 store for given CA certificate.")
     p = crypto.PKCS12()
     try:
         p.set_ca_certificates([given_ca_cert])
@@ -152,12 +161,45 @@ def make_p12_with_ca_cert(given_ca_cert,given_passphrase):
         return None
     return p12_ca_data
 
+def get_cached_p12_with_ca_cert(given_ca_cert):
+    '''Returns a tuple of (data, passphrase) for a PKCS container with the
+        CA cert.  The container is built once and reused until the CA
+        material is reloaded.  Returns (None, None) if something went wrong.'''
+    global CACHED_CA_P12
+    if CACHED_CA_P12 and CACHED_CA_P12[0] == ca_cache.GENERATION:
+        return CACHED_CA_P12[2],CACHED_CA_P12[1]
+    passphrase = config_munki_client.CA_PAYLOAD_P12_PASSPHRASE
+    if not passphrase:
+        passphrase = str(uuid.uuid4()).replace('-','')
+    p12_ca_data = make_p12_with_ca_cert(given_ca_cert,passphrase)
+    if not p12_ca_data:
+        return None,None
+    CACHED_CA_P12 = (ca_cache.GENERATION,passphrase,p12_ca_data)
+    return p12_ca_data,passphrase
+
+def cert_fingerprint(given_cert):
+    '''Returns the SHA-256 fingerprint of a certificate (of its DER
+        encoding) as lowercase hex, or None.'''
+    der_data = cert_to_der(given_cert)
+    if not der_data:
+        return None
+    return hashlib.sha256(der_data).hexdigest()
+
+def cert_to_der(given_cert):
+    '''Given a certificate object, return its DER encoding or None.'''
+    try:
+        return crypto.dump_certificate(crypto.FILETYPE_ASN1,given_cert)
+    except crypto.Error:
+        common.logging_error("Could not get DER contents of certificate.")
+        return None
+
 #PRAGMA MARK: SIGNING & VERIFICATION METHODS
 
-def sign_with_ca(given_csr,given_ca_cert):
-    '''Signs a CSR with the specified CA's private key.
+def sign_with_ca(given_csr,given_ca_cert,given_serial_number=None):
+    '''Signs a CSR with the specified CA's private key, giving the
+        certificate the given serial number if there is one.
         Returns the signed certificate or None.'''
-    common.logging_info("Signing certificate signing request.")
+    common.logging_info_sampled("Signing certificate signing request.")
     # Check CSR:
     if not given_csr:
         common.logging_error("Invalid CSR.")
@@ -166,27 +208,18 @@ def sign_with_ca(given_csr,given_ca_cert):
     if not given_ca_cert:
         common.logging_error("Cannot sign CSR - CA certificate error.")
         return None
-    # Check for missing CA key file:
-    if not os.path.exists(config_ca.CA_PRIVATE_KEY_FILE_PATH):
-        common.logging_error("No CA private key file found at %s." % config_ca.CA_PRIVATE_KEY_FILE_PATH)
-        return None
-    # Read and load CA private key:
-    try:
-        file_object = open(config_ca.CA_PRIVATE_KEY_FILE_PATH,'r')
-        file_contents = file_object.read()
-        file_object.close()
-    except IOError:
+    # Cached CA private key (decrypted once per process):
+    ca_key = ca_cache.get_ca_key()
+    if not ca_key:
+        common.logging_error("Cannot sign CSR - CA private key error.")
         return None
-    try:
-        ca_key = crypto.load_privatekey(crypto.FILETYPE_PEM,file_contents,config_ca.CA_PRIVATE_KEY_PASSPHRASE)
-    except crypto.Error:
-        common.logging_error("Could not read CA private key from %s." % config_ca.CA_PRIVATE_KEY_FILE_PATH)
-        return None
-    # Set issuer:
+    # Set issuer (and serial, which must be unique for this issuer):
     try:
         given_csr.set_issuer(given_ca_cert.get_subject())
+        if given_serial_number:
+            given_csr.set_serial_number(given_serial_number)
     except crypto.Error:
-        common.logging_error("Could not set issuer for CSR to CA subject.")
+        common.logging_error("Could not set issuer or serial for CSR.")
         ca_key = None # safety!
         return None
     # Sign the CSR with the CA's private key:
@@ -196,13 +229,52 @@ def sign_with_ca(given_csr,given_ca_cert):
         common.logging_error("Could not sign CSR!")
         ca_key = None # safety!
         return None
-    # Wipe CA private key and these variables before exiting this method:
+    # Drop our reference to the CA private key before exiting this method:
     ca_key = None
-    file_contents = None
-    file_object = None
     # Return signed cert:
     return given_csr
 
+def make_ca_store(given_ca_cert):
+    '''Returns an X509 store trusting only the given CA certificate, or None.'''
+    try:
+        store = crypto.X509Store()
+        store.add_cert(given_ca_cert)
+        return store
+    except crypto.Error:
+        common.logging_error("Could not build a certificate store with the CA certificate.")
+        return None
+
+def get_ca_store():
+    '''Returns the X509 store for the CA certificate.  It is built once and
+        reused until the CA material is reloaded.  Returns None if something
+        went wrong.'''
+    global CA_STORE
+    ca_cert = read_ca_cert()
+    ca_store = CA_STORE
+    if ca_store and ca_store[0] == ca_cache.GENERATION:
+        return ca_store[1]
+    if not ca_cert:
+        common.logging_error("Cannot check client certificates - CA certificate error.")
+        return None
+    store = make_ca_store(ca_cert)
+    if store:
+        CA_STORE = (ca_cache.GENERATION,store)
+    return store
+
+def verify_cert_chain(given_cert,given_store=None):
+    '''Checks that the given certificate was issued by the CA and that the
+        current time is within its validity window.  Uses the given store or
+        the CA store.  Returns true or false.'''
+    store = given_store or get_ca_store()
+    if not store:
+        return False
+    try:
+        crypto.X509StoreContext(store,given_cert).verify_certificate()
+        return True
+    except crypto.X509StoreContextError as e:
+        common.logging_error("Certificate fails verification against the CA: %s" % str(e))
+        return False
+
 def verify_signed_message(given_message,given_encoded_sig,given_cert):
     '''Given strings for the message, its signature, and a certificate object,
         verify the message.  Returns true or false.'''
@@ -7,23 +7,143 @@
 
 # Written by Gerrit DeWitt (gdewitt@gsu.edu)
 # Project started 2015-06-15.
-# 2016-09-19, 2017-02-10.
+# 2016-09-19, 2017-02-10, 2026-10-18.
 # Copyright Georgia State University.
 # This script uses publicly-documented methods known to those skilled in the art.
 # References: See top level Read Me.
 
-import os, plistlib, xml
-from flask import Flask, request, make_response
+import os, time, plistlib, xml, signal, base64
+from flask import Flask, Response, request, make_response, g
 app = Flask(__name__)
 # Load our modules:
 import common
 import security
 import enrollment
 import manifests
+import group_index
+import key_pool
+import crypto_pool
+import mobileconfig
+import cert_cache
+import ca_cache
+import crl
+import ledger
+import reenroll_cache
+import manifest_store
+import metrics
 # Import configuration:
 import configuration_classes as config
 config_site = config.Site()
 config_server_app = config.ServerApp()
+common.configure_logging()
+
+# Response modes a client may request for request-enrollment with
+# the optional response_mode POST variable:
+#  * base64: (default) the whole base64-encoded tar file in one response
+#  * stream: the same base64 text, streamed in chunks
+#  * binary: the raw tar file, streamed in chunks
+RESPONSE_MODES = ['base64','stream','binary']
+# Chunk size for streamed responses.  A multiple of 3 so that
+# base64-encoded chunks join without padding in between:
+STREAM_CHUNK_SIZE = 3*16384
+# /metrics answers only requests made directly to the loopback address;
+# requests relayed by the front end web server carry one of these headers:
+LOCAL_ADDRESSES = ['127.0.0.1','::1']
+PROXY_HEADERS = ['X-Forwarded-For','X-Real-IP','Forwarded']
+
+# Counters and gauges exported at /metrics from each module's stats():
+metrics.register_stats('key_pool',key_pool.stats,['keys_served','keys_unsealed','fallbacks','keys_generated'],['depth'])
+metrics.register_stats('crypto_pool',crypto_pool.stats,['admitted','rejected','timeouts'])
+metrics.register_stats('cert_cache',cert_cache.stats,['hits','misses','expired','chain_checks','chain_checks_skipped'],['entries'])
+metrics.register_stats('manifest_cache',manifest_store.stats,['hits','misses'],['entries'])
+metrics.register_stats('reenroll_cache',reenroll_cache.stats,['hits','misses','expired','stored'])
+metrics.register_stats('ledger',ledger.stats,['rows_written','batches_written'],['pending'])
+metrics.register_stats('crl',crl.stats,['signed','rebuilt'])
+metrics.register_stats('log',common.stats,['written','dropped'],['queued'])
+
+def stream_chunks(given_data,given_encode_base64):
+    '''Generator yielding the given data in chunks, optionally base64-encoded.'''
+    for offset in xrange(0,len(given_data),STREAM_CHUNK_SIZE):
+        chunk = given_data[offset:offset+STREAM_CHUNK_SIZE]
+        if given_encode_base64:
+            chunk = base64.b64encode(chunk)
+        yield chunk
+
+def make_streamed_tar_response(given_tar_data,given_response_mode):
+    '''Returns a streaming response for the given tar data in the given mode.'''
+    if given_response_mode == 'binary':
+        encode_base64 = False
+        content_length = len(given_tar_data)
+        if config_server_app.TAR_GZIP:
+            content_type = "application/gzip"
+        else:
+            content_type = "application/x-tar"
+    else:
+        encode_base64 = True
+        content_length = 4 * ((len(given_tar_data) + 2) // 3)
+        content_type = "text/plain"
+    response = Response(stream_chunks(given_tar_data,encode_base64),content_type=content_type)
+    response.headers['Content-Length'] = str(content_length)
+    response.headers['Content-Disposition'] = "attachment"
+    return response
+
+def make_busy_response():
+    '''Returns the HTTP 503 response sent when the crypto queue is full.'''
+    response = make_response("Server busy; retry later.\n",503)
+    response.headers['Retry-After'] = str(config_server_app.CRYPTO_RETRY_AFTER)
+    return response
+
+@app.before_request
+def start_request_context():
+    '''Gives the request an ID (the front end's X-Request-ID if it sent
+        one) that is added to each line logged while handling it.'''
+    common.begin_request(request.headers.get('X-Request-ID'))
+
+@app.teardown_request
+def end_request_context(exception):
+    '''Clears the request ID, so that lines this thread logs between
+        requests do not carry it.  Registered first, so it runs last.'''
+    common.end_request()
+
+@app.before_request
+def refresh_configuration():
+    '''Picks up configuration changes (see configuration_classes.refresh).'''
+    config.refresh()
+
+@app.before_request
+def start_request_timer():
+    '''Notes when the request started, for the request metrics.'''
+    if metrics.is_enabled():
+        g.mes_request_start_time = time.time()
+
+@app.after_request
+def note_response_status(response):
+    '''Notes the response status for the request metrics.'''
+    g.mes_response_status = response.status_code
+    response.headers['X-Request-ID'] = common.get_request_id()
+    return response
+
+@app.teardown_request
+def record_request_metrics(exception):
+    '''Records the request's time and status.  Requests that failed (views
+        returning None) never reach after_request and count as 500.'''
+    start_time = g.get('mes_request_start_time')
+    if start_time is None:
+        return
+    if request.url_rule is None:
+        command = 'other'
+    elif request.url_rule.rule == '/enroll':
+        command = request.form.get('command')
+        if command not in config_server_app.TRANSACTIONS:
+            command = 'invalid'
+    else:
+        command = request.url_rule.rule
+    status = g.get('mes_response_status',500)
+    if exception is not None:
+        status = 500
+    metrics.observe('mes_request_seconds',(('command',command),),time.time() - start_time)
+    metrics.increment('mes_requests_total',(('command',command),('status',str(status))))
+    metrics.write_snapshot()
 
 # Simple app to handle post data:
 @app.route("/enroll",methods=['POST'])
@@ -32,7 +152,10 @@ def process_request():
     # Defaults:
     # Default response type is plist unless set otherwise:
     response_is_tar_file = False
+    response_mode = 'base64'
+    response_includes_groups = False
     response_attachment = None
+    response_timings_dict = {}
     response_dict = {}
     response = None
     # Get HTTP POST variables:
@@ -67,34 +190,65 @@ def process_request():
         except KeyError:
             common.logging_error("Certificate not sent in POST.")
             return None
-        # Load certificate:
-        client_cert = security.pem_to_cert(cert_pem_str)
-        if not client_cert:
+        # Load certificate (parsed once and cached, since a client sends the
+        # same certificate for each transaction):
+        with metrics.timer('mes_auth_stage_seconds',(('stage','cert_lookup'),)):
+            client_cert_entry = cert_cache.lookup(cert_pem_str)
+        if not client_cert_entry:
             common.logging_error("Certificate data is invalid!")
+            return None
+        client_cert = client_cert_entry['cert']
         # Determine computer's manifest name by reading the CN of its certificate.
-        computer_manifest_name = security.read_cert_cn(client_cert).upper()
-        if not computer_manifest_name:
+        if not client_cert_entry['cn']:
+            return None
+        computer_manifest_name = client_cert_entry['cn'].upper()
+        # Authentication: The certificate must have been issued by our CA
+        # and be within its validity window.
+        with metrics.timer('mes_auth_stage_seconds',(('stage','chain'),)):
+            chain_valid = cert_cache.is_chain_valid(client_cert_entry)
+        if not chain_valid:
+            common.logging_error("Authentication error: certificate was not issued by the CA or has expired.")
+            return None
+        with metrics.timer('mes_auth_stage_seconds',(('stage','revocation'),)):
+            revoked = crl.is_revoked(client_cert)
+        if revoked:
+            common.logging_error("Authentication error: certificate has been revoked.")
             return None
         # Authentication: Verify signed message using certificate's public key.
-        if not security.verify_signed_message(message,signature,client_cert):
+        with metrics.timer('mes_auth_stage_seconds',(('stage','signature'),)):
+            signature_valid = security.verify_signed_message(message,signature,client_cert)
+        if not signature_valid:
             common.logging_error("Authentication error: failed to verify the signed message.")
             return None
 
     # Handle command:
     if command == 'request-enrollment':
         client_serial = request.form['message']
-        common.logging_info("Processing enrollment request for %s..." % client_serial)
-        response_attachment = enrollment.do_enrollment(client_serial)
+        response_mode = request.form.get('response_mode','base64')
+        if response_mode not in RESPONSE_MODES:
+            common.logging_error("Unknown response mode %s." % response_mode)
+            return None
+        common.logging_info_sampled("Processing enrollment request for %s...",client_serial)
+        # Turn the client away at once if too many enrollments are in progress:
+        try:
+            with crypto_pool.Admission():
+                response_attachment = enrollment.make_enrollment_archive(client_serial,response_timings_dict)
+        except crypto_pool.PoolBusy:
+            common.logging_info("Enrollment queue full; asking %s to retry later.",client_serial)
+            return make_busy_response()
         if not response_attachment:
-            common.logging_error("Invalid tar file returned by do_enrollment!")
+            common.logging_error("Invalid tar file returned by make_enrollment_archive!")
             return None
+        crypto_pool.record_timings(response_timings_dict)
+        common.logging_info_sampled("Enrollment timings for %(serial)s: %(timings)s",{'serial':client_serial,'timings':crypto_pool.format_timings(response_timings_dict)})
         response_is_tar_file = True
     elif command == 'transaction-a':
-        common.logging_info("Processing transaction A...")
+        common.logging_info_sampled("Processing transaction A...")
         response_dict['computer_manifest'] = manifests.get_computer_manifest_details(computer_manifest_name)
-        ignored,response_dict['group_manifests_array'] = manifests.list_group_manifests()
+        # The group_manifests_array is added from the group index when writing the response:
+        response_includes_groups = True
     elif command == 'transaction-b':
-        common.logging_info("Processing transaction B...")
+        common.logging_info_sampled("Processing transaction B...")
         response_dict['joined_group'] = False
         response_dict['recorded_name'] = False
         try:
@@ -103,15 +257,17 @@ def process_request():
             message_dict = {}
         try:
             group_manifest_name = message_dict['group_manifest_name']
-            response_dict['joined_group'] = manifests.join_group_manifest(computer_manifest_name,group_manifest_name)
         except KeyError:
-            pass
+            group_manifest_name = None
+        metadata_dict = {}
         try:
-            desired_computer_name = message_dict['desired_computer_name']
-            response_dict['recorded_name'] = manifests.write_metadata_to_manifest(computer_manifest_name,'computer_name',desired_computer_name)
+            metadata_dict['computer_name'] = message_dict['desired_computer_name']
         except KeyError:
             pass
-        common.logging_info("Completed transaction B.")
+        # Both changes are applied in one read/modify/write of the manifest:
+        if group_manifest_name or metadata_dict:
+            response_dict['joined_group'],response_dict['recorded_name'] = manifests.update_computer_manifest(computer_manifest_name,group_manifest_name,metadata_dict)
+        common.logging_info_sampled("Completed transaction B.")
     elif command == 'join-manifest': # DEPRECATED!
         common.logging_info("Processing request to join a group manifest...")
         group_manifest_name = message
@@ -124,14 +280,20 @@ def process_request():
         common.logging_info("Completed request to store computer name.")
 
     # Process responses:
-    if response_is_tar_file and response_attachment:
-        common.logging_info("Processing response: tar file.")
-        response = make_response(response_attachment)
+    if response_is_tar_file and response_attachment and response_mode != 'base64':
+        common.logging_info_sampled("Processing response: streamed tar file (%s).",response_mode)
+        response = make_streamed_tar_response(response_attachment,response_mode)
+    elif response_is_tar_file and response_attachment:
+        common.logging_info_sampled("Processing response: tar file.")
+        response = make_response(base64.b64encode(response_attachment))
         response.headers['Content-Disposition'] = "attachment"
     elif response_dict:
-        common.logging_info("Processing response: plist.")
+        common.logging_info_sampled("Processing response: plist.")
         try:
-            response_plist_str = plistlib.writePlistToString(response_dict)
+            if response_includes_groups:
+                response_plist_str = group_index.write_response_with_groups(response_dict)
+            else:
+                response_plist_str = plistlib.writePlistToString(response_dict)
         except xml.parsers.expat.ExpatError:
             response_plist_str = ''
         except TypeError:
@@ -141,10 +303,85 @@ def process_request():
     # Return response:
     if not response:
         return None
+    if response_timings_dict:
+        response.headers['Server-Timing'] = crypto_pool.format_timings(response_timings_dict)
     return response
 
+def make_crl_response(given_format):
+    '''Returns the current CRL in the given format (der or pem), or HTTP 304
+        if the client already has it (If-None-Match).  The CRL is signed
+        ahead of time by crl.get_crl, so this costs a dict lookup.'''
+    signed_crl = crl.get_crl()
+    if not signed_crl:
+        return make_response("CRL unavailable.\n",503)
+    if given_format == 'pem':
+        response = make_response(signed_crl['pem'])
+        response.headers['Content-Type'] = "application/x-pem-file"
+    else:
+        response = make_response(signed_crl['der'])
+        response.headers['Content-Type'] = "application/pkix-crl"
+    response.set_etag("%(etag)s-%(format)s" % {'etag':signed_crl['etag'],'format':given_format})
+    response.last_modified = signed_crl['this_update']
+    # Caches must revalidate so that revocations show up at once; an
+    # unchanged CRL costs them a 304:
+    response.cache_control.public = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+@app.route("/crl",methods=['GET'])
+def process_crl_request():
+    '''Returns the CRL in DER form.'''
+    return make_crl_response('der')
+
+@app.route("/crl.pem",methods=['GET'])
+def process_crl_pem_request():
+    '''Returns the CRL in PEM form.'''
+    return make_crl_response('pem')
+
+def is_direct_local_request():
+    '''Returns true if the request was made from this server to the
+        loopback address without passing through the front end web server.'''
+    if request.remote_addr not in LOCAL_ADDRESSES:
+        return False
+    for header in PROXY_HEADERS:
+        if header in request.headers:
+            return False
+    return True
+
+@app.route("/metrics",methods=['GET'])
+def process_metrics_request():
+    '''Returns the metrics of every MES process in the Prometheus text
+        format.  Answers 404 when metrics are disabled or the request did
+        not come directly from this server.'''
+    if not metrics.is_enabled() or not is_direct_local_request():
+        return make_response("Not Found\n",404)
+    response = make_response(metrics.render())
+    response.headers['Content-Type'] = "text/plain; version=0.0.4; charset=utf-8"
+    response.cache_control.no_store = True
+    return response
+
+def preload():
+    '''Loads what every request needs before the first one arrives: CA
+        material, the CA store, the compiled profile templates and the group
+        index.  wsgi_server.py runs this in the gunicorn master when
+        preload_app is on, so that workers share one copy (copy-on-write)
+        instead of each building its own.'''
+    ca_cache.refresh()
+    security.get_ca_store()
+    mobileconfig.preload()
+    group_index.serialized_groups()
+
+def handle_sighup(signum,frame):
+    '''Signal handler for SIGHUP: reload configuration and cached material on next use.'''
+    config.request_reload()
+    ca_cache.invalidate()
+
 # Launch:
 if __name__ == "__main__":
+    signal.signal(signal.SIGHUP,handle_sighup)
+    key_pool.start()
+    crypto_pool.start()
+    preload()
     if config_server_app.DEBUG_MODE:
         print "WARNING: Web app is running in debug mode!"
         app.run(host="0.0.0.0",port=config_server_app.PORT,debug=True)
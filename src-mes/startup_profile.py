@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+# startup_profile.py
+# Munki Enrollment Server
+# Reports where the time goes when an MES process starts: the import time
+# of each module, the time of each preload step, and the memory used.
+
+# Written by Gerrit DeWitt (gdewitt@gsu.edu)
+# Project started 2015-06-15.  This file created 2026-10-18.
+# Copyright Georgia State University.
+# This script uses publicly-documented methods known to those skilled in the art.
+# References: See top level Read Me.
+
+# Usage: startup_profile.py [count]
+# Imports server.py as a worker does, then runs its preload steps, and
+# prints the count slowest modules (default 25).  "self" is the time spent
+# in a module's own code; "total" includes the modules it imported first.
+# Run it with the same configuration as the MES; it reads the CA material.
+
+import sys, time, resource, __builtin__
+
+# Module name -> [total seconds, self seconds]:
+IMPORT_TIMES = {}
+# Seconds spent in nested imports, for each import in progress:
+IMPORT_STACK = []
+ORIGINAL_IMPORT = __builtin__.__import__
+
+def timed_import(name,*args,**kwargs):
+    '''Replacement for __import__ that times the first import of each module.'''
+    if not name or name in sys.modules:
+        return ORIGINAL_IMPORT(name,*args,**kwargs)
+    start_time = time.time()
+    IMPORT_STACK.append(0.0)
+    try:
+        return ORIGINAL_IMPORT(name,*args,**kwargs)
+    finally:
+        nested_time = IMPORT_STACK.pop()
+        elapsed = time.time() - start_time
+        if IMPORT_STACK:
+            IMPORT_STACK[-1] += elapsed
+        times = IMPORT_TIMES.setdefault(name,[0.0,0.0])
+        times[0] += elapsed
+        times[1] += elapsed - nested_time
+
+def max_rss_mb():
+    '''Returns the peak resident memory of this process in MB.'''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def time_step(given_label,given_function):
+    '''Runs a preload step and prints its time.'''
+    start_time = time.time()
+    given_function()
+    print "  %(label)-44s %(ms)9.1f ms" % {'label':given_label,'ms':(time.time() - start_time)*1000.0}
+
+def main():
+    count = 25
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+    start_rss = max_rss_mb()
+    start_time = time.time()
+    __builtin__.__import__ = timed_import
+    try:
+        import server
+    finally:
+        __builtin__.__import__ = ORIGINAL_IMPORT
+    import_time = time.time() - start_time
+    import_rss = max_rss_mb()
+    print "Slowest imports (ms):"
+    print "  %-44s %9s %9s" % ("module","self","total")
+    for name in sorted(IMPORT_TIMES,key=lambda name: IMPORT_TIMES[name][1],reverse=True)[:count]:
+        print "  %(name)-44s %(self)9.1f %(total)9.1f" % {'name':name,'self':IMPORT_TIMES[name][1]*1000.0,'total':IMPORT_TIMES[name][0]*1000.0}
+    print "Preload steps:"
+    import ca_cache
+    import security
+    import mobileconfig
+    import group_index
+    time_step("CA material",ca_cache.refresh)
+    time_step("CA store",security.get_ca_store)
+    time_step("profile templates",mobileconfig.preload)
+    time_step("group index",group_index.serialized_groups)
+    print "Import: %(ms).1f ms, %(modules)s modules, peak RSS %(before).1f -> %(after).1f MB" % {'ms':import_time*1000.0,'modules':len(IMPORT_TIMES),'before':start_rss,'after':import_rss}
+    print "Ready: %(ms).1f ms, peak RSS %(rss).1f MB" % {'ms':(time.time() - start_time)*1000.0,'rss':max_rss_mb()}
+
+if __name__ == "__main__":
+    main()
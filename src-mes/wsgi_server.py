@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+# wsgi_server.py
+# Munki Enrollment Server
+# Production entry point: runs the Flask app from server.py under the
+# gunicorn pre-fork WSGI server with several worker processes.
+
+# Written by Gerrit DeWitt (gdewitt@gsu.edu)
+# Project started 2015-06-15.  This file created 2026-10-18.
+# Copyright Georgia State University.
+# This script uses publicly-documented methods known to those skilled in the art.
+# References: See top level Read Me.
+
+# Usage: wsgi_server.py [pid_file_path]
+# Signals to the master process (its PID is written to the PID file):
+#  * HUP: graceful reload; new workers start with fresh configuration and
+#    CA material, and old workers finish their current requests first.
+#  * TERM: graceful shutdown.
+#
+# With preload_app on (the default), the master imports the app and loads
+# the configuration, CA material, profile templates and group index once;
+# workers are forked from it ready to serve and share that memory
+# copy-on-write.  Otherwise each worker imports and loads everything itself.
+
+import sys, time, signal, multiprocessing
+from gunicorn.app.base import BaseApplication
+# Import configuration:
+import configuration_classes as config
+config_server_app = config.ServerApp()
+
+class EnrollmentServerApplication(BaseApplication):
+    '''Runs the MES Flask app under gunicorn with settings from ServerApp.'''
+    def __init__(self,given_options):
+        self.options = given_options
+        super(EnrollmentServerApplication,self).__init__()
+
+    def load_config(self):
+        for key in self.options:
+            self.cfg.set(key,self.options[key])
+
+    def load(self):
+        # Called once in the master with preload_app, otherwise in each
+        # worker after it forks.
+        import server
+        server.preload()
+        return server.app
+
+def post_fork(given_arbiter,given_worker):
+    '''gunicorn hook, in the new worker: notes when it was forked.'''
+    given_worker.mes_fork_time = time.time()
+
+def post_worker_init(given_worker):
+    '''gunicorn hook, in the worker once the app is loaded: starts this
+        worker's key pool and crypto pool and handles SIGHUP.  Runs after
+        gunicorn sets up the worker's signals, so our handler is kept.'''
+    import server
+    import key_pool
+    import crypto_pool
+    signal.signal(signal.SIGHUP,server.handle_sighup)
+    key_pool.start()
+    crypto_pool.start()
+    given_worker.log.info("Worker %(pid)s ready %(seconds).3f s after fork." % {'pid':given_worker.pid,'seconds':time.time() - given_worker.mes_fork_time})
+
+def on_reload(given_arbiter):
+    '''gunicorn hook, in the master on HUP before new workers are forked:
+        with preload_app, reloads what the master preloaded so that the new
+        workers start with fresh configuration and CA material.'''
+    if not given_arbiter.cfg.preload_app:
+        return
+    import server
+    import ca_cache
+    config.reload_config(True)
+    ca_cache.invalidate()
+    server.preload()
+
+def worker_exit(given_arbiter,given_worker):
+    '''gunicorn hook: stops this worker's key pool and crypto pool processes,
+        writes any queued issuance records, and retires its metrics.'''
+    import key_pool
+    import crypto_pool
+    import ledger
+    import metrics
+    key_pool.stop()
+    crypto_pool.stop()
+    ledger.flush()
+    metrics.retire()
+
+def gunicorn_options(given_pid_file_path=None):
+    '''Returns a dict of gunicorn settings built from the ServerApp configuration.'''
+    options = {}
+    if config_server_app.DEBUG_MODE:
+        options['bind'] = "0.0.0.0:%s" % config_server_app.PORT
+        options['loglevel'] = "debug"
+    else:
+        options['bind'] = "127.0.0.1:%s" % config_server_app.PORT
+    options['workers'] = config_server_app.WORKERS or multiprocessing.cpu_count()
+    options['worker_class'] = "sync"
+    options['max_requests'] = config_server_app.MAX_REQUESTS
+    options['max_requests_jitter'] = config_server_app.MAX_REQUESTS_JITTER
+    options['timeout'] = config_server_app.REQUEST_TIMEOUT
+    options['graceful_timeout'] = config_server_app.GRACEFUL_TIMEOUT
+    options['proc_name'] = "munki-enrollment-server"
+    options['preload_app'] = config_server_app.PRELOAD_APP
+    options['post_fork'] = post_fork
+    options['post_worker_init'] = post_worker_init
+    options['on_reload'] = on_reload
+    options['worker_exit'] = worker_exit
+    if given_pid_file_path:
+        options['pidfile'] = given_pid_file_path
+    return options
+
+# Launch:
+if __name__ == "__main__":
+    pid_file_path = None
+    if len(sys.argv) > 1:
+        pid_file_path = sys.argv[1]
+    if config_server_app.DEBUG_MODE:
+        print "WARNING: Web app is running in debug mode!"
+    EnrollmentServerApplication(gunicorn_options(pid_file_path)).run()